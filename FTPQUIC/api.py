@@ -0,0 +1,207 @@
+"""
+This Python file houses the library API, to send and receive files from an application that runs its own event loop
+FTClient keeps a pool of connections to one server and sends files, bytes-like objects or async iterables of bytes,
+every upload returns a TransferResult. FTServer runs the server in the current event loop, stores the received files
+in a storage backend (see storage.py) and calls its 'on_file_complete' callbacks with every verified file.
+The command line of file_transfer.py runs the same client and server, with one connection per run.
+"""
+
+import asyncio
+import contextlib
+import logging
+import os
+import time
+import ft_client
+import ft_server
+import quic_engine
+# TransferResult, ReceivedFile and the storage backends are used by the applications of the API too
+from ft_client import TransferResult, TRANSFER_VERIFIED, TRANSFER_FAILED, TRANSFER_ERROR
+from ft_server import ReceivedFile
+from storage import LocalStorage, MemoryStorage, FSYNC_NEVER
+from tickets import ClientTicketCache, SessionTicketStore
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONNECTIONS = 1 # connections the client keeps open to the server
+DEFAULT_UPLOADS_PER_CONNECTION = 8 # uploads sent at the same time over one connection before another one is opened
+
+"""
+This class is a connection of the pool of an FTClient, kept open until the client is closed or the connection times out
+'uploads' counts the files that are being sent over the connection, new uploads use the least loaded connection.
+"""
+class PooledConnection:
+    def __init__(self, client: quic_engine.AsyncQuicServer, exit_stack: contextlib.AsyncExitStack):
+        self.client = client
+        self.exit_stack = exit_stack
+        self.uploads = 0
+
+    def is_closed(self):
+        return self.client.is_closed()
+
+    async def close(self):
+        await self.exit_stack.aclose()
+
+"""
+This class sends files to one server over a pool of up to 'max_connections' connections, reused by all uploads
+A connection is opened when every open connection already sends 'uploads_per_connection' files, or when the server
+closed the previous ones, e.g. after the idle timeout. With a 'ticket_cache', new connections resume the last TLS session
+and send their first PDUs as 0-RTT data.
+The other keyword arguments are the options of the transfers (streams, resume, delta, digest, mmap, compression, chunk_size,
+offloader), which every upload can override, and of the connections (send_window, receive_queue).
+"""
+class FTClient:
+    def __init__(self, host, port, cert_file = None, *, wire_format = None, max_connections = DEFAULT_MAX_CONNECTIONS,
+                 uploads_per_connection = DEFAULT_UPLOADS_PER_CONNECTION, ticket_cache: ClientTicketCache = None,
+                 qlog_dir = None, **options):
+        self.host = host
+        self.port = port
+        self.configuration = quic_engine.build_client_quic_config(cert_file, wire_format, qlog_dir)
+        self.max_connections = max(1, max_connections)
+        self.uploads_per_connection = max(1, uploads_per_connection)
+        self.ticket_cache = ticket_cache
+        self.scope = options
+        self._connections = [] # open connections of the pool
+        self._lock = asyncio.Lock() # connections are opened one at a time
+        self._closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    # Opens a connection of the pool, returns it and whether it still waits for its handshake, with early data
+    async def _open_connection(self):
+        exit_stack = contextlib.AsyncExitStack()
+        client = await exit_stack.enter_async_context(quic_engine.open_client_connection(
+                self.host, self.port, self.configuration, self.scope, self.ticket_cache))
+        connection = PooledConnection(client, exit_stack)
+        self._connections.append(connection)
+        logger.info(f"[cli] Opened Connection {len(self._connections)}/{self.max_connections} to {self.host}:{self.port}")
+        return connection, client.early_alpn is not None
+
+    # Returns the least loaded open connection, opening one if they are all busy and the pool is not full
+    async def _acquire(self):
+        async with self._lock:
+            if self._closed:
+                raise ConnectionError("Client is closed")
+            for connection in [connection for connection in self._connections if connection.is_closed()]:
+                self._connections.remove(connection)
+                await connection.close()
+            connection = min(self._connections, key=lambda connection: connection.uploads, default=None)
+            if connection is None or (connection.uploads >= self.uploads_per_connection and len(self._connections) < self.max_connections):
+                return await self._open_connection()
+            return connection, False
+
+    """
+    This function sends 'source' to the server and returns a TransferResult, it does not raise when the transfer fails
+    'source' is the path of a file, a bytes-like object or an async iterable of bytes-like pieces, which are sent as
+    they are produced. Bytes and iterables are stored under 'filename', files under their path unless it is given.
+    The keyword arguments override the options of the client for this upload.
+    """
+    async def upload(self, source, filename = None, **options) -> TransferResult:
+        data = None
+        path = None
+        if isinstance(source, (str, os.PathLike)):
+            path = os.fspath(source)
+            filename = filename or path
+        else:
+            data = source
+            if filename is None:
+                raise ValueError("Bytes and async iterables need a filename")
+            if not hasattr(data, "__aiter__"):
+                data = memoryview(data) # raises TypeError for other objects
+
+        result = TransferResult(filename)
+        started = time.perf_counter()
+        try:
+            connection, early_data = await self._acquire()
+        except (ConnectionError, OSError) as e:
+            logger.error(f"[cli] Error: Could not connect to server! {e}")
+            result.status = TRANSFER_ERROR
+            result.error = repr(e)
+            result.connect_seconds = time.perf_counter() - started
+            return result
+
+        connection.uploads += 1
+        try:
+            handler = connection.client._client_handler
+            conn = handler.ft_connection()
+            scope = {**handler.scope, **options, "wire_format": handler.scope["wire_format"]} # negotiated by the connection
+            transfer = ft_client.ft_client_proto(scope, conn, filename, data, result, path)
+            result.connect_seconds = time.perf_counter() - started
+            if early_data:
+                # The first upload of a connection that resumed a session sends as 0-RTT data while it waits for the handshake
+                transfer = await quic_engine.start_transfer(connection.client, transfer)
+            await transfer
+        except Exception as e: # the connection was lost, or the source could not be read
+            logger.error(f"[cli] Error: Upload of {filename} Failed! {e!r}")
+            result.status = TRANSFER_ERROR
+            result.error = repr(e)
+        finally:
+            connection.uploads -= 1
+        return result
+
+    # Closes every connection of the pool, uploads that are still running fail
+    async def close(self):
+        async with self._lock:
+            self._closed = True
+            connections, self._connections = self._connections, []
+            for connection in connections:
+                await connection.close()
+
+"""
+This class runs the server in the current event loop, until it is closed
+Received files are stored in 'storage', a LocalStorage or MemoryStorage, or in the LocalStorage of the directory when
+a path is given, and in the 'server_files' directory by default. 'on_file_complete' is a callable, or a list of them,
+called with the ReceivedFile of every verified file once it is stored, callbacks can be coroutines.
+Clients cannot send files larger than 'max_file_size' bytes, or than the 'max_file_size' of a MemoryStorage if it is smaller.
+"""
+class FTServer:
+    def __init__(self, host, port, *, cert_file, key_file, storage = None, on_file_complete = None, wire_format = None,
+                 fsync = FSYNC_NEVER, offloader = None, ticket_store: SessionTicketStore = None, qlog_dir = None,
+                 receive_queue = quic_engine.DEFAULT_RECEIVE_QUEUE_SIZE, max_file_size = ft_server.DEFAULT_MAX_FILE_SIZE):
+        self.host = host
+        self.port = port
+        self.configuration = quic_engine.build_server_quic_config(cert_file, key_file, wire_format, qlog_dir)
+        if isinstance(storage, (str, os.PathLike)):
+            storage = LocalStorage(os.fspath(storage))
+        if on_file_complete is None:
+            on_file_complete = []
+        elif callable(on_file_complete):
+            on_file_complete = [on_file_complete]
+        self.on_file_complete = list(on_file_complete) # shared by the handlers, so callbacks can be added while the server runs
+        self.storage = storage
+        self.scope = {"fsync": fsync, "max_file_size": max_file_size, "receive_queue": receive_queue, "storage": storage,
+                      "on_file_complete": self.on_file_complete}
+        if offloader is not None:
+            self.scope["offloader"] = offloader
+        self.ticket_store = ticket_store or SessionTicketStore()
+        self._server = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    # Starts listening, raises OSError when the port is not available
+    async def start(self):
+        if self._server is None:
+            self._server = await quic_engine.start_server(self.host, self.port, self.configuration, self.scope,
+                                                          ticket_store=self.ticket_store)
+
+    # Stops listening and closes the connections of the clients
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    # Runs the server until the task is cancelled
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await asyncio.Future()
+        finally:
+            self.close()
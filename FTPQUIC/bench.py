@@ -0,0 +1,278 @@
+"""
+This Python file houses the transfer benchmark suite
+The server and the client run in one process over loopback, with a generated certificate and generated files.
+Every payload set is sent over one connection, in a process of its own so its peak memory is measured alone, and
+the results are printed as JSON, so they can be compared
+between versions. A UDP proxy between the client and the server can drop and delay datagrams to emulate a bad link.
+Usage:
+python3 bench.py --sets 1kb 1mb 100mb small-files [--loss 0.01 --delay-ms 20] [--output results.json]
+"""
+
+import argparse
+import asyncio
+import datetime
+import ipaddress
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+import quic_engine
+import ft_client
+import pdu
+from storage import LocalStorage
+
+BENCH_HOST = "127.0.0.1"
+SERVER_NAME = "localhost" # name in the generated certificate
+WRITE_SIZE = 1024 * 1024 # generated files are written in pieces of this size
+
+# Payload sets: name -> (number of files, size of every file in bytes)
+PAYLOAD_SETS = {
+    "1kb": (1, 1024),
+    "1mb": (1, 1024 * 1024),
+    "100mb": (1, 100 * 1024 * 1024),
+    "1gb": (1, 1024 * 1024 * 1024),
+    "small-files": (1000, 1024),
+}
+DEFAULT_SETS = ["1kb", "1mb", "100mb", "small-files"]
+
+WIRE_FORMATS = {"binary": pdu.WIRE_FORMAT_BINARY, "json": pdu.WIRE_FORMAT_JSON}
+
+# This function writes a self signed certificate and its private key for the benchmark server
+def generate_certificate(directory):
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, SERVER_NAME)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(SERVER_NAME),
+                                                    x509.IPAddress(ipaddress.ip_address(BENCH_HOST))]), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    cert_file = os.path.join(directory, "bench_certificate.pem")
+    key_file = os.path.join(directory, "bench_private_key.pem")
+    with open(cert_file, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_file, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    return cert_file, key_file
+
+# This function writes the files of a payload set with random content and returns their paths
+def generate_payload(directory, set_name):
+    count, size = PAYLOAD_SETS[set_name]
+    set_directory = os.path.join(directory, set_name)
+    os.makedirs(set_directory, exist_ok=True)
+    filenames = []
+    for index in range(count):
+        filename = os.path.join(set_directory, f"file_{index:05d}.bin")
+        with open(filename, "wb") as f:
+            for offset in range(0, size, WRITE_SIZE):
+                f.write(os.urandom(min(WRITE_SIZE, size - offset)))
+        filenames.append(filename)
+    return filenames
+
+# This function returns a UDP port that is free on the benchmark host
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.bind((BENCH_HOST, 0))
+        return s.getsockname()[1]
+
+# This function returns the value below which 'percent' percent of the values fall (nearest rank)
+def percentile(values, percent):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100)) # round up
+    return ordered[int(rank) - 1]
+
+# Receives the datagrams of one UDP socket of the proxy
+class ProxyEndpoint(asyncio.DatagramProtocol):
+    def __init__(self, on_datagram):
+        self.on_datagram = on_datagram
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.on_datagram(data, addr)
+
+"""
+This class forwards UDP datagrams between one client and the server to emulate a bad link
+Every datagram is dropped with probability 'loss' and otherwise delivered after 'delay' seconds, in both directions.
+"""
+class LossyLinkProxy:
+    def __init__(self, target, loss = 0.0, delay = 0.0, seed = None):
+        self.target = target
+        self.loss = loss
+        self.delay = delay
+        self.forwarded = 0
+        self.dropped = 0
+        self._random = random.Random(seed)
+        self._client_addr = None
+        self._listener = None # socket the client sends to
+        self._upstream = None # socket connected to the server
+
+    async def start(self, port):
+        loop = asyncio.get_running_loop()
+        self._listener, _ = await loop.create_datagram_endpoint(lambda: ProxyEndpoint(self._from_client), local_addr=(BENCH_HOST, port))
+        self._upstream, _ = await loop.create_datagram_endpoint(lambda: ProxyEndpoint(self._from_server), remote_addr=self.target)
+
+    def _from_client(self, data, addr):
+        self._client_addr = addr
+        self._forward(self._upstream, data, None)
+
+    def _from_server(self, data, addr):
+        if self._client_addr is not None:
+            self._forward(self._listener, data, self._client_addr)
+
+    def _forward(self, transport, data, addr):
+        if self.loss and self._random.random() < self.loss:
+            self.dropped += 1
+            return
+        self.forwarded += 1
+        if self.delay:
+            asyncio.get_running_loop().call_later(self.delay, transport.sendto, data, addr)
+        else:
+            transport.sendto(data, addr)
+
+    def close(self):
+        for transport in (self._listener, self._upstream):
+            if transport is not None:
+                transport.close()
+
+# This function sends a list of files over one connection to an in-process server and measures the transfer
+# The server stores the received files in 'server_directory'
+async def run_transfer(filenames, cert_file, key_file, wire_format, scope, loss, delay, server_directory):
+    server_port = free_port()
+    server_config = quic_engine.build_server_quic_config(cert_file, key_file, wire_format)
+    client_config = quic_engine.build_client_quic_config(cert_file, wire_format)
+    client_config.server_name = SERVER_NAME
+    server = await quic_engine.start_server(BENCH_HOST, server_port, server_config, {"storage": LocalStorage(server_directory)})
+
+    proxy = None
+    client_port = server_port
+    if loss or delay:
+        proxy = LossyLinkProxy((BENCH_HOST, server_port), loss, delay)
+        client_port = free_port()
+        await proxy.start(client_port)
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    try:
+        results = await quic_engine.run_client(BENCH_HOST, client_port, client_config, filenames, dict(scope))
+    finally:
+        elapsed = time.perf_counter() - started
+        cpu_seconds = time.process_time() - cpu_started
+        if proxy is not None:
+            proxy.close()
+        server.close()
+    return results or [], elapsed, cpu_seconds, proxy
+
+# This function runs one payload set and returns its measurements, it runs in a process of its own, see run_set()
+def bench_set(set_name, filenames, cert_file, key_file, wire_format, scope, loss, delay, repeat, server_directory):
+    latencies = []
+    successful = 0
+    total_bytes = 0
+    seconds = 0.0
+    cpu_seconds = 0.0
+    dropped = 0
+    for _ in range(repeat):
+        results, elapsed, cpu, proxy = asyncio.run(run_transfer(filenames, cert_file, key_file, wire_format, scope, loss, delay,
+                                                                server_directory))
+        shutil.rmtree(server_directory, ignore_errors=True) # received files of the run
+        seconds += elapsed
+        cpu_seconds += cpu
+        dropped += proxy.dropped if proxy is not None else 0
+        for result in results:
+            if result["successful"]:
+                successful += 1
+                total_bytes += result["size"]
+                latencies.append(result["seconds"])
+
+    return {
+        "set": set_name,
+        "files": len(filenames) * repeat,
+        "successful": successful,
+        "bytes": total_bytes,
+        "seconds": seconds,
+        "mb_s": total_bytes / 1e6 / seconds if seconds else 0.0,
+        "files_s": successful / seconds if seconds else 0.0,
+        "latency_p50_ms": percentile(latencies, 50) * 1000 if latencies else None,
+        "latency_p99_ms": percentile(latencies, 99) * 1000 if latencies else None,
+        "cpu_seconds": cpu_seconds,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, # peak of the process of this set
+        "dropped_datagrams": dropped,
+    }
+
+# This function runs bench_set() in a new process, so the peak memory of a set does not include the earlier sets
+# or the generation of the payload files
+def run_set(*args):
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(bench_set, *args).result()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Transfer benchmarks for File Transfer over QUIC')
+    parser.add_argument('--sets', nargs='+', choices=PAYLOAD_SETS.keys(), default=DEFAULT_SETS, help='Payload sets to send')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of times every set is sent')
+    parser.add_argument('-w', '--wire-format', choices=WIRE_FORMATS.keys(), default='binary', help='PDU wire format')
+    parser.add_argument('--streams', type=int, default=1, help='Number of parallel streams per file')
+    parser.add_argument('--concurrency', type=int, default=ft_client.DEFAULT_CONCURRENCY, help='Number of files sent at the same time')
+    parser.add_argument('--chunk-size', default=ft_client.CHUNK_SIZE, help="Chunk size in bytes, or 'auto'")
+    parser.add_argument('--loss', type=float, default=0.0, help='Probability that the proxy drops a datagram')
+    parser.add_argument('--delay-ms', type=float, default=0.0, help='One way delay added by the proxy in milliseconds')
+    parser.add_argument('--output', help='File to write the JSON results to (default: standard output)')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    # Only warnings of the client and server are shown, so they do not hide the benchmark output
+    logging.basicConfig(format="%(message)s", stream=sys.stderr, level=logging.WARNING)
+    chunk_size = args.chunk_size if args.chunk_size == ft_client.CHUNK_SIZE_AUTO else int(args.chunk_size)
+    scope = {"streams": args.streams, "concurrency": args.concurrency, "chunk_size": chunk_size}
+    config = {"sets": args.sets, "repeat": args.repeat, "wire_format": args.wire_format, "streams": args.streams,
+              "concurrency": args.concurrency, "chunk_size": chunk_size, "loss": args.loss, "delay_ms": args.delay_ms}
+
+    work_directory = tempfile.mkdtemp(prefix="ftquic_bench_")
+    server_directory = os.path.join(work_directory, "server_files") # received files, removed after every run
+    try:
+        cert_file, key_file = generate_certificate(work_directory)
+        results = []
+        for set_name in args.sets:
+            filenames = generate_payload(work_directory, set_name)
+            result = run_set(set_name, filenames, cert_file, key_file, WIRE_FORMATS[args.wire_format], scope,
+                             args.loss, args.delay_ms / 1000, args.repeat, server_directory)
+            results.append(result)
+            shutil.rmtree(os.path.join(work_directory, set_name))
+            print(f"[bench] {set_name}: {result['successful']}/{result['files']} files, {result['mb_s']:.2f} MB/s, "
+                  f"{result['files_s']:.1f} files/s, p50 {result['latency_p50_ms'] or 0:.1f} ms, "
+                  f"p99 {result['latency_p99_ms'] or 0:.1f} ms, CPU {result['cpu_seconds']:.2f} s", file=sys.stderr)
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    report = json.dumps({"config": config, "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+if __name__ == '__main__':
+    main()
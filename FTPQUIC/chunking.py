@@ -0,0 +1,83 @@
+"""
+This Python file houses the content-defined chunking used by delta transfers
+Chunk boundaries are chosen from the content with a rolling gear hash (FastCDC), so an insertion or deletion
+only changes the chunks around it and every other chunk keeps its hash.
+"""
+
+import hashlib
+import random
+
+MIN_CHUNK_SIZE = 2 * 1024
+AVERAGE_CHUNK_SIZE = 8 * 1024
+MAX_CHUNK_SIZE = 64 * 1024
+READ_SIZE = 1024 * 1024 # number of bytes read from the file at a time
+
+# Normalized chunking: a boundary is harder to hit before the average size and easier after it,
+# which keeps chunk sizes close to the average. These are the masks of FastCDC for 8 KiB chunks, with 15 and 11 bits
+# spread over the high bits of the hash, so a boundary depends on the last 48 or so bytes rather than the last 15
+MASK_BEFORE_AVERAGE = 0x0003590703530000 # MaskS
+MASK_AFTER_AVERAGE = 0x0000D90003530000 # MaskL
+# Only the bits of the masks are tested, so the gear hash is kept to the 50 bits they cover: with 64 bits, the same
+# cuts are found, but Python spends more time on the larger integers
+HASH_MASK = (1 << (MASK_BEFORE_AVERAGE | MASK_AFTER_AVERAGE).bit_length()) - 1
+
+# Random values for every byte value, from a fixed seed so every client cuts the same content at the same places
+_gear_random = random.Random(544)
+GEAR = tuple(_gear_random.getrandbits(64) & HASH_MASK for _ in range(256))
+
+# This function returns the length of the first chunk of 'data', which starts at 'start' and has 'size' bytes left
+# Its loop runs for every byte past the minimum chunk size in pure Python, so files are chunked at only about 8 MB/s,
+# in the offload pool of the client
+def find_cut(data, start, size):
+    if size <= MIN_CHUNK_SIZE:
+        return size
+    end = start + min(size, MAX_CHUNK_SIZE)
+    average = start + min(size, AVERAGE_CHUNK_SIZE)
+    gear = GEAR
+    hash_mask = HASH_MASK
+    mask = MASK_BEFORE_AVERAGE
+    rolling_hash = 0
+    # 'length' is the length of the chunk if it is cut after the byte
+    for length, byte in enumerate(data[start + MIN_CHUNK_SIZE:average], MIN_CHUNK_SIZE + 1):
+        rolling_hash = ((rolling_hash << 1) + gear[byte]) & hash_mask
+        if not rolling_hash & mask:
+            return length
+    mask = MASK_AFTER_AVERAGE
+    for length, byte in enumerate(data[average:end], average - start + 1):
+        rolling_hash = ((rolling_hash << 1) + gear[byte]) & hash_mask
+        if not rolling_hash & mask:
+            return length
+    return end - start
+
+# This function reads a file object and yields its content-defined chunks
+def iter_chunks(f):
+    buffer = b''
+    start = 0
+    eof = False
+    while True:
+        # Keep at least one maximum size chunk buffered, unless the end of the file was reached
+        if not eof and len(buffer) - start < MAX_CHUNK_SIZE:
+            data = f.read(READ_SIZE)
+            eof = not data
+            buffer = buffer[start:] + data
+            start = 0
+            continue
+        size = len(buffer) - start
+        if size == 0:
+            return
+        cut = find_cut(buffer, start, size)
+        yield buffer[start:start + cut]
+        start += cut
+
+# This function splits a file and returns the offset, length and SHA-256 of every chunk, and the SHA-256 of the file
+# It only takes a path and returns plain values, so it can run in a worker process
+def chunk_file(filename):
+    file_hash = hashlib.sha256()
+    chunks = []
+    offset = 0
+    with open(filename, "rb") as f:
+        for chunk in iter_chunks(f):
+            file_hash.update(chunk)
+            chunks.append((offset, len(chunk), hashlib.sha256(chunk).hexdigest()))
+            offset += len(chunk)
+    return chunks, file_hash.hexdigest()
@@ -0,0 +1,116 @@
+"""
+This Python file houses the compression codecs of file chunks
+A codec is negotiated with the 'compression' option of the START PDU, and every chunk is compressed on its own,
+so chunks can still be streamed and checked against their checksum, which is computed on the uncompressed chunk.
+A chunk that does not shrink is sent as it is, with no compression flag, and a transfer stops compressing after
+several such chunks in a row, e.g. for files that are already compressed.
+zlib is always available, zstd and lz4 are used when the 'zstandard' and 'lz4' packages are installed.
+"""
+
+import zlib
+
+COMPRESSION_NONE = "none"
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_ZSTD = "zstd"
+COMPRESSION_LZ4 = "lz4"
+
+INCOMPRESSIBLE_CHUNKS = 8 # chunks in a row that did not shrink before a transfer stops compressing
+PROBE_INTERVAL = 256 # chunks sent uncompressed before compression is tried again, in case the content changed
+
+def zlib_compress(data, level = None):
+    return zlib.compress(data, 6 if level is None else level)
+
+# Decompression is bounded by the chunk size, so a small PDU cannot expand into a huge chunk
+def zlib_decompress(data, max_size):
+    decompressor = zlib.decompressobj()
+    chunk = decompressor.decompress(data, max_size)
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError("Compressed chunk is larger than the chunk size or incomplete")
+    return chunk
+
+# Compression codecs by name, as (compress(data, level), decompress(data, max_size))
+CODECS = {
+    COMPRESSION_ZLIB: (zlib_compress, zlib_decompress),
+}
+
+try:
+    import zstandard
+
+    def zstd_compress(data, level = None):
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+
+    # max_output_size only applies to frames without a content size, a frame that declares one is decompressed into a
+    # buffer of that size, so the declared size is checked first
+    def zstd_decompress(data, max_size):
+        if zstandard.frame_content_size(data) > max_size: # -1 when the frame does not declare it
+            raise ValueError("Compressed chunk is larger than the chunk size")
+        chunk = zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size)
+        if len(chunk) > max_size:
+            raise ValueError("Compressed chunk is larger than the chunk size")
+        return chunk
+
+    CODECS[COMPRESSION_ZSTD] = (zstd_compress, zstd_decompress)
+except ImportError:
+    pass
+
+try:
+    import lz4.frame
+
+    def lz4_compress(data, level = None):
+        return lz4.frame.compress(data, compression_level=0 if level is None else level)
+
+    def lz4_decompress(data, max_size):
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+        chunk = decompressor.decompress(data, max_length=max_size)
+        if not decompressor.eof:
+            raise ValueError("Compressed chunk is larger than the chunk size or incomplete")
+        return chunk
+
+    CODECS[COMPRESSION_LZ4] = (lz4_compress, lz4_decompress)
+except ImportError:
+    pass
+
+# This function returns the decompressed chunk of a DATA PDU, it can run in a worker thread or process
+# The errors of every codec are raised as ValueError, so a corrupted chunk is handled like an invalid checksum
+def decompress_chunk(data, codec, max_size):
+    if codec not in CODECS:
+        raise ValueError(f"Unsupported compression: {codec}")
+    try:
+        return CODECS[codec][1](data, max_size)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f"Corrupted {codec} chunk: {e}") from e
+
+"""
+This class compresses the chunks of one transfer, it is used by one worker thread at a time
+compress() returns the compressed chunk, or None when the chunk should be sent as it is.
+After INCOMPRESSIBLE_CHUNKS chunks in a row that did not shrink, chunks are sent as they are without trying,
+and compression is tried again every PROBE_INTERVAL chunks.
+"""
+class ChunkCompressor:
+    def __init__(self, codec, level = None):
+        if codec not in CODECS:
+            raise ValueError(f"Unsupported compression: {codec}")
+        self.codec = codec
+        self.level = level
+        self._compress = CODECS[codec][0]
+        self._incompressible = 0 # chunks in a row that did not shrink
+        self._skipped = 0 # chunks sent without trying since compression was turned off
+
+    @property
+    def enabled(self):
+        return self._incompressible < INCOMPRESSIBLE_CHUNKS
+
+    def compress(self, data):
+        if not self.enabled:
+            self._skipped += 1
+            if self._skipped < PROBE_INTERVAL:
+                return None
+            self._skipped = 0 # probe whether the chunks compress again
+        compressed = self._compress(data, self.level)
+        if len(compressed) >= len(data):
+            self._incompressible += 1
+            return None
+        self._incompressible = 0
+        return compressed
@@ -0,0 +1,141 @@
+"""
+This Python file houses the executor layer used to run hashing and disk I/O off the event loop
+Blocking work runs in a pool of worker threads, and CPU bound work (hashing, content-defined chunking) can be
+sent to a pool of worker processes instead. hashlib releases the GIL, so hashing runs in parallel in both cases.
+Every transfer submits its jobs through its own bounded queue, so a large transfer cannot fill the pool and
+starve the other transfers, and the event loop keeps processing QUIC acknowledgements and timers meanwhile.
+Timed jobs measure themselves in the worker, so the histograms do not include the time a job waited in the queue.
+"""
+
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pdu import new_digest, DIGEST_SHA256
+from compression import decompress_chunk
+from metrics import metrics
+
+EXECUTOR_THREAD = "thread"
+EXECUTOR_PROCESS = "process"
+EXECUTOR_KINDS = (EXECUTOR_THREAD, EXECUTOR_PROCESS)
+
+DEFAULT_QUEUE_SIZE = 2 # jobs of one transfer that can be waiting in the pool at the same time
+OFFLOAD_MIN_SIZE = 64 * 1024 # smaller buffers are hashed on the event loop, handing them to a worker costs more
+
+# This function returns the digest of a buffer as a hexadecimal string, it is sent to the workers
+def hexdigest(data, digest = DIGEST_SHA256):
+    return new_digest(digest, data).hexdigest()
+
+# This function runs a job in a worker and returns its result with the seconds it took there, it is sent to the workers
+def timed_call(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+"""
+This class runs blocking functions in worker threads or processes
+Disk I/O always runs in threads, since open files and hash objects cannot be sent to another process.
+With the process executor, CPU bound jobs run in processes and must only use picklable arguments.
+"""
+class Offloader:
+    def __init__(self, kind = EXECUTOR_THREAD, workers = None):
+        if kind not in EXECUTOR_KINDS:
+            raise ValueError(f"Unknown executor: {kind}")
+        self.kind = kind
+        self._io_executor = ThreadPoolExecutor(workers, thread_name_prefix="ft-io")
+        self._cpu_executor = ProcessPoolExecutor(workers) if kind == EXECUTOR_PROCESS else self._io_executor
+
+    # Runs a function that does blocking I/O in a worker thread
+    async def run_io(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._io_executor, func, *args)
+
+    # Runs a CPU bound function in a worker thread, or in a worker process with the process executor
+    async def run_cpu(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._cpu_executor, func, *args)
+
+    # Returns a bounded queue for the jobs of one transfer
+    def queue(self, limit = DEFAULT_QUEUE_SIZE):
+        return JobQueue(self, limit)
+
+    def shutdown(self):
+        self._io_executor.shutdown(wait=False)
+        if self._cpu_executor is not self._io_executor:
+            self._cpu_executor.shutdown(wait=False)
+
+"""
+This class limits how many jobs of one transfer are submitted to the pool at the same time
+submit() waits while 'limit' jobs are pending and returns a future, so a transfer can prepare its next job
+(e.g. read the next block of a file) while it sends the previous one.
+"""
+class JobQueue:
+    def __init__(self, offloader: Offloader, limit = DEFAULT_QUEUE_SIZE):
+        self.offloader = offloader
+        self._slots = asyncio.Semaphore(max(1, limit))
+
+    async def _run(self, runner, func, args):
+        try:
+            return await runner(func, *args)
+        finally:
+            self._slots.release()
+
+    # Submits a blocking I/O job and returns a future of its result, waits while the queue is full
+    async def submit_io(self, func, *args):
+        await self._slots.acquire()
+        return asyncio.ensure_future(self._run(self.offloader.run_io, func, args))
+
+    # Submits a CPU bound job and returns a future of its result, waits while the queue is full
+    async def submit_cpu(self, func, *args):
+        await self._slots.acquire()
+        return asyncio.ensure_future(self._run(self.offloader.run_cpu, func, args))
+
+    # Runs a blocking I/O job through the queue and returns its result
+    async def run_io(self, func, *args):
+        return await (await self.submit_io(func, *args))
+
+    # Runs a CPU bound job through the queue and returns its result
+    async def run_cpu(self, func, *args):
+        return await (await self.submit_cpu(func, *args))
+
+    # Runs a blocking I/O job through the queue and adds the time it took in the worker to the 'metric' histogram of 'role'
+    async def run_io_timed(self, metric, role, func, *args):
+        result, seconds = await self.run_io(timed_call, func, *args)
+        metrics.observe(metric, seconds, role)
+        return result
+
+    # Runs a CPU bound job through the queue and adds the time it took in the worker to the 'metric' histogram of 'role'
+    async def run_cpu_timed(self, metric, role, func, *args):
+        result, seconds = await self.run_cpu(timed_call, func, *args)
+        metrics.observe(metric, seconds, role)
+        return result
+
+    # Returns the digest of a buffer as a hexadecimal string, small buffers are hashed right away
+    # The time spent hashing is added to the 'hash_seconds' histogram of 'role'
+    async def hexdigest(self, data, digest = DIGEST_SHA256, role = ""):
+        if len(data) < OFFLOAD_MIN_SIZE:
+            with metrics.timer("hash_seconds", role):
+                return hexdigest(data, digest)
+        if self.offloader.kind == EXECUTOR_PROCESS:
+            data = bytes(data) # memoryviews cannot be sent to a process
+        return await self.run_cpu_timed("hash_seconds", role, hexdigest, data, digest)
+
+    # Returns the decompressed chunk of a DATA PDU, chunks of at most 'max_size' bytes are decompressed right away if that is small
+    # The time spent decompressing is added to the 'compress_seconds' histogram of 'role'
+    async def decompress(self, data, codec, max_size, role = ""):
+        if max_size < OFFLOAD_MIN_SIZE:
+            with metrics.timer("compress_seconds", role):
+                return decompress_chunk(data, codec, max_size)
+        if self.offloader.kind == EXECUTOR_PROCESS:
+            data = bytes(data) # memoryviews cannot be sent to a process
+        return await self.run_cpu_timed("compress_seconds", role, decompress_chunk, data, codec, max_size)
+
+# Shared offloader of the handlers that were not given one in their scope
+_default_offloader = None
+
+# This function returns the offloader in the scope of a handler, or the shared thread pool
+def get_offloader(scope):
+    global _default_offloader
+    offloader = scope.get("offloader")
+    if offloader is None:
+        if _default_offloader is None:
+            _default_offloader = Offloader()
+        offloader = _default_offloader
+    return offloader
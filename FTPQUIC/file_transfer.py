@@ -1,51 +1,190 @@
 import argparse
 import asyncio
+import functools
+import logging
+import os
+import sys
 import quic_engine
+import pdu
+import storage
+import ft_client
+import ft_server
+import executor
+import compression
+import metrics
+import workers
+import tickets
+from utils import expand_paths
+
+# Wire formats selectable from the command line, both are offered when none is given
+WIRE_FORMATS = {"binary": pdu.WIRE_FORMAT_BINARY, "json": pdu.WIRE_FORMAT_JSON}
+
+# Log levels selectable from the command line, 'debug' shows a message for every chunk
+LOG_LEVELS = {"debug": logging.DEBUG, "info": logging.INFO, "warning": logging.WARNING, "error": logging.ERROR}
+APP_LOGGERS = ("quic_engine", "ft_client", "ft_server") # other libraries (aioquic, asyncio) only show warnings
+
+# This function shows the messages of the client and server at or above 'level'
+def configure_logging(level):
+    logging.basicConfig(format="%(message)s", stream=sys.stdout, level=max(level, logging.WARNING))
+    for name in APP_LOGGERS:
+        logging.getLogger(name).setLevel(level)
+
+# This function parses the chunk size option: a number of bytes, or 'auto' to adapt it to the connection
+def chunk_size_arg(value):
+    if value == ft_client.CHUNK_SIZE_AUTO:
+        return value
+    try:
+        size = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid chunk size: {value}")
+    if size <= 0:
+        raise argparse.ArgumentTypeError(f"chunk size must be positive: {value}")
+    return size
+
+# This function parses the byte range of a download: 'OFFSET:LENGTH', or 'OFFSET:' for the rest of the file
+def range_arg(value):
+    offset, separator, length = value.partition(":")
+    try:
+        byte_range = (int(offset), int(length) if length else None)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid range: {value}")
+    if not separator or byte_range[0] < 0 or (byte_range[1] is not None and byte_range[1] < 0):
+        raise argparse.ArgumentTypeError(f"range must be OFFSET:LENGTH or OFFSET: {value}")
+    return byte_range
 
 def client_mode(args):
     server_address = args.server
     server_port = args.port
     cert_file = args.cert_file
 
-    # Retrieve file name from command line args
-    filename = args.filename
+    # Retrieve file names from command line args, expanding glob patterns and directories of the files to send
+    # Other operations name files stored on the server
+    filenames = expand_paths(args.filename) if args.operation == ft_client.OPERATION_PUT else args.filename
+    
+    wire_format = WIRE_FORMATS.get(args.wire_format)
+    
+    # Options passed to the client request handler
+    scope = {"send_window": args.window, "receive_queue": args.receive_queue, "streams": args.streams, "concurrency": args.concurrency,
+             "resume": args.resume, "delta": args.delta, "digest": args.digest, "mmap": args.mmap,
+             "compression": args.compression, "chunk_size": args.chunk_size, "operation": args.operation, "range": args.range,
+             "output_dir": args.output_dir,
+             "offloader": executor.Offloader(args.executor, args.executor_workers)}
     
-    config = quic_engine.build_client_quic_config(cert_file)
-    asyncio.run(quic_engine.run_client(server_address, server_port, config, filename))
+    config = quic_engine.build_client_quic_config(cert_file, wire_format, args.qlog_dir)
+    ticket_cache = tickets.ClientTicketCache(args.session_tickets) if args.session_tickets else None
+    try:
+        asyncio.run(quic_engine.run_client(server_address, server_port, config, filenames, scope, ticket_cache))
+    finally:
+        if args.metrics_json:
+            metrics.metrics.write_json(args.metrics_json)
     
     
 def server_mode(args):
-    listen_address = args.listen
-    listen_port = args.port
-    cert_file = args.cert_file
-    key_file = args.key_file
+    worker_count = args.workers or os.cpu_count() or 1
+    if worker_count > 1:
+        # Every worker process runs its own server on the same port, the parent exports their metrics
+        workers.run_workers(worker_count, functools.partial(serve_worker, args), functools.partial(serve_metrics, args))
+    else:
+        asyncio.run(serve(args))
+
+# This function returns the configuration, the options and the session ticket store of the server, every worker process builds its own
+def server_setup(args):
+    wire_format = WIRE_FORMATS.get(args.wire_format)
+    
+    # Options passed to every server request handler
+    scope = {"fsync": args.fsync, "max_file_size": args.max_file_size, "receive_queue": args.receive_queue, "offloader": executor.Offloader(args.executor, args.executor_workers)}
     
-    server_config = quic_engine.build_server_quic_config(cert_file, key_file)
-    asyncio.run(quic_engine.run_server(listen_address, listen_port, server_config))
+    server_config = quic_engine.build_server_quic_config(args.cert_file, args.key_file, wire_format, args.qlog_dir)
+    ticket_store = tickets.SessionTicketStore(args.max_tickets, args.ticket_ttl, args.session_tickets)
+    return server_config, scope, ticket_store
+
+# This function runs the server together with the metrics exporters that are enabled
+async def serve(args):
+    server_config, scope, ticket_store = server_setup(args)
+    await asyncio.gather(quic_engine.run_server(args.listen, args.port, server_config, scope, ticket_store=ticket_store), serve_metrics(args))
+
+# This function runs the metrics exporters that are enabled, for this process or for the workers in 'source'
+async def serve_metrics(args, source = metrics.metrics):
+    tasks = []
+    if args.metrics_port:
+        tasks.append(metrics.serve_metrics(args.listen, args.metrics_port, source))
+    if args.metrics_json:
+        tasks.append(metrics.dump_metrics_periodically(args.metrics_json, args.metrics_interval, source))
+    await asyncio.gather(*tasks)
+
+# This function runs the server of one worker process, and reports its metrics to the parent process
+async def serve_worker(args, router, reports):
+    configure_logging(LOG_LEVELS[args.log_level])
+    server_config, scope, ticket_store = server_setup(args)
+    reporter = asyncio.ensure_future(workers.report_metrics(reports, router.index))
+    try:
+        await quic_engine.run_server(args.listen, args.port, server_config, scope, router, ticket_store)
+    finally:
+        reporter.cancel()
+        await asyncio.gather(reporter, return_exceptions=True)
 
 def parse_args():
     parser = argparse.ArgumentParser(description='File Transfer over QUIC')
     subparsers = parser.add_subparsers(dest='mode', help='Mode to run the application in', required=True)
     
     client_parser = subparsers.add_parser('client')
+    client_parser.add_argument('operation', nargs='?', choices=ft_client.OPERATIONS, default=ft_client.OPERATION_PUT, help='Send files to the server (default), download them, list the stored files or show the size and modification time of stored files')
     client_parser.add_argument('-s','--server', default='localhost', help='Host to connect to')   
     client_parser.add_argument('-p','--port', type=int, default=4433, help='Port to connect to')
     client_parser.add_argument('-c','--cert-file', default='./certs/quic_certificate.pem', help='Certificate file (for self signed certs)')
 
-    # Include additional argument for the user to specify the file or its path, which is required to run the protocol
-    client_parser.add_argument('-f', '--filename', required=True, help='Path of the file to send')
+    # Include additional argument for the user to specify the files, directories or glob patterns to send, which is required to run the protocol
+    client_parser.add_argument('-f', '--filename', nargs='+', default=[], help='Paths of the files to send, directories are sent recursively, or names of the stored files to download, list (as path prefixes) or show')
+    client_parser.add_argument('--range', type=range_arg, help="Only download this byte range of the files, as 'OFFSET:LENGTH' or 'OFFSET:' for the rest of the file")
+    client_parser.add_argument('-o', '--output-dir', default='.', help='Directory to save downloaded files to')
+    client_parser.add_argument('--concurrency', type=int, default=ft_client.DEFAULT_CONCURRENCY, help='Number of files sent at the same time over the connection')
+    client_parser.add_argument('-w', '--wire-format', choices=WIRE_FORMATS.keys(), help='Only offer this PDU wire format (default: binary with JSON fallback)')
+    client_parser.add_argument('--streams', type=int, default=1, help='Number of QUIC streams to send byte ranges of the file over in parallel')
+    client_parser.add_argument('--resume', action='store_true', help='Only send the chunks the server does not have from an interrupted transfer')
+    client_parser.add_argument('--delta', action='store_true', help='Only send the content-defined chunks of the file that the server does not store yet. Chunking runs at about 8 MB/s, so it only pays off on slow links, use --executor process to keep it off the event loop')
+    client_parser.add_argument('--chunk-size', type=chunk_size_arg, default=ft_client.CHUNK_SIZE, help="Size of the file chunks in bytes, or 'auto' to grow them from 4 KB to 1 MB with the measured throughput and RTT")
+    client_parser.add_argument('--digest', choices=pdu.DIGESTS.keys(), default=pdu.DIGEST_SHA256, help='Digest of the chunk and file checksums, negotiated in the START PDU (requires the binary wire format)')
+    client_parser.add_argument('--compression', choices=[compression.COMPRESSION_NONE] + list(compression.CODECS), default=compression.COMPRESSION_NONE, help='Compress the chunks that shrink with this codec, negotiated in the START PDU (requires the binary wire format)')
+    client_parser.add_argument('--mmap', action='store_true', help='Read the file through mmap, chunks are only copied into the send buffer of the QUIC stream')
+    client_parser.add_argument('--window', type=int, default=quic_engine.DEFAULT_SEND_WINDOW, help='Maximum number of bytes in flight before the client waits for acknowledgements')
+    client_parser.add_argument('--receive-queue', type=int, default=quic_engine.DEFAULT_RECEIVE_QUEUE_SIZE, help='Maximum number of received bytes queued on a stream before the server is asked to wait')
+    client_parser.add_argument('--executor', choices=executor.EXECUTOR_KINDS, default=executor.EXECUTOR_THREAD, help='Run hashing and chunking in worker threads or worker processes')
+    client_parser.add_argument('--executor-workers', type=int, help='Number of worker threads or processes (default: based on the number of CPUs)')
+    client_parser.add_argument('--log-level', choices=LOG_LEVELS.keys(), default='info', help="Messages to show, 'debug' shows every chunk")
+    client_parser.add_argument('--metrics-json', help='File to write the transfer metrics to as JSON when the client exits')
+    client_parser.add_argument('--qlog-dir', help='Directory to write a qlog trace of the connection to')
+    client_parser.add_argument('--session-tickets', help='File to keep TLS session tickets in, so the next connection resumes the session and sends its first PDUs as 0-RTT data')
 
     server_parser = subparsers.add_parser('server')
     server_parser.add_argument('-c','--cert-file', default='./certs/quic_certificate.pem', help='Certificate file (for self signed certs)')
     server_parser.add_argument('-k','--key-file', default='./certs/quic_private_key.pem', help='Key file (for self signed certs)')
     server_parser.add_argument('-l','--listen', default='localhost', help='Address to listen on')
     server_parser.add_argument('-p','--port', type=int, default=4433, help='Port to listen on')
+    server_parser.add_argument('-w', '--wire-format', choices=WIRE_FORMATS.keys(), help='Only accept this PDU wire format (default: binary with JSON fallback)')
+    server_parser.add_argument('--fsync', choices=storage.FSYNC_POLICIES, default=storage.FSYNC_NEVER, help='When received files are flushed to disk with fsync')
+    server_parser.add_argument('--max-file-size', type=int, default=ft_server.DEFAULT_MAX_FILE_SIZE, help='Largest file in bytes a client can send, larger announced sizes are refused before any space is reserved')
+    server_parser.add_argument('--receive-queue', type=int, default=quic_engine.DEFAULT_RECEIVE_QUEUE_SIZE, help='Maximum number of received bytes queued on a stream before the client is asked to wait')
+    server_parser.add_argument('--executor', choices=executor.EXECUTOR_KINDS, default=executor.EXECUTOR_THREAD, help='Run hashing in worker threads or worker processes')
+    server_parser.add_argument('--executor-workers', type=int, help='Number of worker threads or processes (default: based on the number of CPUs)')
+    server_parser.add_argument('--log-level', choices=LOG_LEVELS.keys(), default='info', help="Messages to show, 'debug' shows every chunk")
+    server_parser.add_argument('--metrics-port', type=int, help='Serve the metrics in the Prometheus text format over HTTP on this port')
+    server_parser.add_argument('--metrics-json', help='File to write the metrics to as JSON periodically')
+    server_parser.add_argument('--metrics-interval', type=float, default=metrics.DEFAULT_DUMP_INTERVAL, help='Seconds between two JSON metrics dumps')
+    server_parser.add_argument('--qlog-dir', help='Directory to write a qlog trace of every connection to')
+    server_parser.add_argument('--workers', type=int, default=1, help='Number of server processes sharing the port, 0 for one per CPU')
+    server_parser.add_argument('--session-tickets', help='Directory to keep the issued TLS session tickets in, so they survive restarts and are shared by the workers (default: in memory)')
+    server_parser.add_argument('--ticket-ttl', type=float, help='Seconds a session ticket can be used for resumption (default: its 24 hour lifetime)')
+    server_parser.add_argument('--max-tickets', type=int, default=tickets.DEFAULT_MAX_TICKETS, help='Number of session tickets kept, the oldest ones are dropped first')
        
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.mode == 'client' and not args.filename and args.operation != ft_client.OPERATION_LIST:
+        client_parser.error("the following arguments are required: -f/--filename")
+    return args
 
 
 if __name__ == '__main__':
     args = parse_args()
+    configure_logging(LOG_LEVELS[args.log_level])
     if args.mode == 'client':
         client_mode(args)
     elif args.mode == 'server':
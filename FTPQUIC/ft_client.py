@@ -2,60 +2,928 @@ from typing import Dict
 from ft_quic import FTQuicConnection, QuicStreamEvent
 import pdu
 import asyncio
-import hashlib # library used for checksum using SHA-256 hashing
-import base64 # library used for encoding/decoding file chunks during transfer
-from utils import calculate_checksum
-
-# This function represents file transfer from the client side
-async def ft_client_proto(scope:Dict, conn:FTQuicConnection, filename: str):
-    print("[cli] Starting File Transfer...")
-    new_stream_id = conn.new_stream()
-
-    # Send the START PDU of the file message to the server
-    START_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_START, filename, filename=filename)
-    START_quic_stream = QuicStreamEvent(new_stream_id, START_datagram.to_framed_bytes(), False)
-    await conn.send(START_quic_stream)
-    print(f"[cli] Sent START of file: {filename}")
-
-    # Begin reading the contents of the file and send file data in chunks
+import contextlib
+import json
+import mmap
+import os
+import secrets
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+import logging
+from utils import encode_file_chunk, read_reply, read_chunk_block, read_range, FrameReassembler
+from chunking import chunk_file
+from compression import ChunkCompressor, COMPRESSION_NONE
+from storage import FileSink, close_mapping, safe_relative_path, WRITE_BATCH_SIZE
+from executor import get_offloader
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 4096 # Read file contents in 4KB chunks by default
+READ_BLOCK_SIZE = 1024 * 1024 # number of bytes read and hashed by a worker thread at a time
+DEFAULT_CONCURRENCY = 8 # number of files sent at the same time by a batch
+RECEIVE_WINDOW_CHUNKS = 4 # number of chunks the server can send before waiting for a window update, for downloads
+RETRANSMIT_WINDOW_SIZE = 1024 * 1024 # bytes of the most recent DATA PDUs kept to send them again without reading the file
+ACK_IDLE_TIMEOUT = 5.0 # seconds after the END PDU without a NACK PDU or a chunk sent again before the ACK is given up on
+
+# Operations of the client: send files to the server (default), download them, list the stored files or show one of them
+OPERATION_PUT = "put"
+OPERATION_GET = "get"
+OPERATION_LIST = "list"
+OPERATION_STAT = "stat"
+OPERATIONS = (OPERATION_PUT, OPERATION_GET, OPERATION_LIST, OPERATION_STAT)
+
+# Status of a sent file in a TransferResult
+TRANSFER_VERIFIED = "verified"
+TRANSFER_FAILED = "failed"
+TRANSFER_ERROR = "error"
+
+# Adaptive chunk sizes grow from the minimum to the maximum size with the measured throughput and RTT
+CHUNK_SIZE_AUTO = "auto"
+MIN_CHUNK_SIZE = 4 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+MEASURE_INTERVAL = 0.05 # seconds of sending over which the throughput is measured
+TARGET_CHUNK_TIME = 0.005 # a chunk should take at least this long to send, so the per PDU overhead stays small
+CHUNKS_PER_RTT = 4 # and at most a quarter of the round trip time, so several chunks are in flight
+
+"""
+This class picks the size of the next chunks of a transfer from the measured throughput and RTT
+A chunk should take about TARGET_CHUNK_TIME to send, or a quarter of the RTT on slower links, so fast transfers
+send few large PDUs and slow ones keep small chunks. The size is a power of two that at most doubles or
+halves once per measurement interval, so the read blocks of the file always end on a chunk boundary.
+"""
+class AdaptiveChunkSize:
+    def __init__(self, rtt = None, minimum = MIN_CHUNK_SIZE, maximum = MAX_CHUNK_SIZE):
+        self.size = minimum
+        self.minimum = minimum
+        self.maximum = maximum
+        self._rtt = rtt # returns the smoothed RTT of the connection in seconds
+        self._started = time.perf_counter()
+        self._sent = 0
+
+    # This function records the bytes of a sent chunk and adjusts the chunk size after every interval
+    def sent(self, size):
+        self._sent += size
+        elapsed = time.perf_counter() - self._started
+        if elapsed < MEASURE_INTERVAL:
+            return
+        throughput = self._sent / elapsed
+        rtt = self._rtt() if self._rtt is not None else 0.0
+        target = throughput * max(TARGET_CHUNK_TIME, rtt / CHUNKS_PER_RTT)
+        previous = self.size
+        if target >= self.size * 2:
+            self.size = min(self.size * 2, self.maximum)
+        elif target < self.size // 2:
+            self.size = max(self.size // 2, self.minimum)
+        if self.size != previous:
+            logger.info(f"[cli] Chunk Size Changed to {self.size} bytes, Throughput: {throughput / 1e6:.2f} MB/s, RTT: {rtt * 1000:.2f} ms")
+        self._started = time.perf_counter()
+        self._sent = 0
+
+# This function runs the operation of the client given in the scope, on every file of 'filenames'
+# Listing and showing files return the name, size and modification time of the files, other operations the results of ft_client_batch
+async def ft_client_run(scope:Dict, conn:FTQuicConnection, filenames):
+    operation = scope.get("operation", OPERATION_PUT)
+    if operation in (OPERATION_LIST, OPERATION_STAT):
+        wire_format = scope.get("wire_format", pdu.WIRE_FORMAT_JSON)
+        if wire_format != pdu.WIRE_FORMAT_BINARY:
+            logger.warning("[cli] Listing and showing files need the binary wire format")
+            return []
+        if operation == OPERATION_LIST:
+            return await list_files(conn, wire_format, filenames or [""])
+        return await stat_files(conn, wire_format, filenames)
+    return await ft_client_batch(scope, conn, filenames)
+
+# This function returns the path a downloaded file is saved to, below the 'output_dir' of the scope
+def download_path(scope:Dict, filename: str):
+    return os.path.join(scope.get("output_dir", "."), safe_relative_path(filename))
+
+"""
+This function sends or downloads a batch of files over one connection, up to 'concurrency' files at a time
+Every file is sent by ft_client_proto, or downloaded by ft_client_get, on its own stream, and a summary is
+printed for batches of several files
+Returns a list with the filename, size, duration in seconds and success of every transfer
+"""
+async def ft_client_batch(scope:Dict, conn:FTQuicConnection, filenames):
+    concurrency = max(1, scope.get("concurrency", DEFAULT_CONCURRENCY))
+    download = scope.get("operation") == OPERATION_GET
+    transfer = ft_client_get if download else ft_client_proto
+    if not filenames:
+        logger.info("[cli] No Files to Send")
+    pending = iter(filenames) # shared by the senders, each takes the next file when it is done
+    results = []
+
+    async def sender():
+        for filename in pending:
+            started = time.perf_counter()
+            successful = await transfer(scope, conn, filename)
+            size = os.path.getsize(download_path(scope, filename) if download else filename) if successful else 0
+            results.append({"filename": filename, "size": size, 
+                            "seconds": time.perf_counter() - started, "successful": successful})
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender() for _ in range(min(concurrency, len(filenames)))))
+    elapsed = time.perf_counter() - started
+
+    if len(filenames) > 1:
+        successful = [result for result in results if result["successful"]]
+        megabytes = sum(result["size"] for result in successful) / 1e6
+        logger.info(f"[cli] {'Received' if download else 'Sent'} {len(successful)}/{len(filenames)} Files, {megabytes:.2f} MB in {elapsed:.2f} s: "
+              f"{len(successful) / elapsed:.1f} files/s, {megabytes / elapsed:.2f} MB/s")
+    return results
+
+"""
+This class is the result of one file sent with ft_client_proto, as returned by the library API
+'status' is TRANSFER_VERIFIED when the server verified the checksum of the file, TRANSFER_FAILED when it did not,
+and TRANSFER_ERROR when the file could not be sent, with the reason in 'error'.
+'digest' is the checksum of the whole file, computed with the 'digest_name' algorithm while it was sent.
+"""
+class TransferResult:
+    def __init__(self, filename):
+        self.filename = filename
+        self.status = TRANSFER_FAILED
+        self.error = None
+        self.size = 0
+        self.digest = None
+        self.digest_name = pdu.DIGEST_SHA256
+        self.connect_seconds = 0.0 # time spent waiting for a connection, by the library API
+        self.transfer_seconds = 0.0
+
+    @property
+    def successful(self):
+        return self.status == TRANSFER_VERIFIED
+
+    @property
+    def seconds(self):
+        return self.connect_seconds + self.transfer_seconds
+
+    # Records the size and the overall checksum of the sent file
+    def record(self, size, digest, digest_name):
+        self.size = size
+        self.digest = digest
+        self.digest_name = digest_name
+
+    def to_dict(self):
+        return {"filename": self.filename, "status": self.status, "error": self.error, "size": self.size,
+                "digest": self.digest, "digest_name": self.digest_name, "connect_seconds": self.connect_seconds,
+                "transfer_seconds": self.transfer_seconds, "seconds": self.seconds}
+
+"""
+This function represents file transfer from the client side, and returns True if the server verified the file
+With 'data', a bytes-like object or an async iterable of bytes-like pieces is sent under 'filename' instead of a file.
+Iterables are sent over one stream as they are produced, without the options that need the size of the file first.
+With 'path', the file is read from 'path' and stored under 'filename' by the server.
+The outcome is also recorded in 'result', a TransferResult, when it is given
+"""
+async def ft_client_proto(scope:Dict, conn:FTQuicConnection, filename: str, data = None, result = None, path = None):
+    logger.info("[cli] Starting File Transfer...")
+    wire_format = scope.get("wire_format", pdu.WIRE_FORMAT_JSON) # negotiated through the ALPN of the connection
+    streams = scope.get("streams", 1)
+    resume = scope.get("resume", False)
+    delta = scope.get("delta", False)
+    digest = scope.get("digest", pdu.DIGEST_SHA256)
+    use_mmap = scope.get("mmap", False)
+    chunk_size = scope.get("chunk_size", CHUNK_SIZE)
+    compression = scope.get("compression", COMPRESSION_NONE)
+    iterable = data is not None and hasattr(data, "__aiter__")
+    successful = False
+    error = None
+    started = time.perf_counter()
+
     try:
+        if data is None:
+            os.stat(path or filename) # a missing file is reported before a stream is opened
+        if data is not None and delta:
+            logger.info("[cli] Delta transfers read the file twice, sending the data over one stream")
+            delta = False
+        if iterable and (streams > 1 or resume):
+            logger.info("[cli] Parallel streams and resumable transfers need the size of the file first, sending the data over one stream")
+            streams, resume = 1, False
+        if compression != COMPRESSION_NONE and (wire_format != pdu.WIRE_FORMAT_BINARY or delta):
+            logger.info("[cli] Compression needs the binary wire format and is not used by delta transfers, sending chunks uncompressed")
+            compression = COMPRESSION_NONE
+        if (streams > 1 or resume or delta) and wire_format != pdu.WIRE_FORMAT_BINARY:
+            logger.info("[cli] Parallel streams, resumable and delta transfers need the binary wire format, sending the whole file over one stream")
+            streams, resume, delta = 1, False, False
+        if (streams > 1 or resume) and delta:
+            logger.info("[cli] Delta transfers use one stream and cannot be resumed")
+            streams, resume = 1, False
+        if streams > 1 and resume:
+            logger.info("[cli] Resumable transfers use one stream")
+            streams = 1
+        if resume and chunk_size == CHUNK_SIZE_AUTO:
+            logger.info(f"[cli] Resumable transfers use a fixed chunk size of {CHUNK_SIZE} bytes")
+            chunk_size = CHUNK_SIZE
+        if digest != pdu.DIGEST_SHA256 and (wire_format != pdu.WIRE_FORMAT_BINARY or delta):
+            logger.info("[cli] Other digests than SHA-256 need the binary wire format and cannot be used by delta transfers, using SHA-256")
+            digest = pdu.DIGEST_SHA256
+        offloader = get_offloader(scope)
+        if iterable:
+            successful = await send_iterable_stream(conn.open_stream(), wire_format, filename, data, offloader=offloader,
+                                                    digest=digest, chunk_size=chunk_size, compression=compression, result=result)
+        elif delta:
+            successful = await send_file_delta(conn.open_stream(), wire_format, filename, offloader, result=result, path=path)
+        elif streams > 1:
+            successful = await send_file_parallel(conn, wire_format, filename, streams, offloader, digest, use_mmap, chunk_size, compression,
+                                                  data=data, result=result, path=path)
+        else:
+            successful = await send_file_stream(conn.open_stream(), wire_format, filename, resume=resume, offloader=offloader,
+                                                digest=digest, use_mmap=use_mmap, chunk_size=chunk_size, compression=compression,
+                                                data=data, result=result, path=path)
+    # Error messages sent to server if file transfer fails
+    except FileNotFoundError:
+        logger.error(f"[cli] Error: {path or filename} not found!")
+        error = f"{path or filename} not found"
+    except Exception as e:
+        logger.error(f"[cli] File Transfer Failed! {e!r}")
+        error = repr(e)
+    
+    if result is not None:
+        result.status = TRANSFER_VERIFIED if successful else TRANSFER_ERROR if error is not None else TRANSFER_FAILED
+        result.error = error
+        result.transfer_seconds = time.perf_counter() - started
+    logger.info("[cli] Ending File Transfer...")
+    return successful
+
+# This function splits a file into at most 'streams' byte ranges that start on a chunk boundary
+def split_ranges(file_size, streams, chunk_size = CHUNK_SIZE):
+    chunks = -(-file_size // chunk_size) # round up
+    range_size = max(1, -(-chunks // streams)) * chunk_size
+    return [(offset, min(range_size, file_size - offset)) for offset in range(0, file_size, range_size)] or [(0, 0)]
+
+# This function sends the byte ranges of a file, or of a bytes-like 'data', concurrently, each over its own stream
+# Every range is verified with its own checksum, so only the size is recorded in 'result'
+async def send_file_parallel(conn:FTQuicConnection, wire_format, filename: str, streams: int, offloader = None,
+                             digest = pdu.DIGEST_SHA256, use_mmap = False, chunk_size = CHUNK_SIZE, compression = COMPRESSION_NONE,
+                             data = None, result = None, path = None):
+    file_size = os.path.getsize(path or filename) if data is None else memoryview(data).nbytes
+    if result is not None:
+        result.record(file_size, None, digest)
+    ranges = split_ranges(file_size, streams, MIN_CHUNK_SIZE if chunk_size == CHUNK_SIZE_AUTO else chunk_size)
+    transfer_id = secrets.token_hex(8) # lets the server put the ranges back together
+    logger.info(f"[cli] Sending {filename} in {len(ranges)} Ranges Over Parallel Streams, Transfer ID: {transfer_id}")
+
+    senders = []
+    for offset, length in ranges:
+        options = {"transfer_id": transfer_id, "offset": offset, "length": length, 
+                   "size": file_size, "ranges": len(ranges)}
+        senders.append(send_file_stream(conn.open_stream(), wire_format, filename, offset, length, options, 
+                                        offloader=offloader, digest=digest, use_mmap=use_mmap, chunk_size=chunk_size,
+                                        compression=compression, data=data, path=path))
+    results = await asyncio.gather(*senders)
+
+    if all(results):
+        logger.info(f"[cli] All {len(ranges)} Ranges of {filename} Verified by the Server")
+    else:
+        logger.warning(f"[cli] {results.count(False)} of {len(ranges)} Ranges of {filename} Failed")
+    return all(results)
+
+# This function asks the server which chunks of a file it already has, and returns their sequence numbers
+async def query_received_chunks(stream:FTQuicConnection, wire_format, filename: str, reassembler: FrameReassembler, options):
+    QUERY_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_QUERY, filename, filename=filename, options=options)
+    await stream.send(QuicStreamEvent(stream.stream_id, QUERY_datagram.to_framed_bytes(wire_format), False))
+    MANIFEST_datagram = await asyncio.wait_for(reassembler.read(), timeout=5) # Timeout after 5 seconds
+    if MANIFEST_datagram is not None and MANIFEST_datagram.mtype == pdu.MSG_TYPE_FILE_ACK:
+        raise ValueError(MANIFEST_datagram.msg) # the server cannot resume the transfer
+    if MANIFEST_datagram is None or MANIFEST_datagram.mtype != pdu.MSG_TYPE_FILE_MANIFEST:
+        raise ValueError("Expected File MANIFEST")
+    received = set()
+    for first, stop in json.loads(MANIFEST_datagram.msg)["received"]:
+        received.update(range(first, stop))
+    logger.info(f"[cli] Server Already Has {len(received)} Chunks of {filename}, Sending the Missing Chunks")
+    return received
+
+# This function reads byte ranges of a file given as (offset, length) pairs, it runs in a worker thread
+def read_ranges(fd, ranges):
+    return [os.pread(fd, length, offset) for offset, length in ranges]
+
+# This function returns the size of a framed PDU, a list of buffers when it was framed with Datagram.to_framed_parts()
+def framed_size(framed):
+    if isinstance(framed, list):
+        return sum(len(part) for part in framed)
+    return len(framed)
+
+"""
+This class sends the chunks the server asks for again with NACK PDUs, when the START PDU has the 'nack' option
+The DATA PDUs of the most recent chunks are kept in a bounded window, older chunks are read from the file again
+by their offset, which is found from the blocks of the file that were read. 'source' is the file descriptor of the file,
+or a memoryview of the data that is sent. The END PDU is sent without ending the
+stream, so the chunks the server asks for after it can still be sent until the server replies with its ACK.
+The wait for the ACK restarts with every NACK PDU and every chunk sent again, so a long resend does not time out.
+"""
+class RetransmitWindow:
+    def __init__(self, stream:FTQuicConnection, wire_format, filename, source, jobs, digest, stats, max_size = RETRANSMIT_WINDOW_SIZE):
+        self.stream = stream
+        self.wire_format = wire_format
+        self.filename = filename
+        self.source = source
+        self.jobs = jobs
+        self.digest = digest
+        self.stats = stats
+        self.max_size = max_size
+        self.sent = OrderedDict() # framed DATA PDUs of the most recent chunks, by sequence number
+        self.size = 0 # bytes of the kept DATA PDUs
+        self.first_sequences = [] # sequence number of the first chunk of every block
+        self.blocks = [] # offset, length and chunk size of every block, the chunk size only changes between blocks
+        self.chunk_count = 0 # chunks in the blocks read so far
+        self.active_at = time.monotonic() # last time a NACK PDU was received or a chunk was sent again
+
+    # Records a block of 'chunk_count' chunks of the file that was read
+    def add_block(self, offset, length, chunk_size, chunk_count):
+        self.first_sequences.append(self.chunk_count)
+        self.blocks.append((offset, length, chunk_size))
+        self.chunk_count += chunk_count
+
+    # Keeps the DATA PDU of a chunk that was sent
+    def add(self, sequence, framed):
+        self.sent[sequence] = framed
+        self.size += framed_size(framed)
+        while self.size > self.max_size:
+            _, dropped = self.sent.popitem(last=False)
+            self.size -= framed_size(dropped)
+
+    # Returns the offset and length of a chunk in the file
+    def chunk_range(self, sequence):
+        index = bisect_right(self.first_sequences, sequence) - 1
+        offset, length, chunk_size = self.blocks[index]
+        chunk_offset = offset + (sequence - self.first_sequences[index]) * chunk_size
+        return chunk_offset, min(chunk_size, offset + length - chunk_offset)
+
+    # Drops the kept DATA PDUs of the chunks the server received in order
+    def acknowledge(self, next_sequence):
+        while self.sent and next(iter(self.sent)) < next_sequence:
+            _, acknowledged = self.sent.popitem(last=False)
+            self.size -= framed_size(acknowledged)
+
+    # Sends the chunks of (first sequence, count) ranges again
+    async def resend(self, ranges):
+        stream_id = self.stream.stream_id
+        for first, count in ranges:
+            for sequence in range(first, min(first + count, self.chunk_count)):
+                framed = self.sent.get(sequence)
+                if framed is None:
+                    offset, length = self.chunk_range(sequence)
+                    file_chunk = await self.jobs.run_io(read_range, self.source, offset, length)
+                    chunk_checksum = await self.jobs.hexdigest(file_chunk, self.digest, role="client")
+                    DATA_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_DATA, file_chunk, filename=self.filename, checksum=chunk_checksum, sequence=sequence)
+                    framed = DATA_datagram.to_framed_bytes(self.wire_format)
+                await self.stream.send(QuicStreamEvent(stream_id, framed, False))
+                self.stats.retransmitted_chunks += 1
+                self.active_at = time.monotonic()
+
+    # Reads the replies of the server while the file is sent, answers its NACK PDUs and returns its ACK
+    async def read_replies(self, reassembler: FrameReassembler):
+        while True:
+            datagram = await reassembler.read()
+            if datagram is None or datagram.mtype != pdu.MSG_TYPE_FILE_NACK:
+                return datagram
+            self.active_at = time.monotonic()
+            ranges = pdu.unpack_sequence_ranges(datagram.msg)
+            logger.info(f"[cli] Server Asked for {sum(count for _, count in ranges)} Chunks of {self.filename} Again")
+            self.acknowledge(datagram.sequence)
+            await self.resend(ranges)
+
+    # Waits for the ACK that 'replies' returns, raises asyncio.TimeoutError after 'timeout' seconds without any activity
+    async def wait_for_ack(self, replies, timeout = ACK_IDLE_TIMEOUT):
+        while True:
+            done, _ = await asyncio.wait([replies], timeout=max(0.0, self.active_at + timeout - time.monotonic()))
+            if done:
+                return replies.result()
+            if time.monotonic() - self.active_at >= timeout:
+                raise asyncio.TimeoutError()
+
+"""
+This function sends a file, or the byte range of a file given in 'options', over one stream
+With 'resume', only the chunks the server does not have yet are sent
+The file is read and hashed in blocks by a worker thread, the next block is read while the current one is sent.
+The checksum of the file is updated with every block, so the file is only read once.
+With 'use_mmap', the file is memory mapped and the DATA PDUs of the binary wire format are sent as their header and a slice
+of the mapping, so the only copy of a chunk is made by the QUIC stream. The mapping is closed once the transfer is over and
+the block read ahead, the kept DATA PDUs and the chunk being sent again were released, slices of it are left until then.
+'chunk_size' is a number of bytes, or CHUNK_SIZE_AUTO to adapt it to the connection, and is announced in the START PDU
+With a 'compression' codec, announced in the START PDU, the worker thread also compresses the chunks that shrink
+With 'data', a bytes-like object is sent under 'filename' instead of the file, and chunks are slices of it
+With 'path', the file is read from 'path' and sent under 'filename'
+The overall checksum and size are recorded in 'result', a TransferResult, when it is given
+Returns True if the server acknowledged a successful checksum verification
+"""
+async def send_file_stream(stream:FTQuicConnection, wire_format, filename: str, offset = 0, length = None, options = None, resume = False, 
+                           offloader = None, digest = pdu.DIGEST_SHA256, use_mmap = False, chunk_size = CHUNK_SIZE,
+                           compression = COMPRESSION_NONE, data = None, result = None, path = None):
+    stream_id = stream.stream_id
+    reassembler = FrameReassembler(stream, role="client")
+    offloader = offloader or get_offloader({})
+    jobs = offloader.queue() # bounds the blocks of this file that are read ahead
+    stats = metrics.open_stream(stream.connection_id, stream_id, "client")
+    stats.filename = filename
+    successful = False
+    debug = logger.isEnabledFor(logging.DEBUG) # per chunk messages are only formatted when they are shown
+
+    replies = None # reads the NACK PDUs and the ACK of the server while the file is sent
+    mapping = None # the memory mapped file, with 'use_mmap'
+    next_block = None # the block that is read ahead by a worker thread
+    try:
+        # Open the file before the START PDU, so a missing file does not leave an unfinished stream on the server
+        if data is not None:
+            data = memoryview(data).cast("B")
+        with open(path or filename, "rb") if data is None else contextlib.nullcontext() as f:
+            file_size = os.fstat(f.fileno()).st_size if data is None else len(data)
+            if digest != pdu.DIGEST_SHA256:
+                options = dict(options or {}, digest=digest) # SHA-256 is used when the START PDU has no digest
+            compressor = None
+            if compression != COMPRESSION_NONE:
+                compressor = ChunkCompressor(compression)
+                options = dict(options or {}, compression=compression)
+            adaptive = None
+            if chunk_size == CHUNK_SIZE_AUTO:
+                adaptive = AdaptiveChunkSize(stream.rtt)
+                chunk_size = adaptive.size
+            # Only the binary wire format has options, servers of the JSON format accept chunks of any size
+            window = None
+            if wire_format == pdu.WIRE_FORMAT_BINARY:
+                options = dict(options or {}, chunk_size=chunk_size, nack=True)
+                if adaptive is not None:
+                    options["max_chunk_size"] = adaptive.maximum # lets the server size its buffers
+                window = RetransmitWindow(stream, wire_format, filename, f.fileno() if data is None else data, jobs, digest, stats)
+            received = set() # chunks to skip when resuming a transfer
+            if resume:
+                options = dict(options or {}, resume=True, size=file_size)
+                received = await query_received_chunks(stream, wire_format, filename, reassembler, options)
+
+            # Send the START PDU of the file message to the server
+            START_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_START, filename, filename=filename, options=options)
+            START_quic_stream = QuicStreamEvent(stream_id, START_datagram.to_framed_bytes(wire_format), False)
+            await stream.send(START_quic_stream)
+            logger.info(f"[cli] Sent START of file: {filename}")
+            if window is not None:
+                replies = asyncio.ensure_future(window.read_replies(reassembler))
+
+            source = f.fileno() if data is None else data
+            if use_mmap and data is None and file_size > 0: # empty files cannot be mapped
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                source = memoryview(mapping)
+            # Begin reading the contents of the file and send file data in chunks
+            sequence_number = 0
+            file_hash = pdu.new_digest(digest) # checksum of the file, or of the range
+            end = file_size if length is None else offset + length
+            # Blocks end on chunk boundaries, adaptive chunk sizes are powers of two up to the block size
+            block_size = max(1, READ_BLOCK_SIZE // chunk_size) * chunk_size if adaptive is None else READ_BLOCK_SIZE
+            block_offsets = range(offset, end, block_size)
+            def read_block(index):
+                block_offset = block_offsets[index]
+                block_chunk_size = chunk_size if adaptive is None else adaptive.size
+                return jobs.submit_io(read_chunk_block, source, block_offset, min(block_size, end - block_offset), block_chunk_size,
+                                      file_hash, digest, "client", compressor)
+
+            next_block = await read_block(0) if block_offsets else None
+            for index in range(len(block_offsets)):
+                chunks = await next_block
+                if window is not None and chunks:
+                    window.add_block(block_offsets[index], min(block_size, end - block_offsets[index]), len(chunks[0][0]), len(chunks))
+                # Read the next block while this one is sent, blocks are read one after the other so the hash stays in order
+                if index + 1 < len(block_offsets):
+                    next_block = await read_block(index + 1)
+                for file_chunk, chunk_checksum, compressed_chunk in chunks:
+                    if sequence_number in received:
+                        sequence_number += 1
+                        continue
+                    if compressed_chunk is not None:
+                        encoded_chunk = compressed_chunk
+                        stats.saved_bytes += len(file_chunk) - len(compressed_chunk)
+                    else:
+                        encoded_chunk = encode_file_chunk(file_chunk, wire_format) # raw bytes, or Base64 for the JSON wire format
+                    DATA_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_DATA, encoded_chunk, filename=filename, checksum=chunk_checksum, sequence=sequence_number,
+                                                 compressed=compressed_chunk is not None)
+                    if mapping is not None:
+                        framed = DATA_datagram.to_framed_parts(wire_format) # the chunk is a slice of the mapping, it is not copied
+                    else:
+                        framed = DATA_datagram.to_framed_bytes(wire_format)
+                    DATA_quic_stream = QuicStreamEvent(stream_id, framed, False)
+                    if window is not None:
+                        window.add(sequence_number, DATA_quic_stream.data) # kept to be sent again
+                    await stream.send(DATA_quic_stream) # waits while too much data is in flight
+                    stats.bytes += len(file_chunk)
+                    stats.chunks += 1
+                    if debug:
+                        logger.debug(f"[cli] Sent File Data Chunk of Size: {len(file_chunk)}, Checksum: {chunk_checksum[:8]}, Seq #: {sequence_number}")
+                    sequence_number += 1
+                    if adaptive is not None:
+                        adaptive.sent(len(file_chunk))
+
+            # Send END PDU of the file with the overall checksum, computed while the file was read
+            # With selective retransmit, its sequence is the number of chunks and the stream stays open for the chunks sent again
+            overall_checksum = file_hash.hexdigest()
+            if result is not None:
+                result.record(end - offset, overall_checksum, digest)
+            END_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_END, "Ending File Transmission", filename=filename, checksum=overall_checksum,
+                                        sequence=sequence_number if window is not None else 0)
+            END_quic_steam = QuicStreamEvent(stream_id, END_datagram.to_framed_bytes(wire_format), window is None) # End QUIC stream
+            await stream.send(END_quic_steam)
+            logger.info(f"[cli] Sent END of File With Overall Checksum: {overall_checksum[:8]}")
+            if compressor is not None:
+                logger.info(f"[cli] Compressed Chunks With {compression}: {stats.bytes - stats.saved_bytes} of {stats.bytes} bytes Sent")
+
+            if replies is None:
+                successful = await receive_ack(stream, wire_format, reassembler)
+                return successful
+            # The file stays open until the ACK, to read the chunks the server asks for again
+            try:
+                ACK_datagram = await window.wait_for_ack(replies)
+            except asyncio.TimeoutError:
+                # The handler of the server waits for the chunks it asked for until the stream ends, so the stream is ended
+                logger.warning(f"[cli] No ACK for {filename} Within {ACK_IDLE_TIMEOUT:.0f} Seconds After the Last Reply")
+                with contextlib.suppress(Exception): # the connection may be closed
+                    await stream.send(QuicStreamEvent(stream_id, b"", True))
+                stream.close()
+                return False
+            await stream.send(QuicStreamEvent(stream_id, b"", True)) # End QUIC stream
+            stream.close()
+            successful = check_ack(ACK_datagram)
+            return successful
+    except Exception:
+        await abort_stream(stream)
+        raise
+    finally:
+        if replies is not None:
+            replies.cancel()
+        if mapping is not None:
+            # The mapping can only be closed once no slice of it is left, the block read ahead may still be hashed by a worker
+            # thread and the replies task may still send a chunk again
+            pending = [task for task in (next_block, replies) if task is not None]
+            if pending:
+                await asyncio.wait(pending)
+            chunks = file_chunk = encoded_chunk = framed = DATA_datagram = DATA_quic_stream = None
+            next_block = replies = pending = window = None
+            close_mapping(mapping, source)
+        metrics.finish_stream(stats, successful)
+
+# This function joins the pieces of an async iterable into blocks of 'block_size' bytes, the last block can be shorter
+# Every byte is copied once, into a new block, so a block handed to a worker thread is never changed
+async def read_iterable_blocks(pieces, block_size):
+    block = bytearray()
+    async for piece in pieces:
+        piece = memoryview(piece).cast("B")
+        position = 0
+        while len(block) + len(piece) - position >= block_size:
+            taken = block_size - len(block)
+            block += piece[position:position + taken]
+            position += taken
+            yield block
+            block = bytearray()
+        block += piece[position:]
+    if block:
+        yield block
+
+"""
+This function sends the pieces of an async iterable of bytes-like objects as a file, over one stream
+The data is sent as it is produced, without staging it to disk, so its size is only known at the end.
+Pieces are joined into blocks, a worker thread hashes and splits every block into chunks, and the next block is
+hashed while the current one is sent. The blocks are not kept, so chunks are not sent again with NACK PDUs.
+The overall checksum and size are recorded in 'result', a TransferResult, when it is given
+Returns True if the server acknowledged a successful checksum verification
+"""
+async def send_iterable_stream(stream:FTQuicConnection, wire_format, filename: str, pieces, offloader = None,
+                               digest = pdu.DIGEST_SHA256, chunk_size = CHUNK_SIZE, compression = COMPRESSION_NONE, result = None):
+    stream_id = stream.stream_id
+    reassembler = FrameReassembler(stream, role="client")
+    offloader = offloader or get_offloader({})
+    jobs = offloader.queue()
+    stats = metrics.open_stream(stream.connection_id, stream_id, "client")
+    stats.filename = filename
+    successful = False
+    debug = logger.isEnabledFor(logging.DEBUG)
+
+    try:
+        options = None
+        if digest != pdu.DIGEST_SHA256:
+            options = {"digest": digest}
+        compressor = None
+        if compression != COMPRESSION_NONE:
+            compressor = ChunkCompressor(compression)
+            options = dict(options or {}, compression=compression)
+        adaptive = None
+        if chunk_size == CHUNK_SIZE_AUTO:
+            adaptive = AdaptiveChunkSize(stream.rtt)
+            chunk_size = adaptive.size
+        if wire_format == pdu.WIRE_FORMAT_BINARY:
+            options = dict(options or {}, chunk_size=chunk_size)
+            if adaptive is not None:
+                options["max_chunk_size"] = adaptive.maximum
+
+        # The first block is produced before the START PDU, so an iterable that fails at once leaves no stream on the server
+        block_size = max(1, READ_BLOCK_SIZE // chunk_size) * chunk_size if adaptive is None else READ_BLOCK_SIZE
+        blocks = read_iterable_blocks(pieces, block_size)
+        file_hash = pdu.new_digest(digest)
+        def read_block(block):
+            block_chunk_size = chunk_size if adaptive is None else adaptive.size
+            return jobs.submit_io(read_chunk_block, memoryview(block), 0, len(block), block_chunk_size, file_hash, digest, "client", compressor)
+        block = await anext(blocks, None)
+
+        START_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_START, filename, filename=filename, options=options)
+        await stream.send(QuicStreamEvent(stream_id, START_datagram.to_framed_bytes(wire_format), False))
+        logger.info(f"[cli] Sent START of file: {filename}")
+
         sequence_number = 0
-        with open(filename, "rb") as f:
-            while True:
-                file_chunk = f.read(4096) # Read file contents in 4KB chunks
-                if not file_chunk:
-                    break
-                encoded_chunk_str = base64.b64encode(file_chunk).decode("ascii") # convert binary bytes to ASCII using Base64
-                chunk_checksum = hashlib.sha256(file_chunk).hexdigest() # get checksum value in hexidecimal
-                DATA_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_DATA, encoded_chunk_str, filename=filename, checksum=chunk_checksum, sequence=sequence_number)
-                DATA_quic_stream = QuicStreamEvent(new_stream_id, DATA_datagram.to_framed_bytes(), False)
-                await conn.send(DATA_quic_stream)
-                print(f"[cli] Sent File Data Chunk of Size: {len(file_chunk)}, Checksum: {chunk_checksum[:8]}, Seq #: {sequence_number}")
+        file_size = 0
+        next_block = await read_block(block) if block is not None else None
+        while next_block is not None:
+            chunks = await next_block
+            # Produce and hash the next block while this one is sent
+            block = await anext(blocks, None)
+            next_block = await read_block(block) if block is not None else None
+            for file_chunk, chunk_checksum, compressed_chunk in chunks:
+                if compressed_chunk is not None:
+                    encoded_chunk = compressed_chunk
+                    stats.saved_bytes += len(file_chunk) - len(compressed_chunk)
+                else:
+                    encoded_chunk = encode_file_chunk(file_chunk, wire_format)
+                DATA_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_DATA, encoded_chunk, filename=filename, checksum=chunk_checksum, sequence=sequence_number,
+                                             compressed=compressed_chunk is not None)
+                await stream.send(QuicStreamEvent(stream_id, DATA_datagram.to_framed_bytes(wire_format), False))
+                stats.bytes += len(file_chunk)
+                stats.chunks += 1
+                file_size += len(file_chunk)
+                if debug:
+                    logger.debug(f"[cli] Sent File Data Chunk of Size: {len(file_chunk)}, Checksum: {chunk_checksum[:8]}, Seq #: {sequence_number}")
                 sequence_number += 1
-                await asyncio.sleep(0.01) # delay slightly to avoid overloading
-        
-        # Send END PDU of the file and Calculate the Overall Checksum
-        overall_checksum = await calculate_checksum(filename)
+                if adaptive is not None:
+                    adaptive.sent(len(file_chunk))
+
+        overall_checksum = file_hash.hexdigest()
+        if result is not None:
+            result.record(file_size, overall_checksum, digest)
+        END_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_END, "Ending File Transmission", filename=filename, checksum=overall_checksum)
+        await stream.send(QuicStreamEvent(stream_id, END_datagram.to_framed_bytes(wire_format), True)) # End QUIC stream
+        logger.info(f"[cli] Sent END of File With Overall Checksum: {overall_checksum[:8]}, {file_size} bytes")
+        successful = await receive_ack(stream, wire_format, reassembler)
+        return successful
+    except Exception:
+        await abort_stream(stream)
+        raise
+    finally:
+        metrics.finish_stream(stats, successful)
+
+"""
+This function sends only the parts of a file that the server does not have yet
+The file is split into content-defined chunks and their checksums are sent first. The server replies with the
+chunks it already stores, from any earlier file, and rebuilds the file once it received the missing chunks.
+With 'path', the file is read from 'path' and sent under 'filename'
+The overall checksum and size are recorded in 'result', a TransferResult, when it is given
+Returns True if the server acknowledged a successful checksum verification
+"""
+async def send_file_delta(stream:FTQuicConnection, wire_format, filename: str, offloader = None, result = None, path = None):
+    stream_id = stream.stream_id
+    reassembler = FrameReassembler(stream, role="client")
+    offloader = offloader or get_offloader({})
+    jobs = offloader.queue()
+    stats = metrics.open_stream(stream.connection_id, stream_id, "client")
+    stats.filename = filename
+    successful = False
+    debug = logger.isEnabledFor(logging.DEBUG) # per chunk messages are only formatted when they are shown
+
+    try:
+        with open(path or filename, "rb") as f:
+            # Split the file and compute the checksums of its chunks and of the whole file in one pass, in a worker
+            chunks, overall_checksum = await jobs.run_cpu_timed("hash_seconds", "client", chunk_file, path or filename) # offset, length and checksum of every chunk
+            file_size = sum(length for _, length, _ in chunks)
+
+            # Send the START PDU, followed by the list of chunks
+            options = {"delta": True, "size": file_size, "chunks": len(chunks)}
+            START_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_START, filename, filename=filename, options=options)
+            await stream.send(QuicStreamEvent(stream_id, START_datagram.to_framed_bytes(wire_format), False))
+            logger.info(f"[cli] Sent START of file: {filename}, {len(chunks)} Chunks")
+            for first in range(0, len(chunks), pdu.CHUNK_RECORDS_PER_LIST):
+                records = [(length, checksum) for _, length, checksum in chunks[first:first + pdu.CHUNK_RECORDS_PER_LIST]]
+                LIST_datagram = pdu.Datagram(pdu.MSG_TYPE_CHUNK_LIST, pdu.pack_chunk_records(records), filename=filename, sequence=first)
+                await stream.send(QuicStreamEvent(stream_id, LIST_datagram.to_framed_bytes(wire_format), False))
+
+            HAVE_datagram = await asyncio.wait_for(reassembler.read(), timeout=5) # Timeout after 5 seconds
+            if HAVE_datagram is None or HAVE_datagram.mtype != pdu.MSG_TYPE_CHUNK_HAVE:
+                raise ValueError("Expected CHUNK_HAVE")
+            have = pdu.unpack_bitmap(HAVE_datagram.msg, len(chunks))
+            logger.info(f"[cli] Server Already Has {sum(have)} of {len(chunks)} Chunks of {filename}, Sending {have.count(False)} Chunks")
+
+            # Send the missing chunks, reusing the checksums computed for the chunk list
+            # A worker reads them in batches of up to a block, the next batch is read while the current one is sent
+            batches = [] # sequence number, offset, length and checksum of the missing chunks
+            batch_size = 0
+            for sequence_number, (offset, length, chunk_checksum) in enumerate(chunks):
+                if have[sequence_number]:
+                    continue
+                if not batches or batch_size + length > READ_BLOCK_SIZE:
+                    batches.append([])
+                    batch_size = 0
+                batches[-1].append((sequence_number, offset, length, chunk_checksum))
+                batch_size += length
+            next_batch = None
+            if batches:
+                next_batch = await jobs.submit_io(read_ranges, f.fileno(), [(offset, length) for _, offset, length, _ in batches[0]])
+            for index, batch in enumerate(batches):
+                file_chunks = await next_batch
+                if index + 1 < len(batches):
+                    next_batch = await jobs.submit_io(read_ranges, f.fileno(), [(offset, length) for _, offset, length, _ in batches[index + 1]])
+                for (sequence_number, _, _, chunk_checksum), file_chunk in zip(batch, file_chunks):
+                    DATA_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_DATA, file_chunk, filename=filename, checksum=chunk_checksum, sequence=sequence_number)
+                    await stream.send(QuicStreamEvent(stream_id, DATA_datagram.to_framed_bytes(wire_format), False))
+                    stats.bytes += len(file_chunk)
+                    stats.chunks += 1
+                    if debug:
+                        logger.debug(f"[cli] Sent File Data Chunk of Size: {len(file_chunk)}, Checksum: {chunk_checksum[:8]}, Seq #: {sequence_number}")
+
+        if result is not None:
+            result.record(file_size, overall_checksum, pdu.DIGEST_SHA256)
         END_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_END, "Ending File Transmission", filename=filename, checksum=overall_checksum)
-        END_quic_steam = QuicStreamEvent(new_stream_id, END_datagram.to_framed_bytes(), True) # End QUIC stream
-        await conn.send(END_quic_steam)
-        print(f"[cli] Sent END of File With Overall Checksum: {overall_checksum[:8]}")
-
-        # Wait for ACK from server to complete file transfer
-        ACK_event: QuicStreamEvent = await asyncio.wait_for(conn.receive(), timeout=5) # Timeout after 5 seconds
-        ACK_datagram = pdu.Datagram.from_bytes(ACK_event.data)
-        if ACK_datagram.mtype == pdu.MSG_TYPE_FILE_ACK and ACK_datagram.msg == "File Transfer Successful (Checksum Verified)":
-            print("[cli] Received File Transfer Acknowledgement: Successful Checksum Verification")
-        elif ACK_datagram.mtype == pdu.MSG_TYPE_FILE_ACK and ACK_datagram.msg == "File Transfer Failed (Checksum Mismatch)":
-            print("[cli] Received File Transfer Acknowledgement: Checksum Mismatch")
-        elif ACK_datagram.mtype == pdu.MSG_TYPE_FILE_ACK:
-            print("[cli] Received File Transfer Acknowledgement")
+        await stream.send(QuicStreamEvent(stream_id, END_datagram.to_framed_bytes(wire_format), True)) # End QUIC stream
+        logger.info(f"[cli] Sent END of File With Overall Checksum: {overall_checksum[:8]}")
+        successful = await receive_ack(stream, wire_format, reassembler)
+        return successful
+    except Exception:
+        await abort_stream(stream)
+        raise
+    finally:
+        metrics.finish_stream(stats, successful)
+
+# This function ends the stream of a failed transfer and closes it
+# The server drops the partial file once its stream ends without an END PDU, and ends the stream too, which releases
+# the receive queue of the stream on a connection that is kept open for other transfers
+async def abort_stream(stream:FTQuicConnection):
+    with contextlib.suppress(Exception): # the stream may already be ended, or the connection closed
+        await stream.send(QuicStreamEvent(stream.stream_id, b"", True))
+    stream.close()
+
+# This function waits for the ACK of a file from the server, and returns True if the server verified the file
+async def receive_ack(stream:FTQuicConnection, wire_format, reassembler: FrameReassembler):
+    # Wait for ACK from server to complete file transfer
+    ACK_datagram = await asyncio.wait_for(read_reply(stream, wire_format, reassembler), timeout=5) # Timeout after 5 seconds
+    stream.close()
+    return check_ack(ACK_datagram)
+
+# This function logs the ACK of a file from the server, and returns True if the server verified the file
+def check_ack(ACK_datagram):
+    if ACK_datagram is None:
+        logger.warning("[cli] Stream Ended Without a File ACK")
+    elif ACK_datagram.mtype == pdu.MSG_TYPE_FILE_ACK and ACK_datagram.msg == "File Transfer Successful (Checksum Verified)":
+        logger.info("[cli] Received File Transfer Acknowledgement: Successful Checksum Verification")
+        return True
+    elif ACK_datagram.mtype == pdu.MSG_TYPE_FILE_ACK and ACK_datagram.msg == "File Transfer Failed (Checksum Mismatch)":
+        logger.warning("[cli] Received File Transfer Acknowledgement: Checksum Mismatch")
+    elif ACK_datagram.mtype == pdu.MSG_TYPE_FILE_ACK and ACK_datagram.msg == "File Transfer Failed (Missing Chunks)":
+        logger.warning("[cli] Received File Transfer Acknowledgement: Missing Chunks, Send the File Again With --resume or --delta")
+    elif ACK_datagram.mtype == pdu.MSG_TYPE_FILE_ACK:
+        logger.info("[cli] Received File Transfer Acknowledgement")
+    else:
+        logger.warning(f"[cli] Received Unexpected Message Type: {ACK_datagram.mtype}, Expected File ACK")
+    return False
+
+# This function downloads a file from the server, or the byte range of it given by the 'range' of the scope
+# Returns True if the file was received and verified
+async def ft_client_get(scope:Dict, conn:FTQuicConnection, filename: str):
+    logger.info("[cli] Starting File Download...")
+    wire_format = scope.get("wire_format", pdu.WIRE_FORMAT_JSON) # negotiated through the ALPN of the connection
+    digest = scope.get("digest", pdu.DIGEST_SHA256)
+    chunk_size = scope.get("chunk_size", CHUNK_SIZE)
+    offset, length = scope.get("range") or (0, None)
+    successful = False
+
+    try:
+        if wire_format != pdu.WIRE_FORMAT_BINARY:
+            logger.warning("[cli] Downloads need the binary wire format")
         else:
-            print(f"[cli] Received Unexpected Message Type: {ACK_datagram.mtype}, Expected File ACK")
-    # Error messages sent to server if file transfer fails
-    except FileNotFoundError:
-        print(f"[cli] Error: {filename} not found!")
+            if chunk_size == CHUNK_SIZE_AUTO:
+                logger.info(f"[cli] Downloads use a fixed chunk size of {CHUNK_SIZE} bytes")
+                chunk_size = CHUNK_SIZE
+            successful = await receive_file_stream(conn.open_stream(), wire_format, filename, download_path(scope, filename),
+                                                   offset, length, get_offloader(scope), digest, chunk_size)
     except:
-        print("[cli] File Transfer Failed! ")
-    
-    print("[cli] Ending File Transfer...")
+        logger.error("[cli] File Download Failed!")
+
+    logger.info("[cli] Ending File Download...")
+    return successful
+
+"""
+This function asks the server for a file, or for 'length' bytes of it from 'offset', and saves it to 'filepath'
+The server replies with the same START, DATA and END PDUs as an upload. Every chunk is verified against its checksum
+and written in batches to a temporary file, which is renamed to 'filepath' once the checksum of the whole range matches.
+Returns True if the file was received and verified
+"""
+async def receive_file_stream(stream:FTQuicConnection, wire_format, filename: str, filepath, offset = 0, length = None,
+                              offloader = None, digest = pdu.DIGEST_SHA256, chunk_size = CHUNK_SIZE):
+    stream_id = stream.stream_id
+    reassembler = FrameReassembler(stream, role="client")
+    jobs = (offloader or get_offloader({})).queue()
+    stats = metrics.open_stream(stream.connection_id, stream_id, "client")
+    stats.filename = filename
+    successful = False
+    sink = None
+    debug = logger.isEnabledFor(logging.DEBUG) # per chunk messages are only formatted when they are shown
+
+    try:
+        options = {"offset": offset, "chunk_size": chunk_size}
+        if length is not None:
+            options["length"] = length
+        if digest != pdu.DIGEST_SHA256:
+            options["digest"] = digest
+        GET_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_GET, filename, filename=filename, options=options)
+        await stream.send(QuicStreamEvent(stream_id, GET_datagram.to_framed_bytes(wire_format), True)) # the request is complete
+        if stream.reserve_receive_window is not None:
+            stream.reserve_receive_window(RECEIVE_WINDOW_CHUNKS * chunk_size)
+
+        START_datagram = await asyncio.wait_for(reassembler.read(), timeout=5) # Timeout after 5 seconds
+        if START_datagram is not None and START_datagram.mtype == pdu.MSG_TYPE_FILE_ACK:
+            logger.warning(f"[cli] Server Could Not Send {filename}: {START_datagram.msg}")
+            return False
+        if START_datagram is None or START_datagram.mtype != pdu.MSG_TYPE_FILE_START:
+            raise ValueError("Expected File START")
+        start = START_datagram.options
+        logger.info(f"[cli] Receiving {filename}: {start['length']} of {start['size']} bytes at Offset {start['offset']}")
+        sink = FileSink(filepath, batch_size=max(WRITE_BATCH_SIZE, chunk_size), digest=digest)
+        last_sequence_number = -1
+
+        async for file_data_datagram in reassembler:
+            if file_data_datagram.mtype == pdu.MSG_TYPE_FILE_DATA and file_data_datagram.filename == filename:
+                received_file_chunk = file_data_datagram.msg
+                calculated_checksum = await jobs.hexdigest(received_file_chunk, digest, role="client")
+                if calculated_checksum != file_data_datagram.checksum:
+                    stats.checksum_failures += 1
+                    logger.warning(f"[cli] Received Data Chunk for {filename} With Invalid Checksum!")
+                elif file_data_datagram.sequence != last_sequence_number + 1:
+                    stats.out_of_order += 1
+                    logger.warning(f"[cli] Sequence Out of Order! Expected Seq #: {last_sequence_number + 1}")
+                else:
+                    sink.write(received_file_chunk, flush=False)
+                    if sink.needs_flush:
+                        await jobs.run_io_timed("disk_write_seconds", "client", sink.flush)
+                    stats.bytes += len(received_file_chunk)
+                    stats.chunks += 1
+                    last_sequence_number += 1
+                    if debug:
+                        logger.debug(f"[cli] Received Data Chunk for {filename} with Valid Checksum: {calculated_checksum[:8]}, Seq #: {file_data_datagram.sequence}")
+
+            # Save the file once the checksum of everything received matches the checksum of the server
+            elif file_data_datagram.mtype == pdu.MSG_TYPE_FILE_END and file_data_datagram.filename == filename:
+                await jobs.run_io_timed("disk_write_seconds", "client", sink.flush)
+                server_overall_checksum = file_data_datagram.checksum
+                client_overall_checksum = sink.hexdigest()
+                if client_overall_checksum == server_overall_checksum and sink.size == start["length"]:
+                    await jobs.run_io_timed("disk_write_seconds", "client", sink.commit)
+                    logger.info(f"[cli] File Received and Saved to {filepath}, Total Size: {sink.size} bytes")
+                    logger.info(f"[cli] Overall Checksums Match! Server: {server_overall_checksum[:8]}, Client: {client_overall_checksum[:8]}")
+                    successful = True
+                else:
+                    logger.warning(f"[cli] Overall Checksums Mismatch! Server: {server_overall_checksum[:8]}, Client: {client_overall_checksum[:8]}")
+                break
+            else:
+                logger.warning(f"[cli] Unexpected PDU Type: {file_data_datagram.mtype}")
+                break
+        else:
+            logger.warning(f"[cli] Stream Ended Before the END of {filename}")
+        return successful
+    finally:
+        stream.close()
+        if sink is not None:
+            sink.abort() # removes the temporary file unless it was committed
+        metrics.finish_stream(stats, successful)
+
+# This function sends a FILE_LIST or FILE_STAT request on its own stream and returns the files of the FILE_INFO reply
+# Returns None if the server replied with an error
+async def request_file_info(stream:FTQuicConnection, wire_format, request):
+    reassembler = FrameReassembler(stream, role="client")
+    try:
+        await stream.send(QuicStreamEvent(stream.stream_id, request.to_framed_bytes(wire_format), True))
+        INFO_datagram = await asyncio.wait_for(reassembler.read(), timeout=5) # Timeout after 5 seconds
+    finally:
+        stream.close()
+    if INFO_datagram is not None and INFO_datagram.mtype == pdu.MSG_TYPE_FILE_ACK:
+        logger.warning(f"[cli] {request.msg}: {INFO_datagram.msg}")
+        return None
+    if INFO_datagram is None or INFO_datagram.mtype != pdu.MSG_TYPE_FILE_INFO:
+        raise ValueError("Expected File INFO")
+    return json.loads(INFO_datagram.msg)["files"]
+
+# This function shows a file with its size and modification time
+def log_file_info(info):
+    modified = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(info["mtime"]))
+    logger.info(f"[cli] {info['size']:>12}  {modified}  {info['name']}")
+
+# This function lists the files stored on the server under each path prefix, and returns them
+async def list_files(conn:FTQuicConnection, wire_format, prefixes):
+    files = []
+    for prefix in prefixes:
+        LIST_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_LIST, prefix)
+        listed = await request_file_info(conn.open_stream(), wire_format, LIST_datagram) or []
+        for info in listed:
+            log_file_info(info)
+        logger.info(f"[cli] {len(listed)} Files Stored Under '{prefix or '/'}', {sum(info['size'] for info in listed)} bytes")
+        files.extend(listed)
+    return files
+
+# This function returns the size and modification time of stored files, files that are not stored are left out
+async def stat_files(conn:FTQuicConnection, wire_format, filenames):
+    files = []
+    for filename in filenames:
+        STAT_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_STAT, filename, filename=filename)
+        for info in await request_file_info(conn.open_stream(), wire_format, STAT_datagram) or []:
+            log_file_info(info)
+            files.append(info)
+    return files
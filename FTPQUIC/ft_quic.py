@@ -1,18 +1,35 @@
 from typing import Coroutine,Callable, Optional
 
+# One event is allocated for every piece of received stream data, slots keep it small and fast to create
 class QuicStreamEvent():
+    __slots__ = ("stream_id", "data", "end_stream")
+
     def __init__(self, stream_id, data, end_stream):
         self.stream_id = stream_id
         self.data = data
         self.end_stream = end_stream
         
+# 'open_stream' returns a connection whose 'receive' only returns events of a new stream, given by 'stream_id'
+# 'rtt' returns the smoothed round trip time of the connection in seconds
+# 'reserve_receive_window' lets the peer send at least the given number of bytes on the stream without waiting
+# 'connection_id' identifies the QUIC connection of the stream in the metrics
 class FTQuicConnection():
     def __init__(self, send:Coroutine[QuicStreamEvent, None, None], 
                  receive: Coroutine[None, None, QuicStreamEvent],
                  close:Optional[Callable[[], None]], 
-                 new_stream:Optional[Callable[[], int]]):
+                 new_stream:Optional[Callable[[], int]],
+                 open_stream:Optional[Callable[[], "FTQuicConnection"]] = None,
+                 stream_id:Optional[int] = None,
+                 rtt:Optional[Callable[[], float]] = None,
+                 reserve_receive_window:Optional[Callable[[int], None]] = None,
+                 connection_id:Optional[int] = None):
         self.send = send
         self.receive = receive
         self.close = close
         self.new_stream = new_stream
+        self.open_stream = open_stream
+        self.stream_id = stream_id
+        self.rtt = rtt
+        self.reserve_receive_window = reserve_receive_window
+        self.connection_id = connection_id
         
\ No newline at end of file
@@ -2,88 +2,888 @@ from typing import Dict
 from ft_quic import FTQuicConnection, QuicStreamEvent
 import pdu
 import os
-import hashlib # library used for checksum using SHA-256 hashing
-import base64 # library used for encoding/decoding file chunks during transfer
-from utils import calculate_checksum, read_framed_datagram
+import json
+import logging
+import inspect
+import asyncio
+import functools
+import time
+from utils import decode_file_chunk, reply_bytes, read_chunk_block, FrameReassembler
+from storage import LocalStorage, ResumableFile, safe_relative_path, FSYNC_NEVER, WRITE_BATCH_SIZE
+from executor import get_offloader
+from compression import CODECS
+from metrics import metrics
 
-# Create a dictionary to store files received from the client
-received_files: Dict[str, bytearray] = {}
-SERVER_FILES_DIRECTORY = "server_files" # name of the directory where the transferred files will be stored
+logger = logging.getLogger(__name__)
+
+SERVER_FILES_DIRECTORY = "server_files" # name of the directory where the transferred files will be stored by default
+MAX_BUFFERED_CHUNK_SIZE = 16 * 1024 * 1024 # largest announced chunk size the receive buffers are sized for
+RECEIVE_WINDOW_CHUNKS = 4 # number of the largest chunks the client can send before waiting for a window update
+SEND_CHUNK_SIZE = 4096 # size of the chunks of a downloaded file when the client does not ask for another size
+SEND_BLOCK_SIZE = 1024 * 1024 # number of bytes of a downloaded file hashed by a worker thread at a time
+REORDER_BUFFER_SIZE = 4 * 1024 * 1024 # bytes of chunks received after a missing chunk that are held until it is sent again
+MAX_CHUNK_RETRIES = 3 # times a chunk with an invalid checksum is asked for again before the transfer fails
+DEFAULT_MAX_FILE_SIZE = 64 * 1024 ** 3 # largest file a client can send, the 'max_file_size' of the scope overrides it
+MAX_PARALLEL_RANGES = 1024 # ranges a file sent over parallel streams can be split into
+PARALLEL_TRANSFER_TIMEOUT = 60.0 # seconds a parallel transfer without an open range stream is kept before it is discarded
+
+# Shared storage of the handlers that were not given one in their scope, the 'server_files' directory
+_default_storage = None
+
+# This function returns the storage backend in the scope of a handler, or the 'server_files' directory
+def get_storage(scope):
+    global _default_storage
+    storage = scope.get("storage")
+    if storage is None:
+        if _default_storage is None:
+            _default_storage = LocalStorage(SERVER_FILES_DIRECTORY)
+        storage = _default_storage
+    return storage
+
+# Describes a file that was received, verified and stored, it is passed to the 'on_file_complete' callbacks of the scope
+# 'checksum' is the checksum of the whole file in the 'digest' of the transfer, None for files sent over parallel streams
+class ReceivedFile:
+    def __init__(self, filename, filepath, size, checksum, digest = pdu.DIGEST_SHA256):
+        self.filename = filename
+        self.filepath = filepath
+        self.size = size
+        self.checksum = checksum
+        self.digest = digest
+
+    def to_dict(self):
+        return {"filename": self.filename, "filepath": self.filepath, "size": self.size, 
+                "checksum": self.checksum, "digest": self.digest}
+
+# This function calls the 'on_file_complete' callbacks of the scope with a stored file, callbacks can be coroutines
+# A failing callback is logged, the file stays stored and the client already received its ACK
+async def notify_file_complete(scope:Dict, received: ReceivedFile):
+    for callback in scope.get("on_file_complete", ()):
+        try:
+            result = callback(received)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            logger.error(f"[svr] File Complete Callback Failed for {received.filename}: {e!r}")
+
+# This function returns the largest chunk size announced in the START PDU, 0 if none was announced
+def announced_chunk_size(options):
+    return min(options.get("max_chunk_size", options.get("chunk_size", 0)), MAX_BUFFERED_CHUNK_SIZE)
+
+# This function returns the size of the write batches of a transfer, so a batch holds at least one chunk
+def write_batch_size(options):
+    return max(WRITE_BATCH_SIZE, announced_chunk_size(options))
+
+# This function decompresses the chunk of a DATA PDU, up to the announced chunk size, and returns None if it cannot be decompressed
+async def decompress_received_chunk(data, compression, options, jobs):
+    max_size = announced_chunk_size(options) or MAX_BUFFERED_CHUNK_SIZE
+    try:
+        return await jobs.decompress(data, compression, max_size, role="server")
+    except ValueError as e:
+        logger.warning(f"[svr] Received Data Chunk That Cannot Be Decompressed: {e}")
+        return None
+
+# This function returns True for integers, JSON booleans are not sizes
+def is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+# This function returns why the file size announced in the options of a START or QUERY PDU is refused, or None
+# The size is preallocated or used to size the manifest of the file, so it is capped by 'max_file_size'
+def check_announced_size(options, max_file_size):
+    size = options.get("size")
+    if not is_integer(size) or size < 0:
+        return "Invalid Size"
+    if size > max_file_size:
+        return "File Too Large"
+    return None
+
+# This function returns the largest file a client can send, the 'max_file_size' of the scope or the smaller one of the storage
+def get_max_file_size(scope, storage):
+    max_file_size = scope.get("max_file_size", DEFAULT_MAX_FILE_SIZE)
+    if storage.max_file_size is not None:
+        max_file_size = min(max_file_size, storage.max_file_size)
+    return max_file_size
+
+# This function returns why the byte range announced in the options of a START PDU is refused, or None
+def check_announced_range(options):
+    offset, length, ranges = options.get("offset"), options.get("length"), options.get("ranges")
+    if not all(is_integer(value) for value in (offset, length, ranges)) or not isinstance(options.get("transfer_id"), str):
+        return "Invalid Range"
+    if offset < 0 or length < 0 or offset + length > options["size"] or not 1 <= ranges <= MAX_PARALLEL_RANGES:
+        return "Invalid Range"
+    return None
+
+"""
+This class collects the byte ranges of one file that are sent over parallel streams of one connection
+Every range is written into the same preallocated temporary file with positional writes. Ranges must not overlap,
+and the file is only saved once every announced range was received and verified and together they cover the whole file.
+It is discarded if any range failed or did not cover it, and after PARALLEL_TRANSFER_TIMEOUT seconds without an open
+range stream, e.g. when the connection closed before the streams of some ranges were opened.
+The file is created and preallocated by a worker thread of the 'jobs' queue, ranges that start meanwhile wait for the same job.
+"""
+class ParallelTransfer:
+    def __init__(self, key, storage, filename, size, ranges, fsync, jobs, digest = pdu.DIGEST_SHA256, batch_size = WRITE_BATCH_SIZE,
+                 timeout = PARALLEL_TRANSFER_TIMEOUT):
+        self.key = key # connection ID and transfer ID chosen by the client
+        self.transfer_id = key[1]
+        self.filename = filename
+        self.size = size
+        self.ranges = ranges
+        self.sink = None # set once the file is open
+        self._opening = asyncio.ensure_future(jobs.run_io(functools.partial(
+            storage.open_sink, filename, fsync=fsync, batch_size=batch_size, size=size, digest=digest)))
+        self.covered = [] # (offset, end) of the ranges whose stream started, sorted by offset
+        self.verified_bytes = 0 # bytes of the verified ranges, which do not overlap
+        self.active_ranges = 0 # range streams that are being received
+        self.finished_ranges = 0
+        self.failed = False
+        self.done = False
+        self.timeout = timeout
+        self.last_activity = time.monotonic()
+        self._expiry = None
+
+    # This function returns the sink of the file once it is open, it raises the error of the storage if it could not be opened
+    async def open_sink(self):
+        if self.sink is None:
+            self.sink = await asyncio.shield(self._opening) # a range that is cancelled does not cancel the others
+        return self.sink
+
+    # This function records the range of a stream, and returns False if it overlaps another range or is one range too many
+    def add_range(self, offset, length):
+        if len(self.covered) >= self.ranges or self.done:
+            return False
+        end = offset + length
+        if any(offset < other_end and other_offset < end or length == 0 and other_offset == offset
+               for other_offset, other_end in self.covered):
+            return False
+        self.covered.append((offset, end))
+        self.covered.sort()
+        self.active_ranges += 1
+        self.last_activity = time.monotonic()
+        return True
+
+    # This function is called once per range when its stream ends, and returns True when the whole file was saved
+    # The file is saved or discarded by a worker thread of the 'jobs' queue
+    async def finish_range(self, length, verified, jobs):
+        self.active_ranges -= 1
+        self.finished_ranges += 1
+        self.last_activity = time.monotonic()
+        if verified:
+            self.verified_bytes += length
+        else:
+            self.failed = True
+        if self.finished_ranges < self.ranges:
+            return False
+        if self.failed or self.verified_bytes != self.size:
+            if not self.failed:
+                logger.warning(f"[svr] Ranges of {self.filename} Cover {self.verified_bytes} of {self.size} bytes, Discarding the File")
+            await self.discard(jobs)
+            return False
+        self._finish()
+        await jobs.run_io(self.sink.commit)
+        return True
+
+    # This function discards the file of the transfer
+    async def discard(self, jobs):
+        if not self.done:
+            self._finish()
+            try:
+                sink = await self.open_sink()
+            except Exception:
+                return # the file was never created
+            await jobs.run_io(sink.abort)
+
+    def _finish(self):
+        self.done = True
+        if parallel_transfers.get(self.key) is self:
+            del parallel_transfers[self.key]
+        if self._expiry is not None and self._expiry is not asyncio.current_task():
+            self._expiry.cancel()
+
+    # Starts the task discarding the transfer once it was idle for 'timeout' seconds
+    def start_expiry(self, jobs):
+        self._expiry = asyncio.ensure_future(self._expire(jobs))
+
+    async def _expire(self, jobs):
+        while not self.done:
+            idle = time.monotonic() - self.last_activity
+            if self.active_ranges == 0 and idle >= self.timeout:
+                logger.warning(f"[svr] Parallel Transfer of {self.filename} Expired With {self.finished_ranges} of {self.ranges} Ranges Received")
+                await self.discard(jobs)
+                return
+            await asyncio.sleep(self.timeout - idle if self.active_ranges == 0 else self.timeout)
+
+# Transfers received over parallel streams, by connection ID and transfer ID chosen by the client
+parallel_transfers: Dict[tuple, ParallelTransfer] = {}
+
+# This function returns the parallel transfer a range belongs to, and creates it for its first range
+# Returns None if the range announces another file, size or number of ranges than the transfer it belongs to
+def get_parallel_transfer(connection_id, options, storage, filename, fsync, jobs):
+    key = (connection_id, options["transfer_id"])
+    transfer = parallel_transfers.get(key)
+    if transfer is None:
+        transfer = ParallelTransfer(key, storage, filename, options["size"], options["ranges"], fsync, jobs,
+                                    options.get("digest", pdu.DIGEST_SHA256), write_batch_size(options))
+        parallel_transfers[key] = transfer
+        transfer.start_expiry(jobs)
+    elif (transfer.filename, transfer.size, transfer.ranges) != (filename, options["size"], options["ranges"]):
+        return None
+    return transfer
+
+# Partial files of resumable transfers that are being received, by path
+resumable_files: Dict[str, ResumableFile] = {}
+
+# This function opens the partial file of a resumable transfer from the size and chunk size in the datagram options
+# If a stream of a dropped connection still has the file open, what it received is written before it is taken over
+# The recorded chunks are read back and verified by a worker thread of the 'jobs' queue
+async def open_resumable_file(datagram, storage, fsync, jobs):
+    filepath = storage.filepath(datagram.filename)
+    stale = resumable_files.pop(filepath, None)
+    if stale is not None:
+        await jobs.run_io(stale.close)
+    resumable = await jobs.run_io(storage.open_resumable, datagram.filename, datagram.options["size"], datagram.options["chunk_size"], fsync,
+                                  write_batch_size(datagram.options), datagram.options.get("digest", pdu.DIGEST_SHA256))
+    resumable_files[filepath] = resumable
+    return resumable
+
+# This function closes a partial file, and keeps it unless it was saved or discarded
+async def close_resumable_file(resumable, jobs):
+    if resumable_files.get(resumable.filepath) is resumable:
+        del resumable_files[resumable.filepath]
+    await jobs.run_io(resumable.close)
+
+"""
+This class asks the client to send chunks again with NACK PDUs, when the START PDU has the 'nack' option
+A chunk with an invalid checksum is asked for again right away, and so are the chunks missing before a chunk that
+arrives early. Early chunks are held in a bounded reorder buffer and written once the missing chunks arrive, the ones
+that do not fit are dropped and asked for again. Chunks sent again arrive after the chunks already in flight on the
+stream, often after the END PDU, which is then kept until they arrived. A damaged chunk only costs sending that
+chunk again instead of the whole file.
+"""
+# Chunks of resumed transfers are written at their offset in any order, so only the 'in_order' ones leave gaps
+class ReorderBuffer:
+    def __init__(self, conn:FTQuicConnection, stream_id, filename, wire_format, stats, max_size = REORDER_BUFFER_SIZE, in_order = True):
+        self.conn = conn
+        self.stream_id = stream_id
+        self.filename = filename
+        self.wire_format = wire_format
+        self.stats = stats
+        self.max_size = max_size
+        self.in_order = in_order
+        self.chunks = {} # chunk and checksum of every held sequence number
+        self.size = 0 # bytes of the held chunks
+        self.highest = -1 # highest sequence number that was received or asked for
+        self.dropped = set() # chunks asked for that arrived again while the buffer was full
+        self.retries = {} # times every chunk with an invalid checksum was asked for again
+        self.failed = False # set once a chunk was asked for too often, the transfer then fails at the END PDU
+        self.end = None # END PDU received while chunks were still missing
+
+    # Sends a NACK PDU for ranges of (first sequence, count), 'next_sequence' tells the client every chunk before it was received
+    async def request(self, ranges, next_sequence):
+        ranges = [(first, count) for first, count in ranges if count > 0]
+        if not ranges:
+            return
+        self.highest = max(self.highest, max(first + count - 1 for first, count in ranges))
+        NACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_NACK, pdu.pack_sequence_ranges(ranges), filename=self.filename, sequence=next_sequence)
+        await self.conn.send(QuicStreamEvent(self.stream_id, reply_bytes(NACK_datagram, self.wire_format), False))
+        requested = sum(count for _, count in ranges)
+        self.stats.retransmitted_chunks += requested
+        logger.info(f"[svr] Asked for {requested} Chunks of {self.filename} Again, Next Expected Seq #: {next_sequence}")
+
+    # Holds a chunk that arrived before 'next_sequence', and asks for the chunks between them that were not asked for yet
+    # A chunk that does not fit is dropped: a new chunk is asked for with the next gap, a chunk that was already asked for
+    # is asked for again once the buffer was written
+    async def hold(self, sequence, chunk, checksum, next_sequence):
+        if sequence in self.chunks:
+            return
+        if self.size + len(chunk) > self.max_size:
+            if sequence <= self.highest:
+                self.dropped.add(sequence)
+            return
+        self.chunks[sequence] = (bytes(chunk), checksum) # copied, so the receive buffer is not kept
+        self.size += len(chunk)
+        first = max(next_sequence, self.highest + 1)
+        self.highest = max(self.highest, sequence)
+        await self.request([(first, sequence - first)], next_sequence)
+
+    # Asks for the chunks that were dropped while the buffer was full, after the chunks before them were written
+    async def request_dropped(self, next_sequence):
+        dropped = sorted(sequence for sequence in self.dropped if sequence >= next_sequence)
+        self.dropped.clear()
+        ranges = []
+        for sequence in dropped:
+            if ranges and ranges[-1][0] + ranges[-1][1] == sequence:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + 1)
+            else:
+                ranges.append((sequence, 1))
+        await self.request(ranges, next_sequence)
+
+    # Asks for a chunk again that could not be verified, with the chunks missing before it, unless it was asked for too often
+    async def reject(self, sequence, next_sequence):
+        self.retries[sequence] = self.retries.get(sequence, 0) + 1
+        if self.retries[sequence] > MAX_CHUNK_RETRIES:
+            self.failed = True
+            logger.warning(f"[svr] Data Chunk for {self.filename} Failed {MAX_CHUNK_RETRIES} Retries! Seq #: {sequence}")
+            return
+        first = max(next_sequence, self.highest + 1) if self.in_order else sequence
+        await self.request([(first, sequence - first), (sequence, 1)], next_sequence)
+
+    # Returns the held chunk and checksum of a sequence number, or None if it is not held
+    def take(self, sequence):
+        held = self.chunks.pop(sequence, None)
+        if held is not None:
+            self.size -= len(held[0])
+        return held
+
+    # Keeps an END PDU that arrived while chunks were missing, and asks for the chunks that were never received nor asked for
+    # Returns False when the transfer can be finished with the END PDU
+    async def wait_for_missing(self, end_datagram, complete, ranges, next_sequence):
+        if self.failed or complete:
+            return False
+        self.end = end_datagram
+        await self.request(ranges, next_sequence)
+        return True
+
+    # True while the kept END PDU waits for chunks sent again
+    def waiting(self, complete):
+        return self.end is not None and not complete and not self.failed
+
+# This function returns the ranges of the sequence numbers below 'end' that are not in 'received', as (first sequence, count)
+def missing_sequence_ranges(received, end):
+    ranges = []
+    first = None
+    for sequence in range(end):
+        if sequence not in received and first is None:
+            first = sequence
+        elif sequence in received and first is not None:
+            ranges.append((first, sequence - first))
+            first = None
+    if first is not None:
+        ranges.append((first, end - first))
+    return ranges
+
+"""
+This function receives a file sent as a delta transfer, after its START PDU
+The client sends the checksums of the content-defined chunks of the file, and the server replies with a bitmap of
+the chunks it already has in its chunk store. Only the other chunks are received, each one once even if it appears
+several times in the file, and the file is then rebuilt from the chunk store and verified.
+Delta transfers always use SHA-256, since the chunk store is addressed by the SHA-256 of the chunks.
+Returns the stored file, or None if the file could not be received and verified
+"""
+async def receive_delta(conn:FTQuicConnection, reassembler:FrameReassembler, start_datagram, storage, wire_format, fsync, jobs, stats):
+    filename = start_datagram.filename
+    filepath = storage.filepath(filename)
+    stream_id = reassembler.stream_id
+    options = start_datagram.options
+    store = storage.chunk_store(fsync)
+
+    # Collect the chunk list
+    chunks = [] # length and checksum of every chunk, in file order
+    while len(chunks) < options["chunks"]:
+        LIST_datagram = await reassembler.read()
+        if LIST_datagram is None or LIST_datagram.mtype != pdu.MSG_TYPE_CHUNK_LIST:
+            logger.warning(f"[svr] Received Unexpected Message Type: {getattr(LIST_datagram, 'mtype', None)}, Expected CHUNK_LIST")
+            return None
+        chunks.extend(pdu.unpack_chunk_records(LIST_datagram.msg))
+    if len(chunks) != options["chunks"] or sum(length for length, _ in chunks) != options["size"]:
+        logger.warning(f"[svr] Chunk List of {filename} Does Not Match the File Size!")
+        return None
+
+    # Reply with the chunks that are already stored, or that are requested for an earlier position in the file
+    stored = await jobs.run_io(lambda: {checksum for _, checksum in chunks if store.has(checksum)})
+    requested = {} # checksum and length of every chunk that must be received
+    have = []
+    for length, checksum in chunks:
+        if checksum in requested or checksum in stored:
+            have.append(True)
+        else:
+            requested[checksum] = length
+            have.append(False)
+    HAVE_datagram = pdu.Datagram(pdu.MSG_TYPE_CHUNK_HAVE, pdu.pack_bitmap(have), filename=filename)
+    await conn.send(QuicStreamEvent(stream_id, reply_bytes(HAVE_datagram, wire_format), False))
+    logger.info(f"[svr] Chunk List of {filename}: {len(chunks) - len(requested)} of {len(chunks)} Chunks Already Stored")
+
+    debug = logger.isEnabledFor(logging.DEBUG) # per chunk messages are only formatted when they are shown
+    received = None
+    async for file_data_datagram in reassembler:
+        if file_data_datagram.mtype == pdu.MSG_TYPE_FILE_DATA and file_data_datagram.filename == filename:
+            received_file_chunk = decode_file_chunk(file_data_datagram.msg)
+            calculated_checksum = await jobs.hexdigest(received_file_chunk, role="server")
+            if calculated_checksum != file_data_datagram.checksum:
+                stats.checksum_failures += 1
+                logger.warning(f"[svr] Received Data Chunk for {filename} With Invalid Checksum!")
+                logger.warning(f"[svr] Expected: {file_data_datagram.checksum[:8]}, Got: {calculated_checksum[:8]}")
+            elif requested.get(calculated_checksum) != len(received_file_chunk):
+                stats.unrequested_chunks += 1
+                logger.warning(f"[svr] Data Chunk Was Not Requested! Seq #: {file_data_datagram.sequence}")
+            else:
+                await jobs.run_io_timed("disk_write_seconds", "server", store.put, calculated_checksum, received_file_chunk)
+                del requested[calculated_checksum]
+                stats.bytes += len(received_file_chunk)
+                stats.chunks += 1
+                if debug:
+                    logger.debug(f"[svr] Received Data Chunk for {filename} with Valid Checksum: {calculated_checksum[:8]}, Seq #: {file_data_datagram.sequence}")
+
+        # Rebuild the file from the chunk store once every missing chunk was received
+        elif file_data_datagram.mtype == pdu.MSG_TYPE_FILE_END and file_data_datagram.filename == filename:
+            client_overall_checksum = file_data_datagram.checksum
+            if requested:
+                logger.warning(f"[svr] File Incomplete! Missing {len(requested)} Chunks")
+                ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, "File Transfer Failed (Missing Chunks)")
+            else:
+                # The file is rebuilt, hashed and saved by a worker thread
+                def rebuild():
+                    sink = storage.open_sink(filename, fsync=fsync, size=options["size"])
+                    try:
+                        for _, checksum in chunks:
+                            sink.write(store.get(checksum))
+                        server_overall_checksum = sink.hexdigest()
+                        if server_overall_checksum == client_overall_checksum:
+                            sink.commit()
+                        return server_overall_checksum, sink.size
+                    finally:
+                        sink.abort() # removes the temporary file unless it was committed
+                server_overall_checksum, size = await jobs.run_io_timed("disk_write_seconds", "server", rebuild)
+                if server_overall_checksum == client_overall_checksum:
+                    logger.info(f"[svr] File Rebuilt From {len(chunks)} Chunks and Saved to {filepath}, Total Size: {size} bytes")
+                    logger.info(f"[svr] Overall Checksums Match! Client: {client_overall_checksum[:8]}, Server: {server_overall_checksum[:8]}")
+                    ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, "File Transfer Successful (Checksum Verified)")
+                    received = ReceivedFile(filename, filepath, size, server_overall_checksum)
+                else:
+                    logger.warning(f"[svr] Overall Checksums Mismatch! Client: {client_overall_checksum[:8]}, Server: {server_overall_checksum[:8]}")
+                    ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, "File Transfer Failed (Checksum Mismatch)")
+            await conn.send(QuicStreamEvent(stream_id, reply_bytes(ACK_datagram, wire_format), False))
+            break
+        else:
+            logger.warning(f"[svr] Unexpected PDU Type: {file_data_datagram.mtype}")
+            break
+    return received
+
+# This function replies to a FILE_LIST request with the stored files whose name starts with the requested prefix,
+# or to a FILE_STAT request with the stored file, and returns False if there was no such file
+async def send_file_info(conn:FTQuicConnection, stream_id, request, storage, wire_format, jobs):
+    files = await jobs.run_io(storage.files)
+    if request.mtype == pdu.MSG_TYPE_FILE_LIST:
+        prefix = request.msg.lstrip("/")
+        names = sorted(name for name in files if name.startswith(prefix))
+    else:
+        name = safe_relative_path(request.filename).replace(os.sep, "/")
+        names = [name] if name in files else []
+    if request.mtype == pdu.MSG_TYPE_FILE_STAT and not names:
+        logger.warning(f"[svr] File Not Found: {request.filename}")
+        reply_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, "File Not Found", filename=request.filename)
+    else:
+        info = {"files": [{"name": name, "size": files[name][0], "mtime": files[name][1]} for name in names]}
+        reply_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_INFO, json.dumps(info))
+        logger.info(f"[svr] Sent Info of {len(names)} Files")
+    await conn.send(QuicStreamEvent(stream_id, reply_bytes(reply_datagram, wire_format), True))
+    return bool(names)
+
+"""
+This function sends a stored file, or the byte range of it given in the options of a FILE_GET request
+The reply uses the PDUs of an upload: START with the size of the file and of the range, the DATA chunks, and END with
+the checksum of the range. The file is opened by the storage, which memory maps files on disk, and a worker thread
+hashes the next block of chunks while the current one is sent. DATA PDUs are sent as their header and a slice of the
+mapping, so the only copy of a chunk is made by the QUIC stream, from the page cache.
+Returns True once the whole range was sent
+"""
+async def send_file(conn:FTQuicConnection, stream_id, request, storage, wire_format, jobs, stats):
+    filename = request.filename
+    options = request.options or {}
+    digest = options.get("digest", pdu.DIGEST_SHA256)
+    chunk_size = options.get("chunk_size", SEND_CHUNK_SIZE)
+    offset = options.get("offset", 0)
+    debug = logger.isEnabledFor(logging.DEBUG) # per chunk messages are only formatted when they are shown
+
+    error = None
+    f = None
+    if wire_format != pdu.WIRE_FORMAT_BINARY:
+        error = "Binary Wire Format Required"
+    elif digest not in pdu.DIGESTS:
+        error = "Unsupported Digest"
+    elif not isinstance(chunk_size, int) or not 0 < chunk_size <= MAX_BUFFERED_CHUNK_SIZE:
+        error = "Invalid Chunk Size"
+    elif not is_integer(offset) or not is_integer(options.get("length", 0)):
+        error = "Invalid Range"
+    else:
+        try:
+            f = await jobs.run_io(storage.open_file, filename)
+        except OSError:
+            error = "File Not Found"
+    if f is not None:
+        size = f.size
+        length = options.get("length", size - offset)
+        if offset < 0 or offset > size or length < 0:
+            error = "Invalid Range"
+        length = min(length, size - offset)
+    if error is not None:
+        if f is not None:
+            f.close()
+        logger.warning(f"[svr] Cannot Send {filename}: {error}")
+        ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, f"File Transfer Failed ({error})", filename=filename)
+        await conn.send(QuicStreamEvent(stream_id, reply_bytes(ACK_datagram, wire_format), True))
+        return False
+
+    next_block = None # the block that is hashed by a worker thread while the current one is sent
+    try:
+        start_options = {"size": size, "offset": offset, "length": length, "chunk_size": chunk_size, "digest": digest}
+        START_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_START, filename, filename=filename, options=start_options)
+        await conn.send(QuicStreamEvent(stream_id, reply_bytes(START_datagram, wire_format), False))
+        logger.info(f"[svr] Sending {filename}: {length} of {size} bytes at Offset {offset}")
+
+        source = f.source
+        sequence_number = 0
+        file_hash = pdu.new_digest(digest) # checksum of the range
+        block_size = max(1, SEND_BLOCK_SIZE // chunk_size) * chunk_size
+        block_offsets = range(offset, offset + length, block_size)
+        def read_block(index):
+            block_offset = block_offsets[index]
+            return jobs.submit_io(read_chunk_block, source, block_offset, min(block_size, offset + length - block_offset),
+                                  chunk_size, file_hash, digest, "server")
+
+        next_block = await read_block(0) if block_offsets else None
+        for index in range(len(block_offsets)):
+            chunks = await next_block
+            # Hash the next block while this one is sent, blocks are hashed one after the other so the hash stays in order
+            if index + 1 < len(block_offsets):
+                next_block = await read_block(index + 1)
+            for file_chunk, chunk_checksum, _ in chunks:
+                DATA_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_DATA, file_chunk, filename=filename, checksum=chunk_checksum, sequence=sequence_number)
+                await conn.send(QuicStreamEvent(stream_id, DATA_datagram.to_framed_parts(wire_format), False)) # waits while too much data is in flight
+                stats.bytes += len(file_chunk)
+                stats.chunks += 1
+                if debug:
+                    logger.debug(f"[svr] Sent File Data Chunk of Size: {len(file_chunk)}, Checksum: {chunk_checksum[:8]}, Seq #: {sequence_number}")
+                sequence_number += 1
+    finally:
+        if next_block is not None and not next_block.done():
+            await asyncio.wait([next_block]) # a worker thread still hashes a slice of the mapping
+        chunks = file_chunk = DATA_datagram = source = next_block = read_block = None # drop the slices of the mapping
+        # The callback of the event loop that resumed this task with the last block still holds the finished job, and
+        # its result, until this task yields. When the whole range was sent without waiting for the stream, that is now.
+        try:
+            await asyncio.sleep(0)
+        finally:
+            f.close()
+
+    overall_checksum = file_hash.hexdigest()
+    END_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_END, "Ending File Transmission", filename=filename, checksum=overall_checksum)
+    await conn.send(QuicStreamEvent(stream_id, END_datagram.to_framed_bytes(wire_format), True)) # End QUIC stream
+    logger.info(f"[svr] Sent END of {filename} With Overall Checksum: {overall_checksum[:8]}")
+    return True
 
 # This function represents file transfer from the server side
+# Once a received file is verified and stored, it is passed to the 'on_file_complete' callbacks of the scope
 async def ft_server_proto(scope:Dict, conn:FTQuicConnection):
-    # Create the 'server_files' directory if it does not exist
-    if not os.path.exists(SERVER_FILES_DIRECTORY):
-        os.makedirs(SERVER_FILES_DIRECTORY)
+    storage = get_storage(scope) # where received files are stored, the 'server_files' directory by default
+    wire_format = scope.get("wire_format", pdu.WIRE_FORMAT_JSON) # negotiated through the ALPN of the connection
+    sink = None
+    transfer = None # set when the stream carries one byte range of a parallel transfer
+    range_finished = False
+    resumable = None # set when the client resumes the transfer from the chunks already received
+    jobs = get_offloader(scope).queue() # hashing and disk I/O of this stream run in worker threads
+    stats = metrics.open_stream(conn.connection_id, conn.stream_id, "server")
+    successful = False
+    received = None # the stored file once it was verified
+    debug = logger.isEnabledFor(logging.DEBUG) # per chunk messages are only formatted when they are shown
 
     try:
         # Listen for a connection from the client
-        received_datagram, stream_id = await read_framed_datagram(conn)
+        reassembler = FrameReassembler(conn, role="server") # keeps frames that arrive together in one QUIC event
+        received_datagram = await reassembler.read()
+        stream_id = reassembler.stream_id
+        fsync = scope.get("fsync", FSYNC_NEVER)
+
+        # Downloads, listings and file info requests are answered on the stream of the request
+        if received_datagram is not None and received_datagram.mtype in (pdu.MSG_TYPE_FILE_LIST, pdu.MSG_TYPE_FILE_STAT):
+            successful = await send_file_info(conn, stream_id, received_datagram, storage, wire_format, jobs)
+            return
+        if received_datagram is not None and received_datagram.mtype == pdu.MSG_TYPE_FILE_GET:
+            stats.filename = received_datagram.filename
+            successful = await send_file(conn, stream_id, received_datagram, storage, wire_format, jobs, stats)
+            return
+
+        # A client resuming a transfer first asks which chunks of the file are already received
+        if (received_datagram is not None and received_datagram.mtype in (pdu.MSG_TYPE_FILE_QUERY, pdu.MSG_TYPE_FILE_START)
+                and (received_datagram.options or {}).get("resume") and not storage.supports_resume):
+            logger.warning(f"[svr] Cannot Resume {received_datagram.filename}: the Storage Does Not Keep Partial Files")
+            ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, "File Transfer Failed (Resume Not Supported)")
+            await conn.send(QuicStreamEvent(stream_id, reply_bytes(ACK_datagram, wire_format), False))
+            return
+        max_file_size = get_max_file_size(scope, storage)
+        if received_datagram is not None and received_datagram.mtype == pdu.MSG_TYPE_FILE_QUERY:
+            options = received_datagram.options or {}
+            refused = check_announced_size(options, max_file_size)
+            if refused is None and (not is_integer(options.get("chunk_size")) or options["chunk_size"] <= 0):
+                refused = "Invalid Chunk Size"
+            if refused is not None:
+                logger.warning(f"[svr] Cannot Resume {received_datagram.filename}: {refused}")
+                ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, f"File Transfer Failed ({refused})")
+                await conn.send(QuicStreamEvent(stream_id, reply_bytes(ACK_datagram, wire_format), False))
+                return
+            resumable = await open_resumable_file(received_datagram, storage, fsync, jobs)
+            manifest = json.dumps({"received": resumable.received_ranges()})
+            MANIFEST_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_MANIFEST, manifest, filename=received_datagram.filename)
+            await conn.send(QuicStreamEvent(stream_id, reply_bytes(MANIFEST_datagram, wire_format), False))
+            logger.info(f"[svr] Sent Manifest of {received_datagram.filename}: {len(resumable.received)} of {resumable.chunk_count} Chunks Already Received")
+            received_datagram = await reassembler.read()
+
         # If START PDU is received, begin receiving file data from client
-        if received_datagram.mtype != pdu.MSG_TYPE_FILE_START:
-            print(f"[svr] Received Unexpected Message Type: {received_datagram.mtype}, Expected File START")
+        if received_datagram is None or received_datagram.mtype != pdu.MSG_TYPE_FILE_START:
+            logger.warning(f"[svr] Received Unexpected Message Type: {getattr(received_datagram, 'mtype', None)}, Expected File START")
             return
         filename = received_datagram.filename
-        print(f"[svr] Receiving File: {filename}")
-        received_files[filename] = bytearray()
+        stats.filename = filename
+        logger.info(f"[svr] Receiving File: {filename}")
+        # Stream the file to a temporary file in the established directory instead of holding it in memory
+        received_filepath = storage.filepath(filename)
+        options = received_datagram.options or {}
+        digest = options.get("digest", pdu.DIGEST_SHA256) # checksums of the chunks and of the file
+        if digest not in pdu.DIGESTS:
+            logger.warning(f"[svr] Unsupported Digest: {digest}")
+            ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, "File Transfer Failed (Unsupported Digest)")
+            await conn.send(QuicStreamEvent(stream_id, reply_bytes(ACK_datagram, wire_format), False))
+            return
+        compression = options.get("compression") # codec of the DATA PDUs sent with the compression flag
+        if compression is not None and compression not in CODECS:
+            logger.warning(f"[svr] Unsupported Compression: {compression}")
+            ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, "File Transfer Failed (Unsupported Compression)")
+            await conn.send(QuicStreamEvent(stream_id, reply_bytes(ACK_datagram, wire_format), False))
+            return
+        # Sizes and ranges that are preallocated or used to size buffers are checked first
+        refused = None
+        if options.get("resume") or options.get("delta") or "transfer_id" in options:
+            refused = check_announced_size(options, max_file_size)
+        if refused is None and "transfer_id" in options and not (options.get("resume") or options.get("delta")):
+            refused = check_announced_range(options)
+        if refused is not None:
+            logger.warning(f"[svr] Refused {filename}: {refused}")
+            ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, f"File Transfer Failed ({refused})")
+            await conn.send(QuicStreamEvent(stream_id, reply_bytes(ACK_datagram, wire_format), False))
+            return
+        # Let the client send several of its largest chunks without waiting for the receive window to grow
+        batch_size = write_batch_size(options)
+        if conn.reserve_receive_window is not None and announced_chunk_size(options) > 0:
+            conn.reserve_receive_window(RECEIVE_WINDOW_CHUNKS * announced_chunk_size(options))
+        if resumable is not None and not options.get("resume"):
+            await close_resumable_file(resumable, jobs)
+            resumable = None
+        if options.get("delta"):
+            received = await receive_delta(conn, reassembler, received_datagram, storage, wire_format, fsync, jobs, stats)
+            successful = received is not None
+            return
+        if options.get("resume"):
+            if resumable is None or resumable.filepath != received_filepath:
+                resumable = await open_resumable_file(received_datagram, storage, fsync, jobs)
+            logger.info(f"[svr] Resuming {filename}: {resumable.chunk_count - len(resumable.received)} of {resumable.chunk_count} Chunks Missing")
+        elif "transfer_id" in options:
+            transfer = get_parallel_transfer(conn.connection_id, options, storage, filename, fsync, jobs)
+            if transfer is None or not transfer.add_range(options["offset"], options["length"]):
+                transfer = None
+                logger.warning(f"[svr] Refused Range of {filename} at Offset {options['offset']}: Overlapping or Not Part of the Transfer")
+                ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, "File Transfer Failed (Invalid Range)")
+                await conn.send(QuicStreamEvent(stream_id, reply_bytes(ACK_datagram, wire_format), False))
+                return
+            range_length = options["length"]
+            try:
+                writer = (await transfer.open_sink()).range_writer(options["offset"])
+            except (OSError, ValueError) as e:
+                logger.warning(f"[svr] Cannot Store {filename}: {e}")
+                ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, "File Transfer Failed (Cannot Store File)")
+                await conn.send(QuicStreamEvent(stream_id, reply_bytes(ACK_datagram, wire_format), False))
+                return
+            logger.info(f"[svr] Receiving Range of {filename} at Offset {options['offset']}, Length: {range_length}, Transfer ID: {transfer.transfer_id}")
+        else:
+            # Creating the temporary file blocks on the disk, so a worker thread does it like for the ranges of a file
+            sink = await jobs.run_io(functools.partial(storage.open_sink, filename, fsync=fsync, batch_size=batch_size, digest=digest))
+            writer = sink
         last_sequence_number = -1 # begin tracking seq # of file chunks received
+        reorder = None # set when the client sends chunks again that the server asks for
+        if options.get("nack"):
+            reorder = ReorderBuffer(conn, stream_id, filename, wire_format, stats,
+                                    max(REORDER_BUFFER_SIZE, RECEIVE_WINDOW_CHUNKS * announced_chunk_size(options)), resumable is None)
+
+        # This function writes the next chunk of the file in order, chunks past the end of a range are dropped
+        async def write_next_chunk(chunk, checksum, sequence):
+            nonlocal last_sequence_number
+            if transfer is not None and writer.size + len(chunk) > range_length:
+                stats.unrequested_chunks += 1
+                logger.warning(f"[svr] Data Chunk Exceeds the Range! Seq #: {sequence}")
+                return
+            if transfer is None and writer.size + len(chunk) > max_file_size:
+                raise ValueError(f"File exceeds the maximum size of {max_file_size} bytes")
+            writer.write(chunk, flush=False)
+            if writer.needs_flush:
+                await jobs.run_io_timed("disk_write_seconds", "server", writer.flush) # a full batch is hashed and written by a worker
+            stats.bytes += len(chunk)
+            stats.chunks += 1
+            if debug:
+                logger.debug(f"[svr] Received Data Chunk for {filename} with Valid Checksum: {checksum[:8]}, Seq #: {sequence}")
+            last_sequence_number = sequence
+
+        # This function returns True once every chunk was received, the END PDU of the client says how many chunks it sent
+        def all_chunks_received(chunk_count):
+            if resumable is not None:
+                return resumable.is_complete()
+            return last_sequence_number + 1 >= chunk_count
+
+        # This function returns the ranges of the chunks sent before the END PDU that were never received nor asked for
+        def unrequested_chunks(chunk_count):
+            if resumable is not None:
+                return missing_sequence_ranges(resumable.received, resumable.chunk_count)
+            first = max(last_sequence_number, reorder.highest) + 1
+            return [(first, chunk_count - first)]
 
         # Loop to receive data until the END PDU is received
-        while True:
-            file_data_datagram, _ = await read_framed_datagram(conn)
+        async for file_data_datagram in reassembler:
+            # Keep an END PDU that arrives while chunks are missing, the transfer is finished once they were sent again
+            if (reorder is not None and file_data_datagram.mtype == pdu.MSG_TYPE_FILE_END and file_data_datagram.filename == filename
+                    and reorder.end is None
+                    and await reorder.wait_for_missing(file_data_datagram, all_chunks_received(file_data_datagram.sequence),
+                                                       unrequested_chunks(file_data_datagram.sequence), last_sequence_number + 1)):
+                continue
+
             # Perform checksum for validation
             if file_data_datagram.mtype == pdu.MSG_TYPE_FILE_DATA and file_data_datagram.filename == filename:
-                received_file_chunk = base64.b64decode(file_data_datagram.msg.encode("ascii")) # Convert from base64 string to original bytes
-                received_checksum = file_data_datagram.checksum
-                calculated_checksum = hashlib.sha256(received_file_chunk).hexdigest()
                 sequence_number = file_data_datagram.sequence
+                received_file_chunk = decode_file_chunk(file_data_datagram.msg) # Base64 text or raw bytes depending on the wire format
+                if file_data_datagram.compressed:
+                    received_file_chunk = await decompress_received_chunk(received_file_chunk, compression, options, jobs)
+                    if received_file_chunk is not None:
+                        stats.saved_bytes += len(received_file_chunk) - len(file_data_datagram.msg)
+                received_checksum = file_data_datagram.checksum
+                calculated_checksum = None # not computed for a chunk that cannot be decompressed
+                if received_file_chunk is not None:
+                    calculated_checksum = await jobs.hexdigest(received_file_chunk, digest, role="server")
 
                 # Verify checksums and sequence
-                if calculated_checksum == received_checksum:
-                    if sequence_number == last_sequence_number + 1:
-                        received_files[filename].extend(received_file_chunk)
-                        print(f"[svr] Received Data Chunk for {filename} with Valid Checksum: {calculated_checksum[:8]}, Seq #: {sequence_number}")
-                        last_sequence_number = sequence_number
+                if calculated_checksum is None:
+                    stats.checksum_failures += 1
+                    if reorder is not None:
+                        await reorder.reject(sequence_number, last_sequence_number + 1)
+                elif calculated_checksum == received_checksum:
+                    if resumable is not None:
+                        # Chunks of a resumed transfer are written at their offset, so gaps are expected
+                        if resumable.write_chunk(sequence_number, received_file_chunk, calculated_checksum, flush=False):
+                            if resumable.needs_flush:
+                                await jobs.run_io_timed("disk_write_seconds", "server", resumable.flush)
+                            stats.bytes += len(received_file_chunk)
+                            stats.chunks += 1
+                            if debug:
+                                logger.debug(f"[svr] Received Data Chunk for {filename} with Valid Checksum: {calculated_checksum[:8]}, Seq #: {sequence_number}")
+                        elif sequence_number in resumable.received:
+                            stats.duplicate_chunks += 1
+                            logger.warning(f"[svr] Data Chunk Already Received! Seq #: {sequence_number}")
+                        else:
+                            stats.unrequested_chunks += 1
+                            logger.warning(f"[svr] Data Chunk Out of Range! Seq #: {sequence_number}")
+                    elif sequence_number == last_sequence_number + 1:
+                        await write_next_chunk(received_file_chunk, calculated_checksum, sequence_number)
+                        # Write the chunks that arrived early and were waiting for this one, then ask for the ones that did not fit
+                        if reorder is not None:
+                            while (held := reorder.take(last_sequence_number + 1)) is not None:
+                                await write_next_chunk(*held, last_sequence_number + 1)
+                            await reorder.request_dropped(last_sequence_number + 1)
+                    elif reorder is not None and sequence_number > last_sequence_number + 1:
+                        await reorder.hold(sequence_number, received_file_chunk, calculated_checksum, last_sequence_number + 1)
+                    elif reorder is not None:
+                        stats.duplicate_chunks += 1 # a chunk sent again after it was received
+                        if debug:
+                            logger.debug(f"[svr] Data Chunk Already Received! Seq #: {sequence_number}")
                     else:
-                        print(f"[svr] Sequence Out of Order! Expected Seq #: {last_sequence_number + 1}")
+                        stats.out_of_order += 1
+                        logger.warning(f"[svr] Sequence Out of Order! Expected Seq #: {last_sequence_number + 1}")
                 else:
-                    print(f"[svr] Received Data Chunk for {filename} With Invalid Checksum!") 
-                    print(f"[svr] Expected: {received_checksum[:8]}, Got: {calculated_checksum[:8]}")
+                    stats.checksum_failures += 1
+                    logger.warning(f"[svr] Received Data Chunk for {filename} With Invalid Checksum!")
+                    logger.warning(f"[svr] Expected: {received_checksum[:8]}, Got: {calculated_checksum[:8]}")
+                    if reorder is not None:
+                        await reorder.reject(sequence_number, last_sequence_number + 1)
+
+                # Finish the transfer with the kept END PDU once the chunks it waited for arrived
+                if reorder is None or reorder.end is None or reorder.waiting(all_chunks_received(reorder.end.sequence)):
+                    continue
+                file_data_datagram = reorder.end
             
-            # Store the contents of the file in the established directory        
+            # Save a resumed file once every chunk was received, otherwise keep it for the next attempt
+            if file_data_datagram.mtype == pdu.MSG_TYPE_FILE_END and file_data_datagram.filename == filename and resumable is not None:
+                client_overall_checksum = file_data_datagram.checksum
+                if not resumable.is_complete():
+                    logger.warning(f"[svr] File Incomplete! Missing {resumable.chunk_count - len(resumable.received)} Chunks, Kept to Resume the Transfer")
+                    ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, "File Transfer Failed (Missing Chunks)")
+                else:
+                    server_overall_checksum = await jobs.run_io(resumable.hexdigest)
+                    if server_overall_checksum == client_overall_checksum:
+                        await jobs.run_io_timed("disk_write_seconds", "server", resumable.commit)
+                        logger.info(f"[svr] File Received and Saved to {received_filepath}, Total Size: {resumable.size} bytes")
+                        logger.info(f"[svr] Overall Checksums Match! Client: {client_overall_checksum[:8]}, Server: {server_overall_checksum[:8]}")
+                        ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, "File Transfer Successful (Checksum Verified)")
+                        successful = True
+                        received = ReceivedFile(filename, received_filepath, resumable.size, server_overall_checksum, digest)
+                    else:
+                        await jobs.run_io(resumable.abort) # the file changed on the client, so the next attempt starts over
+                        logger.warning(f"[svr] Overall Checksums Mismatch! Client: {client_overall_checksum[:8]}, Server: {server_overall_checksum[:8]}")
+                        ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, "File Transfer Failed (Checksum Mismatch)")
+                await conn.send(QuicStreamEvent(stream_id, reply_bytes(ACK_datagram, wire_format), False))
+                break
+
+            # Verify a range on its own, the file is saved when its last range is verified
+            elif file_data_datagram.mtype == pdu.MSG_TYPE_FILE_END and file_data_datagram.filename == filename and transfer is not None:
+                await jobs.run_io_timed("disk_write_seconds", "server", writer.flush)
+                verified = writer.hexdigest() == file_data_datagram.checksum and writer.size == range_length
+                range_finished = True
+                if await transfer.finish_range(range_length, verified, jobs):
+                    logger.info(f"[svr] File Received and Saved to {received_filepath}, Total Size: {options['size']} bytes")
+                    received = ReceivedFile(filename, received_filepath, options["size"], None, digest) # the ranges were verified separately
+                if verified:
+                    logger.info(f"[svr] Range Checksums Match! Client: {file_data_datagram.checksum[:8]}, Server: {writer.hexdigest()[:8]}")
+                    ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, "File Transfer Successful (Checksum Verified)")
+                    successful = True
+                else:
+                    logger.warning(f"[svr] Range Checksums Mismatch! Client: {file_data_datagram.checksum[:8]}, Server: {writer.hexdigest()[:8]}")
+                    ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, "File Transfer Failed (Checksum Mismatch)")
+                await conn.send(QuicStreamEvent(stream_id, reply_bytes(ACK_datagram, wire_format), False))
+                break
+
+            # Move the completed file to its final name in the established directory, once it is verified
             elif file_data_datagram.mtype == pdu.MSG_TYPE_FILE_END and file_data_datagram.filename == filename:
-                file_content = received_files[filename]
-                split_name = os.path.splitext(filename) # split file name and extensions if presents
-                modified_filename = f"{split_name[0]}_svr{split_name[1]}"
-                received_filepath = os.path.join(SERVER_FILES_DIRECTORY, modified_filename)
-                
                 # Make sure the file is saved properly
                 try:
-                    with open(received_filepath, "wb") as f:
-                        f.write(file_content)
-                    print(f"[svr] File Received and Saved to {received_filepath}, Total Size: {len(file_content)} bytes")
-                    
-                    # Verify the checksum of entire file from both sides
+                    # Verify the checksum of entire file from both sides, the server side is updated as chunks are written
                     client_overall_checksum = file_data_datagram.checksum
-                    server_overall_checksum = await calculate_checksum(received_filepath)
+                    server_overall_checksum = await jobs.run_io_timed("disk_write_seconds", "server", sink.hexdigest) # writes the last batch
                     if server_overall_checksum == client_overall_checksum:
-                        print(f"[svr] Overall Checksums Match! Client: {client_overall_checksum[:8]}, Server: {server_overall_checksum[:8]}")
+                        await jobs.run_io_timed("disk_write_seconds", "server", sink.commit)
+                        logger.info(f"[svr] File Received and Saved to {received_filepath}, Total Size: {sink.size} bytes")
+                        logger.info(f"[svr] Overall Checksums Match! Client: {client_overall_checksum[:8]}, Server: {server_overall_checksum[:8]}")
                         ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, "File Transfer Successful (Checksum Verified)")
+                        successful = True
+                        received = ReceivedFile(filename, received_filepath, sink.size, server_overall_checksum, digest)
                     else:
-                        print(f"[svr] Overall Checksums Mismatch! Client: {client_overall_checksum[:8]}, Server: {server_overall_checksum[:8]}")
+                        await jobs.run_io(sink.abort) # the file is not stored under its final name
+                        logger.warning(f"[svr] Overall Checksums Mismatch! Client: {client_overall_checksum[:8]}, Server: {server_overall_checksum[:8]}")
                         ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, "File Transfer Failed (Checksum Mismatch)")
-                    ACK_event = QuicStreamEvent(stream_id, ACK_datagram.to_bytes(), False)
+                    ACK_event = QuicStreamEvent(stream_id, reply_bytes(ACK_datagram, wire_format), False)
                     await conn.send(ACK_event)
                 except:
-                    print(f"[svr] Error saving file!")
+                    logger.error(f"[svr] Error saving file!")
                     ACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_ACK, f"Error saving file!")
-                    ACK_event = QuicStreamEvent(stream_id, ACK_datagram.to_bytes, False)
+                    ACK_event = QuicStreamEvent(stream_id, reply_bytes(ACK_datagram, wire_format), False)
                     await conn.send(ACK_event)
                 break
             else:
-                print(f"[svr] Unexpected PDU Type: {file_data_datagram.mtype}")
+                logger.warning(f"[svr] Unexpected PDU Type: {file_data_datagram.mtype}")
                 break
     except:
-        print("[svr] File Transfer Failed!")
+        logger.error("[svr] File Transfer Failed!")
+    finally:
+        metrics.finish_stream(stats, successful)
+        if sink is not None:
+            sink.abort() # removes the temporary file unless it was committed
+        if transfer is not None and not range_finished:
+            await transfer.finish_range(range_length, False, jobs) # the whole file is discarded once its other ranges end
+        if resumable is not None:
+            await close_resumable_file(resumable, jobs) # keeps the chunks received so far for the next attempt
+        if received is not None:
+            await notify_file_complete(scope, received)
 
-    print("[svr] Ending File Transfer...")
+    logger.info("[svr] Ending File Transfer...")
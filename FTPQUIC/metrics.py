@@ -0,0 +1,331 @@
+"""
+This Python file houses the metrics of the client and server
+Every stream counts its bytes, chunks, checksum failures and dropped chunks with plain attribute updates,
+which are added to the totals of the process when the stream ends, so counting costs almost nothing per chunk.
+Timings of hashing, decoding and disk writes are kept in histograms, jobs of the worker threads and processes are
+timed in the worker, without the time they waited in the queue. The metrics can be served in the
+Prometheus text format over HTTP, or written to a JSON file.
+The worker processes of a multi-process server send their metrics to the parent process, which exports their sum.
+"""
+
+import asyncio
+import bisect
+import collections
+import json
+import os
+import threading
+import time
+
+METRIC_PREFIX = "ftquic"
+
+# Upper bounds of the histogram buckets in seconds
+HISTOGRAM_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+FINISHED_CONNECTIONS = 100 # number of closed connections kept in the JSON dump
+DEFAULT_DUMP_INTERVAL = 10.0 # seconds between two JSON dumps
+
+# Counters of every stream, in the order they are exported
+STREAM_COUNTERS = ("bytes", "chunks", "checksum_failures", "out_of_order", "duplicate_chunks", "unrequested_chunks",
+                   "saved_bytes", "retransmitted_chunks")
+
+# Descriptions of the exported metrics
+METRIC_HELP = {
+    "bytes_total": "File bytes sent or received, by uploads and downloads",
+    "chunks_total": "File chunks sent or received, by uploads and downloads",
+    "checksum_failures_total": "Received chunks whose checksum did not match",
+    "saved_bytes_total": "File bytes that were not sent or received thanks to the compression of chunks",
+    "retransmitted_chunks_total": "Chunks asked for again with NACK PDUs by the server, and sent again by the client",
+    "out_of_order_total": "Received chunks dropped because they arrived out of order, without NACK PDUs to ask for the missing ones",
+    "duplicate_chunks_total": "Received chunks dropped because they were already received",
+    "unrequested_chunks_total": "Received chunks dropped because they were not asked for, or were past the end of the file or range",
+    "transfers_total": "Finished file transfers by result",
+    "connections_total": "Opened QUIC connections",
+    "open_connections": "QUIC connections that are open",
+    "forwarded_datagrams_total": "Datagrams a server worker forwarded to the worker that has their connection",
+    "handshakes_total": "Completed TLS handshakes by result: full, resumed with a session ticket, or with accepted 0-RTT data",
+    "transfer_duration_seconds": "Duration of the file transfers",
+    "hash_seconds": "Time spent computing checksums",
+    "compress_seconds": "Time spent compressing and decompressing file chunks",
+    "decode_seconds": "Time spent parsing received datagrams",
+    "disk_write_seconds": "Time spent writing and saving received files",
+}
+
+# Keeps the distribution of timings in cumulative buckets, like a Prometheus histogram
+class Histogram:
+    def __init__(self, buckets = HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last bucket has no upper bound
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # Returns the number of observations at or below every bucket bound
+    def cumulative(self):
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum,
+                "buckets": {("+Inf" if bound == float("inf") else str(bound)): count for bound, count in self.cumulative()}}
+
+# Counters of one stream, updated by the protocol handler that owns the stream
+class StreamStats:
+    def __init__(self, connection_id, stream_id, role):
+        self.connection_id = connection_id
+        self.stream_id = stream_id
+        self.role = role
+        self.filename = None
+        self.bytes = 0
+        self.chunks = 0
+        self.checksum_failures = 0
+        self.out_of_order = 0
+        self.duplicate_chunks = 0
+        self.unrequested_chunks = 0
+        self.saved_bytes = 0
+        self.retransmitted_chunks = 0
+        self.started = time.perf_counter()
+        self.duration = None
+        self.successful = None
+
+    def to_dict(self):
+        fields = {counter: getattr(self, counter) for counter in STREAM_COUNTERS}
+        fields.update(stream_id=self.stream_id, filename=self.filename, successful=self.successful,
+                      duration=self.duration if self.duration is not None else time.perf_counter() - self.started)
+        return fields
+
+# Measures the time of a block of code and adds it to a histogram
+class Timer:
+    def __init__(self, metrics, name, role):
+        self.metrics = metrics
+        self.name = name
+        self.role = role
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, self.role)
+        return False
+
+"""
+This class is the registry of the counters and histograms of the process
+Metrics are labelled by role ('client' or 'server'), and the streams of every open connection are kept,
+so the JSON dump shows the counters per connection and per stream.
+Histograms can be updated from worker threads, so they are protected by a lock.
+"""
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = collections.Counter() # (name, role, result) -> value
+        self._histograms = {} # (name, role) -> Histogram
+        self._connections = {} # connection ID -> {"role", "started", "streams": {stream ID: StreamStats}}
+        self._finished_connections = collections.deque(maxlen=FINISHED_CONNECTIONS)
+        self._worker_connections = [] # open connections of the worker processes, added with add_state()
+
+    def inc(self, name, value = 1, role = "", result = ""):
+        with self._lock:
+            self._counters[(name, role, result)] += value
+
+    def observe(self, name, value, role = ""):
+        with self._lock:
+            histogram = self._histograms.get((name, role))
+            if histogram is None:
+                histogram = self._histograms[(name, role)] = Histogram()
+            histogram.observe(value)
+
+    # Returns a context manager that adds the time spent in its block to a histogram
+    def timer(self, name, role = ""):
+        return Timer(self, name, role)
+
+    def open_connection(self, connection_id, role):
+        self._connections[connection_id] = {"role": role, "started": time.time(), "streams": {}}
+        self.inc("connections_total", role=role)
+
+    def close_connection(self, connection_id):
+        connection = self._connections.pop(connection_id, None)
+        if connection is not None:
+            self._finished_connections.append(self._connection_dict(connection_id, connection))
+
+    # Returns the counters of a new stream, which are added to the totals by finish_stream()
+    def open_stream(self, connection_id, stream_id, role):
+        stats = StreamStats(connection_id, stream_id, role)
+        connection = self._connections.get(connection_id)
+        if connection is not None:
+            connection["streams"][stream_id] = stats
+        return stats
+
+    def finish_stream(self, stats, successful):
+        if stats.duration is not None:
+            return
+        stats.duration = time.perf_counter() - stats.started
+        stats.successful = successful
+        with self._lock:
+            for counter in STREAM_COUNTERS:
+                self._counters[(f"{counter}_total", stats.role, "")] += getattr(stats, counter)
+            self._counters[("transfers_total", stats.role, "success" if successful else "failure")] += 1
+        self.observe("transfer_duration_seconds", stats.duration, stats.role)
+        connection = self._connections.get(stats.connection_id)
+        if connection is not None:
+            connection.setdefault("finished", collections.Counter()).update(
+                {counter: getattr(stats, counter) for counter in STREAM_COUNTERS})
+            connection["streams"].pop(stats.stream_id, None)
+
+    # Returns the counters, including what the streams that did not end yet counted so far
+    def counters(self):
+        with self._lock:
+            counters = collections.Counter(self._counters)
+        for connection in list(self._connections.values()):
+            for stats in list(connection["streams"].values()):
+                if stats.duration is None:
+                    for counter in STREAM_COUNTERS:
+                        counters[(f"{counter}_total", stats.role, "")] += getattr(stats, counter)
+        for role in {role for name, role, _ in counters if name == "connections_total"}:
+            counters[("open_connections", role, "")] += sum(1 for connection in self._connections.values() if connection["role"] == role)
+        return counters
+
+    def _connection_dict(self, connection_id, connection):
+        totals = collections.Counter(connection.get("finished", {}))
+        streams = [stats.to_dict() for stats in list(connection["streams"].values())]
+        for stream in streams:
+            totals.update({counter: stream[counter] for counter in STREAM_COUNTERS})
+        return {"connection_id": connection_id, "role": connection["role"], "started": connection["started"],
+                "totals": {counter: totals[counter] for counter in STREAM_COUNTERS}, "open_streams": streams}
+
+    # Returns every metric in the Prometheus text exposition format
+    def to_prometheus(self):
+        lines = []
+        by_name = collections.defaultdict(list)
+        for (name, role, result), value in sorted(self.counters().items()):
+            by_name[name].append((role, result, value))
+        for name, samples in by_name.items():
+            metric = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# HELP {metric} {METRIC_HELP.get(name, name)}")
+            lines.append(f"# TYPE {metric} {'gauge' if name == 'open_connections' else 'counter'}")
+            for role, result, value in samples:
+                labels = f'role="{role}"' + (f',result="{result}"' if result else "")
+                lines.append(f"{metric}{{{labels}}} {value}")
+        with self._lock:
+            histograms = {key: (histogram.cumulative(), histogram.sum, histogram.count) for key, histogram in self._histograms.items()}
+        by_name = collections.defaultdict(list)
+        for (name, role), histogram in sorted(histograms.items()):
+            by_name[name].append((role, histogram))
+        for name, samples in by_name.items():
+            metric = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# HELP {metric} {METRIC_HELP.get(name, name)}")
+            lines.append(f"# TYPE {metric} histogram")
+            for role, (buckets, total, count) in samples:
+                for bound, bucket_count in buckets:
+                    bound = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{metric}_bucket{{role="{role}",le="{bound}"}} {bucket_count}')
+                lines.append(f'{metric}_sum{{role="{role}"}} {total}')
+                lines.append(f'{metric}_count{{role="{role}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    # Returns every metric, and the counters of the open and recently closed connections, as a dictionary
+    def to_json(self):
+        counters = collections.defaultdict(dict)
+        for (name, role, result), value in sorted(self.counters().items()):
+            counters[name][f"{role}/{result}" if result else role] = value
+        with self._lock:
+            histograms = {f"{name}/{role}": histogram.to_dict() for (name, role), histogram in sorted(self._histograms.items())}
+        return {
+            "time": time.time(),
+            "counters": counters,
+            "histograms": histograms,
+            "connections": [self._connection_dict(connection_id, connection) for connection_id, connection in list(self._connections.items())]
+                           + self._worker_connections,
+            "closed_connections": list(self._finished_connections),
+        }
+
+    # Returns the counters, histograms and connections as plain values, which can be sent to another process
+    def state(self):
+        with self._lock:
+            histograms = {key: (list(histogram.counts), histogram.count, histogram.sum) for key, histogram in self._histograms.items()}
+        return {
+            "counters": dict(self.counters()),
+            "histograms": histograms,
+            "connections": [self._connection_dict(connection_id, connection) for connection_id, connection in list(self._connections.items())],
+            "closed_connections": list(self._finished_connections),
+        }
+
+    # Adds the state() of another registry to this one, the connections are labelled with the worker that has them
+    def add_state(self, state, worker = None):
+        with self._lock:
+            self._counters.update(state["counters"])
+            for key, (counts, count, total) in state["histograms"].items():
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram()
+                histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                histogram.count += count
+                histogram.sum += total
+        for key in ("connections", "closed_connections"):
+            connections = [dict(connection, worker=worker) for connection in state[key]]
+            if key == "connections":
+                self._worker_connections.extend(connections)
+            else:
+                self._finished_connections.extend(connections)
+
+    # This function writes the JSON dump to a file, replacing it atomically
+    def write_json(self, path):
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.to_json(), f, indent=2)
+        os.replace(temp_path, path)
+
+# Metrics of this process
+metrics = Metrics()
+
+# Keeps the latest metrics of every worker process of a server, and exports their sum
+class WorkerMetrics:
+    def __init__(self):
+        self.states = {} # worker index -> last state() received from the worker
+
+    def update(self, worker, state):
+        self.states[worker] = state
+
+    def merged(self):
+        merged = Metrics()
+        for worker, state in sorted(self.states.items()):
+            merged.add_state(state, worker)
+        return merged
+
+    def to_prometheus(self):
+        return self.merged().to_prometheus()
+
+    def write_json(self, path):
+        self.merged().write_json(path)
+
+# This function serves the metrics of 'source' in the Prometheus text format over HTTP, at any path
+async def serve_metrics(host, port, source = metrics):
+    async def handle(reader, writer):
+        try:
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""): # skip the request and its headers
+                pass
+            body = source.to_prometheus().encode("utf-8")
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         + f"Content-Length: {len(body)}\r\n\r\n".encode("ascii") + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+# This function writes the JSON dump of 'source' to a file every 'interval' seconds, and once more when it is cancelled
+async def dump_metrics_periodically(path, interval = DEFAULT_DUMP_INTERVAL, source = metrics):
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            source.write_json(path)
+    finally:
+        source.write_json(path)
@@ -0,0 +1,175 @@
+"""
+This Python file houses microbenchmarks for the hot paths of the protocol
+Usage:
+python3 microbench.py pdu
+python3 microbench.py receive
+python3 microbench.py queue
+"""
+
+import argparse
+import asyncio
+import hashlib
+import os
+import time
+import tracemalloc
+from aioquic.quic.events import StreamDataReceived
+import pdu
+from ft_quic import FTQuicConnection, QuicStreamEvent
+from quic_engine import FTServerRequestHandler, StreamEventQueue
+from utils import encode_file_chunk, decode_file_chunk, FrameReassembler
+
+# This function times a callable over a number of rounds and returns the elapsed seconds
+def time_rounds(func, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return time.perf_counter() - start
+
+# This function compares encode/decode throughput of a FILE_DATA datagram in both wire formats
+def bench_pdu(chunk_size, rounds):
+    file_chunk = os.urandom(chunk_size)
+    chunk_checksum = hashlib.sha256(file_chunk).hexdigest()
+    results = {}
+    for name, wire_format in (("json", pdu.WIRE_FORMAT_JSON), ("binary", pdu.WIRE_FORMAT_BINARY)):
+        def encode():
+            datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_DATA, encode_file_chunk(file_chunk, wire_format),
+                                    filename="bench_file", checksum=chunk_checksum, sequence=1)
+            return datagram.to_framed_bytes(wire_format)
+
+        framed = encode()
+        def decode():
+            datagram, _ = pdu.Datagram.from_framed_bytes(memoryview(framed))
+            return decode_file_chunk(datagram.msg)
+
+        assert bytes(decode()) == file_chunk
+        encode_seconds = time_rounds(encode, rounds)
+        decode_seconds = time_rounds(decode, rounds)
+        megabytes = chunk_size * rounds / 1e6
+        results[name] = {
+            "wire_bytes": len(framed),
+            "encode_mb_s": megabytes / encode_seconds,
+            "decode_mb_s": megabytes / decode_seconds,
+        }
+        print(f"[bench] {name:>6}: {len(framed)} bytes on the wire, "
+              f"encode {results[name]['encode_mb_s']:.1f} MB/s, decode {results[name]['decode_mb_s']:.1f} MB/s")
+    return results
+
+# This function returns the bytes allocated per object by 'create', measured on 'count' objects kept alive at once
+def allocated_bytes(create, count = 1000):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        objects = [create() for _ in range(count)]
+        allocated = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del objects
+    return allocated / count
+
+"""
+This function measures the receive path of a chunk on the server: a QUIC event goes through the queue of the
+request handler and is parsed into a FILE_DATA datagram, as ft_server_proto does for every chunk.
+It prints the time per chunk and the bytes allocated for each queued event and parsed datagram, which stay
+alive while a chunk waits in the queue or is being written.
+"""
+def bench_receive(chunk_size, rounds):
+    file_chunk = os.urandom(chunk_size)
+    DATA_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_DATA, file_chunk, filename="bench_file",
+                                 checksum=hashlib.sha256(file_chunk).hexdigest(), sequence=1)
+    framed = DATA_datagram.to_framed_bytes(pdu.WIRE_FORMAT_BINARY)
+    event = StreamDataReceived(data=framed, end_stream=False, stream_id=0)
+    handler = FTServerRequestHandler(authority=None, connection=None, protocol=None, scope={},
+                                     stream_ended=False, stream_id=0, transmit=None)
+    reassembler = FrameReassembler(FTQuicConnection(None, handler.receive, None, None))
+
+    async def receive_chunks():
+        for _ in range(rounds):
+            handler.quic_event_received(event)
+            datagram = await reassembler.read()
+        return datagram
+
+    start = time.perf_counter()
+    datagram = asyncio.run(receive_chunks())
+    seconds = time.perf_counter() - start
+    assert bytes(datagram.msg) == file_chunk
+
+    view = memoryview(framed)
+    event_bytes = allocated_bytes(lambda: QuicStreamEvent(event.stream_id, event.data, event.end_stream))
+    datagram_bytes = allocated_bytes(lambda: pdu.Datagram.from_framed_bytes(view)[0])
+    results = {
+        "us_per_chunk": seconds / rounds * 1e6,
+        "event_bytes": event_bytes,
+        "datagram_bytes": datagram_bytes,
+    }
+    print(f"[bench] receive: {results['us_per_chunk']:.2f} us per {chunk_size}-byte chunk, "
+          f"{event_bytes:.0f} bytes per queued event, {datagram_bytes:.0f} bytes per parsed datagram")
+    return results
+
+# Counts the streams a StreamEventQueue pauses and resumes, in place of the protocol of a connection
+class PauseCounter:
+    def __init__(self):
+        self.pauses = 0
+        self.resumes = 0
+
+    def pause_stream(self, stream_id):
+        self.pauses += 1
+
+    def resume_stream(self, stream_id):
+        self.resumes += 1
+
+"""
+This function compares the receive queue of the request handlers with the unbounded asyncio.Queue it replaced
+Events of 'chunk_size' bytes are queued one at a time and in bursts of 'burst' events, which the reader then drains.
+It prints the time per event and, for the bounded queue, how many times the stream was paused: while it is paused
+the peer stops sending, where the asyncio.Queue kept every byte the peer sent.
+"""
+def bench_queue(chunk_size, rounds, burst = 2048):
+    event = QuicStreamEvent(0, os.urandom(chunk_size), False)
+    counter = PauseCounter()
+    queues = {"asyncio.Queue": asyncio.Queue, "StreamEventQueue": lambda: StreamEventQueue(counter)}
+    results = {}
+    for name, create in queues.items():
+        async def run_queue():
+            queue = create()
+            start = time.perf_counter()
+            for _ in range(rounds):
+                queue.put_nowait(event)
+                await queue.get()
+            single = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(rounds // burst):
+                for _ in range(burst):
+                    queue.put_nowait(event)
+                for _ in range(burst):
+                    await queue.get()
+            return single, time.perf_counter() - start
+
+        counter.pauses = counter.resumes = 0
+        single, bursts = asyncio.run(run_queue())
+        results[name] = {
+            "us_per_event": single / rounds * 1e6,
+            "us_per_burst_event": bursts / max(1, rounds // burst * burst) * 1e6,
+            "pauses": counter.pauses if name == "StreamEventQueue" else None,
+        }
+        paused = f", stream paused {counter.pauses} times" if name == "StreamEventQueue" else ""
+        print(f"[bench] {name:>16}: {results[name]['us_per_event']:.2f} us per event, "
+              f"{results[name]['us_per_burst_event']:.2f} us per event in bursts of {burst} "
+              f"({burst * chunk_size // 1024} KB){paused}")
+    return results
+
+BENCHMARKS = {
+    "pdu": bench_pdu,
+    "receive": bench_receive,
+    "queue": bench_queue,
+}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Microbenchmarks for File Transfer over QUIC')
+    parser.add_argument('benchmark', choices=BENCHMARKS.keys(), help='Benchmark to run')
+    parser.add_argument('--chunk-size', type=int, default=4096, help='Size of the file chunk in bytes')
+    parser.add_argument('--rounds', type=int, default=20000, help='Number of iterations')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    BENCHMARKS[args.benchmark](args.chunk_size, args.rounds)
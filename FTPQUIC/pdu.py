@@ -1,3 +1,4 @@
+import hashlib
 import json
 import struct # library used for interpreting bytes as binary data
 
@@ -10,54 +11,263 @@ MSG_TYPE_FILE_START = 0x02
 MSG_TYPE_FILE_DATA = 0x03
 MSG_TYPE_FILE_END = 0x04
 MSG_TYPE_FILE_ACK = 0x05
+MSG_TYPE_FILE_QUERY = 0x06 # asks which chunks of a file the server already has, to resume a transfer
+MSG_TYPE_FILE_MANIFEST = 0x07 # reply to FILE_QUERY with the received chunk ranges
+MSG_TYPE_CHUNK_LIST = 0x08 # lengths and checksums of the content-defined chunks of a file, for delta transfers
+MSG_TYPE_CHUNK_HAVE = 0x09 # reply to CHUNK_LIST with a bitmap of the chunks the server already stores
+MSG_TYPE_FILE_LIST = 0x0A # asks for the files stored on the server, optionally only those under a path prefix
+MSG_TYPE_FILE_GET = 0x0B # asks the server to send a stored file, or the byte range of it given in the options
+MSG_TYPE_FILE_STAT = 0x0C # asks for the size and modification time of a stored file
+MSG_TYPE_FILE_INFO = 0x0D # reply to FILE_LIST and FILE_STAT with a JSON list of files
+MSG_TYPE_FILE_NACK = 0x0E # asks the client to send chunks again, its sequence is the next chunk expected in order
+
+# Digests that can be negotiated with the 'digest' option of the START PDU for the chunk and file checksums
+# SHA-256 is the default, BLAKE2b (with a 32-byte digest) is faster on CPUs without SHA extensions
+DIGEST_SHA256 = "sha256"
+DIGEST_BLAKE2B = "blake2b"
+DIGESTS = {
+    DIGEST_SHA256: hashlib.sha256,
+    DIGEST_BLAKE2B: lambda data=b"": hashlib.blake2b(data, digest_size=32),
+}
+
+# This function returns a new hash object of a negotiated digest, optionally updated with 'data'
+def new_digest(digest = DIGEST_SHA256, data = b""):
+    if digest not in DIGESTS:
+        raise ValueError(f"Unsupported digest: {digest}")
+    return DIGESTS[digest](data)
 
 # Constant for the length prefix for the framed message
 LENGTH_PREFIX_SIZE = 4
 
+# Wire formats for a datagram: the original JSON text encoding and the versioned binary encoding
+# The binary format starts with its version byte, while a JSON datagram always starts with '{'
+WIRE_FORMAT_JSON = 0x01
+WIRE_FORMAT_BINARY = 0x02
+
+"""
+Fixed header of the binary wire format, followed by the variable length fields in this order:
+[filename (UTF-8)] [checksum (raw digest bytes)] [options (only with FLAG_HAS_OPTIONS)] [payload (raw bytes)]
+Options are encoded as [2-byte length] [JSON object]
+Header Format:
+[1-byte version] [1-byte type] [1-byte flags] [1-byte checksum length]
+[8-byte sequence] [4-byte payload length] [2-byte filename length]
+"""
+BINARY_HEADER = struct.Struct(">BBBBQIH")
+BINARY_HEADER_SIZE = BINARY_HEADER.size
+
+# Flags of the binary header
+FLAG_MSG_TEXT = 0x01 # payload is a UTF-8 string instead of raw bytes
+FLAG_HAS_FILENAME = 0x02
+FLAG_HAS_CHECKSUM = 0x04
+FLAG_CHECKSUM_TEXT = 0x08 # checksum is a UTF-8 string that is not a hexadecimal digest
+FLAG_HAS_OPTIONS = 0x10
+FLAG_COMPRESSED = 0x20 # payload is a chunk compressed with the codec negotiated in the START PDU
+
+OPTIONS_LENGTH = struct.Struct(">H")
+
+# A CHUNK_LIST payload is a sequence of records: [4-byte chunk length] [32-byte raw SHA-256 of the chunk]
+CHUNK_RECORD = struct.Struct(">I32s")
+CHUNK_RECORDS_PER_LIST = 1024 # records sent in one CHUNK_LIST datagram
+
+# This function packs (length, hexadecimal checksum) pairs into a CHUNK_LIST payload
+def pack_chunk_records(records):
+    return b"".join(CHUNK_RECORD.pack(length, bytes.fromhex(checksum)) for length, checksum in records)
+
+# This function unpacks a CHUNK_LIST payload into (length, hexadecimal checksum) pairs
+def unpack_chunk_records(payload):
+    if len(payload) % CHUNK_RECORD.size:
+        raise ValueError("CHUNK_LIST payload is not a whole number of records")
+    return [(length, digest.hex()) for length, digest in CHUNK_RECORD.iter_unpack(payload)]
+
+# A FILE_NACK payload is a sequence of ranges of sequence numbers: [8-byte first sequence] [4-byte count]
+SEQUENCE_RANGE = struct.Struct(">QI")
+
+# This function packs (first sequence, count) pairs into a FILE_NACK payload
+def pack_sequence_ranges(ranges):
+    return b"".join(SEQUENCE_RANGE.pack(first, count) for first, count in ranges)
+
+# This function unpacks a FILE_NACK payload into (first sequence, count) pairs
+def unpack_sequence_ranges(payload):
+    if len(payload) % SEQUENCE_RANGE.size:
+        raise ValueError("FILE_NACK payload is not a whole number of ranges")
+    return list(SEQUENCE_RANGE.iter_unpack(payload))
+
+# This function packs a list of booleans into a CHUNK_HAVE bitmap, the first chunk is the highest bit of the first byte
+def pack_bitmap(flags):
+    bitmap = bytearray(-(-len(flags) // 8))
+    for index, flag in enumerate(flags):
+        if flag:
+            bitmap[index >> 3] |= 0x80 >> (index & 7)
+    return bytes(bitmap)
+
+# This function unpacks the first 'count' flags of a CHUNK_HAVE bitmap
+def unpack_bitmap(bitmap, count):
+    if len(bitmap) * 8 < count:
+        raise ValueError("CHUNK_HAVE bitmap is shorter than the chunk list")
+    return [bool(bitmap[index >> 3] & (0x80 >> (index & 7))) for index in range(count)]
+
 # Updated class to include filename, checksum, and sequence number as fields
+# 'options' holds the settings of a transfer negotiated in the START PDU, such as the byte range of a parallel transfer
+# 'compressed' is set on DATA PDUs whose payload is compressed, their checksum is the checksum of the uncompressed chunk
 class Datagram:
-    def __init__(self, mtype: int, msg: str, size:int = 0, filename: str = None, checksum: str = None, sequence: int = 0):
+    __slots__ = ("mtype", "msg", "size", "filename", "checksum", "sequence", "options", "compressed") # one is created for every chunk
+
+    def __init__(self, mtype: int, msg: str, size:int = 0, filename: str = None, checksum: str = None, sequence: int = 0,
+                 options: dict = None, compressed: bool = False):
         self.mtype = mtype
         self.msg = msg
         self.size = len(self.msg)
         self.filename = filename
         self.checksum = checksum
         self.sequence = sequence
-        
+        self.options = options
+        self.compressed = compressed
+
+    # Options and the compression flag are left out when they are not used, so the JSON stays readable by peers that do not know them
+    def _json_fields(self):
+        fields = {name: getattr(self, name) for name in Datagram.__slots__}
+        if fields["options"] is None:
+            del fields["options"]
+        if not fields["compressed"]:
+            del fields["compressed"]
+        return fields
+
     def to_json(self):
-        return json.dumps(self.__dict__)    
-    
+        return json.dumps(self._json_fields())
+
     @staticmethod
     def from_json(json_str):
         return Datagram(**json.loads(json_str))
-    
-    def to_bytes(self):
-        return json.dumps(self.__dict__).encode('utf-8')
-    
+
+    def to_bytes(self, wire_format: int = WIRE_FORMAT_JSON):
+        if wire_format == WIRE_FORMAT_BINARY:
+            return b"".join(self._binary_parts())
+        return json.dumps(self._json_fields()).encode('utf-8')
+
+    # This function detects the wire format from the first byte, so both formats can be received at any time
     @staticmethod
-    def from_bytes(json_bytes):
-        return Datagram(**json.loads(json_bytes.decode('utf-8')))
-    
+    def from_bytes(data):
+        if data[:1] == bytes([WIRE_FORMAT_BINARY]):
+            return Datagram.from_binary_bytes(data)
+        return Datagram(**json.loads(str(data, 'utf-8')))
+
+    # This function returns the binary header and fields as a list, so they can be joined with a single copy
+    def _binary_parts(self):
+        flags = 0
+        payload = self.msg
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+            flags |= FLAG_MSG_TEXT
+
+        filename = b''
+        if self.filename is not None:
+            filename = self.filename.encode('utf-8')
+            flags |= FLAG_HAS_FILENAME
+
+        checksum = b''
+        if self.checksum is not None:
+            flags |= FLAG_HAS_CHECKSUM
+            try:
+                checksum = bytes.fromhex(self.checksum) # send the digest as raw bytes instead of hexadecimal text
+            except ValueError:
+                checksum = self.checksum.encode('utf-8')
+                flags |= FLAG_CHECKSUM_TEXT
+
+        options = b''
+        if self.options is not None:
+            options = json.dumps(self.options).encode('utf-8')
+            options = OPTIONS_LENGTH.pack(len(options)) + options
+            flags |= FLAG_HAS_OPTIONS
+
+        if self.compressed:
+            flags |= FLAG_COMPRESSED
+
+        header = BINARY_HEADER.pack(WIRE_FORMAT_BINARY, self.mtype, flags, len(checksum),
+                                    self.sequence, len(payload), len(filename))
+        return [header, filename, checksum, options, payload]
+
+    """
+    This function parses a binary datagram without copying the payload
+    The payload of a FILE_DATA datagram is returned as a memoryview into the given buffer
+    """
+    @staticmethod
+    def from_binary_bytes(data):
+        view = memoryview(data)
+        if len(view) < BINARY_HEADER_SIZE:
+            raise ValueError("Incomplete binary datagram header")
+
+        version, mtype, flags, checksum_length, sequence, payload_length, filename_length = BINARY_HEADER.unpack_from(view)
+        if version != WIRE_FORMAT_BINARY:
+            raise ValueError(f"Unsupported datagram version: {version}")
+        position = BINARY_HEADER_SIZE
+        options_length = 0
+        if flags & FLAG_HAS_OPTIONS:
+            options_position = position + filename_length + checksum_length
+            options_length = OPTIONS_LENGTH.size + OPTIONS_LENGTH.unpack_from(view, options_position)[0]
+        if len(view) != BINARY_HEADER_SIZE + filename_length + checksum_length + options_length + payload_length:
+            raise ValueError("Binary datagram length does not match its header")
+
+        filename = None
+        if flags & FLAG_HAS_FILENAME:
+            filename = str(view[position:position + filename_length], 'utf-8')
+        position += filename_length
+
+        checksum = None
+        if flags & FLAG_HAS_CHECKSUM:
+            raw_checksum = view[position:position + checksum_length]
+            checksum = str(raw_checksum, 'utf-8') if flags & FLAG_CHECKSUM_TEXT else raw_checksum.hex()
+        position += checksum_length
+
+        options = None
+        if flags & FLAG_HAS_OPTIONS:
+            options = json.loads(str(view[position + OPTIONS_LENGTH.size:position + options_length], 'utf-8'))
+        position += options_length
+
+        msg = view[position:position + payload_length]
+        if flags & FLAG_MSG_TEXT:
+            msg = str(msg, 'utf-8')
+        return Datagram(mtype, msg, filename=filename, checksum=checksum, sequence=sequence, options=options,
+                        compressed=bool(flags & FLAG_COMPRESSED))
+
     """
     This function will add a 4-byte length header prefix before the message
     Format:
     [4-byte length] [message data]
     """
-    def to_framed_bytes(self):
+    def to_framed_bytes(self, wire_format: int = WIRE_FORMAT_JSON):
+        if wire_format == WIRE_FORMAT_BINARY:
+            parts = self._binary_parts()
+            length = sum(len(part) for part in parts)
+            return b"".join([struct.pack(">I", length)] + parts) # Prefix and fields are copied once
         raw = self.to_bytes()
         return struct.pack(">I", len(raw)) + raw # Prepend with 4-byte length prefix (big-endian)
-    
-    # This function will extract a datagram from a byte buffer with a 4-byte prefix, which stores framed datagrams
+
+    """
+    This function returns the framed datagram as a list of buffers, which are sent one after the other
+    With the binary wire format, the length prefix and the header fields are joined and the payload is the last buffer,
+    unchanged, so a memoryview of a memory mapped file is handed to the QUIC stream without being copied first
+    """
+    def to_framed_parts(self, wire_format: int = WIRE_FORMAT_JSON):
+        if wire_format == WIRE_FORMAT_BINARY:
+            parts = self._binary_parts()
+            length = sum(len(part) for part in parts)
+            return [b"".join([struct.pack(">I", length)] + parts[:-1]), parts[-1]]
+        return [self.to_framed_bytes(wire_format)]
+
+    """
+    This function will extract a datagram from a byte buffer with a 4-byte prefix, which stores framed datagrams
+    The buffer can be a memoryview, in which case the datagram is parsed without copying it
+    """
     @staticmethod
     def from_framed_bytes(buffer: bytes):
         if len(buffer) < LENGTH_PREFIX_SIZE:
             return None, buffer # Incomplete Header
-        
-        length = struct.unpack(">I", buffer[:LENGTH_PREFIX_SIZE])[0] # Find out how many bytes the datagram uses
-        
+
+        length = struct.unpack_from(">I", buffer)[0] # Find out how many bytes the datagram uses
+
         if len(buffer) < LENGTH_PREFIX_SIZE + length:
             return None, buffer # Incomplete Payload
-        
-        datagram_bytes = buffer[LENGTH_PREFIX_SIZE:LENGTH_PREFIX_SIZE + length]
+
+        datagram_bytes = memoryview(buffer)[LENGTH_PREFIX_SIZE:LENGTH_PREFIX_SIZE + length]
         remaining = buffer[LENGTH_PREFIX_SIZE + length:]
         return Datagram.from_bytes(datagram_bytes), remaining # Deserialize datagram and return it with the remaining buffer
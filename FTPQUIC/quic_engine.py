@@ -1,30 +1,73 @@
 import asyncio
+import contextlib
+import dataclasses
+import functools
+import itertools
+import logging
+import socket
+from collections import deque
 from aioquic.asyncio import connect, serve
 from aioquic.asyncio.protocol import QuicConnectionProtocol
-from aioquic.quic.configuration import QuicConfiguration
-from aioquic.quic.events import StreamDataReceived
-from typing import Optional, Dict, Callable
-from aioquic.tls import SessionTicket
+from aioquic.asyncio.server import QuicServer
+from aioquic.buffer import Buffer
+from aioquic.quic.configuration import QuicConfiguration, SMALLEST_MAX_DATAGRAM_SIZE
+from aioquic.quic.connection import QuicConnection
+from aioquic.quic.events import StreamDataReceived, StreamReset, ConnectionTerminated, HandshakeCompleted
+from aioquic.quic.logger import QuicFileLogger
+from aioquic.quic.packet import PACKET_TYPE_INITIAL, pull_quic_header
+from typing import Optional, Dict, Callable, List, Set, Deque
 import json
 from ft_quic import FTQuicConnection, QuicStreamEvent
 import ft_server, ft_client
+import pdu
+from metrics import metrics
+from tickets import SessionTicketStore, ClientTicketCache
+
+logger = logging.getLogger(__name__)
+
+# aioquic has no public API for the send buffers, the RTT estimate, the flow control limits and the connection IDs,
+# so their private attributes are used, those of the aioquic version pinned in requirements.txt. With another version,
+# what needs a missing attribute falls back to the behavior of aioquic alone, and a warning is logged once
+_missing_private_attributes: Set[str] = set()
+
+def warn_missing_private_attribute(role, name, fallback):
+    if name not in _missing_private_attributes:
+        _missing_private_attributes.add(name)
+        logger.warning(f"[{role}] aioquic has no {name}, {fallback}. Install the aioquic version of requirements.txt")
 
 ALPN_PROTOCOL = "file-transfer-protocol"
+ALPN_PROTOCOL_BINARY = "file-transfer-protocol/2"
+
+# PDU wire format selected by each ALPN identifier, in order of preference
+ALPN_WIRE_FORMATS = {
+    ALPN_PROTOCOL_BINARY: pdu.WIRE_FORMAT_BINARY,
+    ALPN_PROTOCOL: pdu.WIRE_FORMAT_JSON,
+}
 
-def build_server_quic_config(cert_file, key_file) -> QuicConfiguration:
+# Returns the ALPN identifiers to offer, restricted to a single wire format if one is given
+def alpn_protocols(wire_format = None):
+    return [alpn for alpn, alpn_format in ALPN_WIRE_FORMATS.items() 
+            if wire_format is None or alpn_format == wire_format]
+
+# With 'qlog_dir', every connection writes a qlog trace of its packets to that directory
+def build_server_quic_config(cert_file, key_file, wire_format = None, qlog_dir = None) -> QuicConfiguration:
     configuration = QuicConfiguration(
-        alpn_protocols=[ALPN_PROTOCOL], 
+        alpn_protocols=alpn_protocols(wire_format), 
         is_client=False
     )
     configuration.load_cert_chain(cert_file, key_file)
+    if qlog_dir:
+        configuration.quic_logger = QuicFileLogger(qlog_dir)
   
     return configuration
 
-def build_client_quic_config(cert_file = None):
-    configuration = QuicConfiguration(alpn_protocols=[ALPN_PROTOCOL], 
+def build_client_quic_config(cert_file = None, wire_format = None, qlog_dir = None):
+    configuration = QuicConfiguration(alpn_protocols=alpn_protocols(wire_format), 
                                       is_client=True)
     if cert_file:
         configuration.load_verify_locations(cert_file)
+    if qlog_dir:
+        configuration.quic_logger = QuicFileLogger(qlog_dir)
   
     return configuration
 
@@ -34,13 +77,31 @@ def create_msg_payload(msg):
 SERVER_MODE = 0
 CLIENT_MODE = 1
 
+# Default number of bytes a stream may have buffered (sent but not acknowledged by the peer) before send() waits
+DEFAULT_SEND_WINDOW = 1024 * 1024
+
+# Default number of received bytes a stream may have queued before its flow control limit stops being raised
+DEFAULT_RECEIVE_QUEUE_SIZE = 4 * 1024 * 1024
+
+# Identifies the connections of this process in the metrics
+_connection_ids = itertools.count(1)
+
 class AsyncQuicServer(QuicConnectionProtocol):
-    def __init__(self, *args, **kwargs):
+    # 'scope' holds the options of the application, every request handler receives its own copy
+    def __init__(self, *args, scope: Optional[Dict] = None, **kwargs):
         super().__init__(*args, **kwargs)
+        self._scope: Dict = scope or {}
         self._handlers: Dict[int, FTServerRequestHandler] = {}
         self._client_handler: Optional[FTClientRequestHandler] = None
         self._is_client: bool = self._quic.configuration.is_client
         self._mode: int = SERVER_MODE if not self._is_client else CLIENT_MODE
+        self._send_buffer_drained = asyncio.Event() # set whenever the peer may have acknowledged data
+        self._paused_streams: Set[int] = set() # streams whose receive queue is full
+        self._pause_stream_limits()
+        self.connection_id: int = next(_connection_ids)
+        self.early_alpn: Optional[str] = None # ALPN of the resumed session, used for the PDUs sent as 0-RTT data
+        self.handshake: Optional[HandshakeCompleted] = None
+        metrics.open_connection(self.connection_id, "client" if self._is_client else "server")
         if self._mode == CLIENT_MODE:
             self._attach_client_handler()
         
@@ -50,18 +111,53 @@ class AsyncQuicServer(QuicConnectionProtocol):
                        authority=self._quic.configuration.server_name,
                         connection=self._quic,
                         protocol=self,
-                        scope={},
+                        scope=dict(self._scope),
                         stream_ended=False,
                         stream_id=None,
                         transmit=self.transmit
                  )
         
+    # Returns the prefix of the messages this end of the connection logs
+    def log_role(self) -> str:
+        return "cli" if self._is_client else "svr"
+
     def remove_handler(self, stream_id):
-        self._handlers.pop(stream_id)
-        
+        self._handlers.pop(stream_id, None)
+        self._paused_streams.discard(stream_id)
+
+    # aioquic raises the flow control limit of a stream as soon as the peer used half of it, whether or not the
+    # application read the data, so the limits of paused streams are not written until they are resumed
+    def _pause_stream_limits(self):
+        write_stream_limits = getattr(self._quic, "_write_stream_limits", None) # aioquic has no public hook for its flow control updates
+        if not callable(write_stream_limits):
+            warn_missing_private_attribute(self.log_role(), "_write_stream_limits", "the receive queues of streams are not bounded")
+            return
+        def write_unpaused_stream_limits(builder, space, stream):
+            if stream.stream_id not in self._paused_streams:
+                write_stream_limits(builder, space, stream)
+        self._quic._write_stream_limits = write_unpaused_stream_limits
+
+    # Stops raising the flow control limit of a stream, so the peer stops sending once it used the current limit
+    def pause_stream(self, stream_id: int) -> None:
+        self._paused_streams.add(stream_id)
+
+    # Raises the flow control limit of a paused stream again, if the peer used enough of it
+    def resume_stream(self, stream_id: int) -> None:
+        if stream_id in self._paused_streams:
+            self._paused_streams.discard(stream_id)
+            self.transmit()
+
+    # A reset stream is ended like a stream whose data ended, so its handler sees the end and is removed
+    def _stream_end_event(self, event):
+        if isinstance(event, StreamReset):
+            return StreamDataReceived(data=b"", end_stream=True, stream_id=event.stream_id)
+        return event
+
     def _quic_client_event_dispatch(self, event):
-        if isinstance(event, StreamDataReceived):
-            self._client_handler.quic_event_received(event)
+        if isinstance(event, (StreamDataReceived, StreamReset)):
+            self._client_handler.quic_event_received(self._stream_end_event(event))
+        elif isinstance(event, ConnectionTerminated):
+            self._client_handler.end_streams()
         
     def _quic_server_event_dispatch(self, event):
         handler = None
@@ -71,7 +167,7 @@ class AsyncQuicServer(QuicConnectionProtocol):
                         authority=self._quic.configuration.server_name,
                         connection=self._quic,
                         protocol=self,
-                        scope={},
+                        scope=dict(self._scope),
                         stream_ended=False,
                         stream_id=event.stream_id,
                         transmit=self.transmit
@@ -82,56 +178,388 @@ class AsyncQuicServer(QuicConnectionProtocol):
             else:
                 handler = self._handlers[event.stream_id]
                 handler.quic_event_received(event)
+        elif isinstance(event, StreamReset):
+            handler = self._handlers.get(event.stream_id)
+            if handler is not None:
+                handler.quic_event_received(self._stream_end_event(event))
+        elif isinstance(event, ConnectionTerminated):
+            # End every open stream, so its handler can keep what was received for a resumed transfer
+            # Handlers whose transfer already returned remove themselves, so the handlers are copied first
+            for stream_id, handler in list(self._handlers.items()):
+                handler.quic_event_received(StreamDataReceived(data=b"", end_stream=True, stream_id=stream_id))
 
     def quic_event_received(self, event):
+        if isinstance(event, HandshakeCompleted):
+            self.handshake = event
+            result = "0-rtt" if event.early_data_accepted else "resumed" if event.session_resumed else "full"
+            metrics.inc("handshakes_total", role="client" if self._is_client else "server", result=result)
+        if isinstance(event, ConnectionTerminated):
+            self._send_buffer_drained.set() # wake up senders so they see the closed connection
         if self._mode == SERVER_MODE:
             self._quic_server_event_dispatch(event)
         else:
             self._quic_client_event_dispatch(event)
+        if isinstance(event, ConnectionTerminated):
+            metrics.close_connection(self.connection_id)
                         
     def is_client(self) -> bool:
         return self._quic.configuration.is_client
 
-class SessionTicketStore:
-    """
-    Simple in-memory store for session tickets.
-    """
+    def is_closed(self) -> bool:
+        return self._closed.is_set()
+
+    # ACKs and flow control updates from the peer arrive with received datagrams
+    def datagram_received(self, data, addr) -> None:
+        super().datagram_received(data, addr)
+        self._send_buffer_drained.set()
+
+    # Returns the number of bytes of a stream that were sent but not yet acknowledged by the peer
+    # This includes data held back by the congestion window or by the peer's flow control limits
+    # aioquic has no public accessor for the send buffer, when its attributes are missing 0 is returned, so sends are
+    # only buffered by aioquic, without limit
+    def stream_send_buffered(self, stream_id: int) -> int:
+        stream = getattr(self._quic, "_streams", {}).get(stream_id)
+        if stream is None:
+            return 0
+        buffer_start = getattr(stream.sender, "_buffer_start", None)
+        buffer_stop = getattr(stream.sender, "_buffer_stop", None)
+        if buffer_start is None or buffer_stop is None:
+            warn_missing_private_attribute(self.log_role(), "_buffer_start", "the send buffers of streams are not bounded")
+            return 0
+        return buffer_stop - buffer_start
+
+    # Waits until the send buffer of a stream is at or below 'limit' bytes
+    async def drain(self, stream_id: int, limit: int) -> None:
+        while self.stream_send_buffered(stream_id) > limit:
+            if self._closed.is_set():
+                raise ConnectionError("Connection closed while sending")
+            self._send_buffer_drained.clear()
+            await self._send_buffer_drained.wait()
+
+    # Returns the smoothed round trip time of the connection in seconds, 0 before it was measured
+    # aioquic has no public accessor for its RTT estimate, 0 is returned when it is missing, so chunk sizes stay at
+    # their initial value
+    def smoothed_rtt(self) -> float:
+        rtt = getattr(getattr(self._quic, "_loss", None), "_rtt_smoothed", None)
+        if rtt is None:
+            warn_missing_private_attribute(self.log_role(), "_rtt_smoothed", "chunk sizes do not adapt to the round trip time")
+            return 0.0
+        return rtt
+
+    # Raises the flow control limits of a stream and of the connection, so the peer can send at least
+    # 'size' more bytes on the stream without waiting for a window update
+    # aioquic only doubles its limits once half of them were used, which stalls PDUs larger than the window
+    # When the private attributes of the limits are missing, they are left to aioquic, which still raises them, only later
+    def reserve_receive_window(self, stream_id: int, size: int) -> None:
+        stream = getattr(self._quic, "_streams", {}).get(stream_id)
+        limit = getattr(self._quic, "_local_max_data", None)
+        if stream is None:
+            return
+        if not hasattr(stream, "max_stream_data_local") or not hasattr(limit, "used"):
+            warn_missing_private_attribute(self.log_role(), "_local_max_data", "receive windows are only raised by aioquic")
+            return
+        stream.max_stream_data_local = max(stream.max_stream_data_local, stream.receiver.highest_offset + size)
+        limit.value = max(limit.value, limit.used + size)
+        self.transmit()
+
+    # Returns the PDU wire format negotiated through ALPN, peers without the binary format fall back to JSON
+    # Before the handshake is complete, a client sending 0-RTT data uses the ALPN of the session it resumes
+    def wire_format(self) -> int:
+        return ALPN_WIRE_FORMATS.get(self._quic.tls.alpn_negotiated or self.early_alpn, pdu.WIRE_FORMAT_JSON)
+
+# Receives the datagrams that other workers forward to this worker
+class RouterProtocol(asyncio.DatagramProtocol):
+    def __init__(self, quic_server: "RoutingQuicServer"):
+        self.quic_server = quic_server
+
+    def datagram_received(self, data, addr):
+        self.quic_server.forwarded_datagram_received(data)
+
+    def error_received(self, exc):
+        pass # a worker that is not listening yet or has exited
+
+# Connection IDs carry the index of their worker in their first byte, so up to this many workers route by connection ID
+MAX_ROUTED_WORKERS = 256
+
+# aioquic has no hook to choose the connection IDs of a connection, they are set through its private attributes
+# Without them, connection IDs stay random and datagrams are forwarded to every worker
+ROUTABLE_CONNECTION_IDS = hasattr(QuicConnection, "_replenish_connection_ids")
+
+# This function makes every connection ID that a connection issues start with the index of its worker
+# It is called before the server registers the connection, and before its first packet
+def stamp_connection_ids(connection, index):
+    prefix = bytes([index])
+    host_cids = connection._host_cids
+    for host_cid in host_cids:
+        host_cid.cid = prefix + host_cid.cid[1:]
+    connection.host_cid = connection._local_initial_source_connection_id = host_cids[0].cid
+    replenish_connection_ids = connection._replenish_connection_ids
+    def replenish_stamped_connection_ids():
+        issued = {host_cid.cid for host_cid in connection._host_cids}
+        replenish_connection_ids()
+        for host_cid in connection._host_cids:
+            if host_cid.cid not in issued:
+                host_cid.cid = prefix + host_cid.cid[1:]
+    connection._replenish_connection_ids = replenish_stamped_connection_ids
+
+"""
+This class is the QUIC server of one worker process of a multi-process server
+Every worker binds the same address with SO_REUSEPORT, and the kernel sends all datagrams of a client address to
+the same worker, so a connection normally stays on the worker that accepted it. When the address of a client changes
+(NAT rebinding or connection migration), its datagrams can reach another worker, which does not know their destination
+connection ID. The connection IDs of a worker start with its index, so such a datagram is forwarded over a Unix socket,
+with the client address, to the worker that issued the connection ID. That worker processes it and replies from the
+shared port, so the client does not see the forwarding. 0-RTT packets still use the connection ID the client chose,
+they are only routed right by the kernel.
+"""
+class RoutingQuicServer(QuicServer):
+    def __init__(self, *args, router, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._router = router
+        self._router_transport: Optional[asyncio.DatagramTransport] = None
+
+    async def start_router(self):
+        self._router_transport, _ = await self._loop.create_datagram_endpoint(
+            lambda: RouterProtocol(self), local_addr=self._router.local_path, family=socket.AF_UNIX)
+
+    def close(self):
+        super().close()
+        if self._router_transport is not None:
+            self._router_transport.close()
+
+    # Returns the connection a datagram belongs to, None if it belongs to no connection of this worker
+    def _route(self, data):
+        try:
+            header = pull_quic_header(Buffer(data=data), host_cid_length=self._configuration.connection_id_length)
+        except ValueError:
+            return None, None
+        return header, self._protocols.get(header.destination_cid)
 
-    def __init__(self) -> None:
-        self.tickets: Dict[bytes, SessionTicket] = {}
+    def datagram_received(self, data, addr) -> None:
+        header, protocol = self._route(data)
+        # Datagrams of this worker's connections, new connections and unsupported versions are handled here
+        if (header is None or protocol is not None
+                or (header.packet_type == PACKET_TYPE_INITIAL and len(data) >= SMALLEST_MAX_DATAGRAM_SIZE)
+                or (header.version is not None and header.version not in self._configuration.supported_versions)
+                or self._router_transport is None):
+            super().datagram_received(data, addr)
+            return
+        if self.routes_by_connection_id():
+            index = header.destination_cid[0] if header.destination_cid else self._router.index
+            if index == self._router.index or index >= self._router.count:
+                super().datagram_received(data, addr) # a connection of this worker that was closed, or no connection
+                return
+            paths = [self._router.path(index)]
+        else:
+            paths = self._router.peer_paths
+        message = json.dumps(list(addr)).encode("utf-8")
+        message = len(message).to_bytes(2, "big") + message + data
+        for path in paths:
+            self._router_transport.sendto(message, path)
+        metrics.inc("forwarded_datagrams_total", role="server")
+
+    # Returns True if the connection IDs of the workers start with their index
+    def routes_by_connection_id(self):
+        return ROUTABLE_CONNECTION_IDS and self._router.count <= MAX_ROUTED_WORKERS
 
-    def add(self, ticket: SessionTicket) -> None:
-        self.tickets[ticket.ticket] = ticket
+    # A datagram forwarded by another worker is only processed if it belongs to a connection of this worker
+    def forwarded_datagram_received(self, message):
+        length = int.from_bytes(message[:2], "big")
+        addr = tuple(json.loads(message[2:2 + length]))
+        data = message[2 + length:]
+        _, protocol = self._route(data)
+        if protocol is not None:
+            protocol.datagram_received(data, addr)
 
-    def pop(self, label: bytes) -> Optional[SessionTicket]:
-        return self.tickets.pop(label, None)
+# This function starts the QUIC server of a worker process, on a socket that shares its port with the other workers
+async def serve_worker(host, port, *, configuration, create_protocol, router, **kwargs) -> RoutingQuicServer:
+    loop = asyncio.get_running_loop()
+    if not ROUTABLE_CONNECTION_IDS:
+        warn_missing_private_attribute("svr", "_replenish_connection_ids", "datagrams that reach another worker are forwarded to every worker")
+    def create_routed_protocol(connection, *args, **kwargs):
+        if quic_server.routes_by_connection_id():
+            stamp_connection_ids(connection, router.index)
+        return create_protocol(connection, *args, **kwargs)
+    _, quic_server = await loop.create_datagram_endpoint(
+        lambda: RoutingQuicServer(configuration=configuration, create_protocol=create_routed_protocol, router=router, **kwargs),
+        local_addr=(host, port), reuse_port=True)
+    await quic_server.start_router()
+    return quic_server
+
+# This function starts the QUIC server and returns it once it listens, closing it stops the server
+# With a 'router', the server is one worker of a multi-process server (see workers.py)
+# The session tickets the server issues are kept in 'ticket_store', workers share them through its directory
+async def start_server(server, server_port, configuration, scope = None, router = None, ticket_store = None) -> QuicServer:
+    if ticket_store is None:
+        ticket_store = SessionTicketStore()
+    create_protocol = functools.partial(AsyncQuicServer, scope=scope)
+    if router is None:
+        quic_server = await serve(server, server_port, configuration=configuration, create_protocol=create_protocol,
+                session_ticket_fetcher=ticket_store.pop,
+                session_ticket_handler=ticket_store.add)
+        logger.info(f"[svr] Listening on {server}:{server_port}...")
+    else:
+        quic_server = await serve_worker(server, server_port, configuration=configuration, create_protocol=create_protocol, router=router,
+                session_ticket_fetcher=ticket_store.pop,
+                session_ticket_handler=ticket_store.add)
+        logger.info(f"[svr] Worker {router.index} Listening on {server}:{server_port}...")
+    return quic_server
 
 # Modified to include error handling in case server connection fails
-async def run_server(server, server_port, configuration):  
-    print(f"[svr] Server Starting...")  
+# The server runs until it is cancelled, which closes its socket
+async def run_server(server, server_port, configuration, scope = None, router = None, ticket_store = None):  
+    logger.info(f"[svr] Server Starting...")  
+    quic_server = None
     try:
-        await serve(server, server_port, configuration=configuration, 
-                create_protocol=AsyncQuicServer,
-                session_ticket_fetcher=SessionTicketStore().pop,
-                session_ticket_handler=SessionTicketStore().add)
-        print(f"[svr] Listening on {server}:{server_port}...")
+        quic_server = await start_server(server, server_port, configuration, scope, router, ticket_store)
         await asyncio.Future()
-    except:
-        print("[svr] Error starting server!")
-        print("[svr] Ensure that the port is available for use and certificates are up to date!")
-  
-# Modified to include file name and error handling in case client connection fails
-async def run_client(server, server_port, configuration, filename):
-    print("[cli] Attempting to connect to server...")
+    except asyncio.CancelledError:
+        raise
+    except OSError as e:
+        logger.error(f"[svr] Error starting server! {e}")
+        logger.error("[svr] Ensure that the port is available for use and certificates are up to date!")
+    finally:
+        if quic_server is not None:
+            quic_server.close()
+
+# This function returns the configuration to connect with and the ALPN of the session sent as 0-RTT data, or None
+# With a ticket for the server in 'ticket_cache', the last TLS session with the server is resumed
+def resume_session(configuration, ticket_key, ticket_cache: Optional[ClientTicketCache] = None):
+    ticket, early_alpn = ticket_cache.get(ticket_key) if ticket_cache is not None else (None, None)
+    # Early data is sent in the wire format of the resumed session, so only its ALPN is offered. Sessions that used
+    # another format than the preferred one are resumed without early data, so the preferred format is negotiated again
+    early_data = ticket is not None and early_alpn == configuration.alpn_protocols[0]
+    if ticket is not None:
+        configuration = dataclasses.replace(configuration, session_ticket=ticket,
+                alpn_protocols=[early_alpn] if early_data else configuration.alpn_protocols)
+    return configuration, early_alpn if early_data else None
+
+"""
+This function opens a client connection, the session tickets it receives are kept in 'ticket_cache' when it closes
+Servers on other ports of the same host issue their own tickets, so they are kept by server name and port.
+A connection that resumes a session with early data is returned before its handshake, start_transfer() must be
+called right away so the first PDUs are sent as 0-RTT data.
+"""
+@contextlib.asynccontextmanager
+async def open_client_connection(server, server_port, configuration, scope = None, ticket_cache: Optional[ClientTicketCache] = None):
+    server_name = configuration.server_name or server
+    ticket_key = f"{server_name}:{server_port}"
+    configuration, early_alpn = resume_session(configuration, ticket_key, ticket_cache)
+    new_tickets = [] # tickets received during this connection, the last one is kept for the next connection
+    async with connect(server, server_port, configuration=configuration, 
+            create_protocol=functools.partial(AsyncQuicServer, scope=scope),
+            session_ticket_handler=new_tickets.append if ticket_cache is not None else None,
+            wait_connected=early_alpn is None) as client:
+        client.early_alpn = early_alpn
+        try:
+            yield client
+        finally:
+            if new_tickets and client.handshake is not None:
+                try:
+                    ticket_cache.add(ticket_key, new_tickets[-1], client.handshake.alpn_protocol)
+                except OSError as e:
+                    logger.warning(f"[cli] Could not save the session ticket: {e}")
+
+# This function starts a transfer on a connection returned by open_client_connection(), and returns its task once connected
+# The transfer starts sending right away, aioquic only marks the connection as connected
+# if it is awaited before the handshake completes
+async def start_transfer(client: AsyncQuicServer, coroutine) -> asyncio.Future:
+    early_data = client.early_alpn is not None and client.handshake is None
+    transfer = asyncio.ensure_future(coroutine)
+    if early_data:
+        try:
+            await client.wait_connected()
+        except BaseException:
+            transfer.cancel()
+            raise
+    return transfer
+
+# Modified to include file names and error handling in case client connection fails
+# All files are sent over the same connection, each on its own stream
+# Returns the result of every transfer from ft_client_batch, or the files listed by ft_client_run, or None if the connection failed
+# With a 'ticket_cache', the client resumes its last TLS session with the server and sends its first PDUs as 0-RTT data
+async def run_client(server, server_port, configuration, filenames, scope = None, ticket_cache: Optional[ClientTicketCache] = None):
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    logger.info("[cli] Attempting to connect to server...")
     try:   
-        async with connect(server, server_port, configuration=configuration, 
-                create_protocol=AsyncQuicServer) as client:
-            print(f"[cli] Connected successfully to server {server}:{server_port}")
-            await asyncio.ensure_future(client._client_handler.launch_ft(filename=filename))
-    except:
-        print("[cli] Error: Could not connect to server!")
+        async with open_client_connection(server, server_port, configuration, scope, ticket_cache) as client:
+            transfer = await start_transfer(client, client._client_handler.launch_ft(filenames=filenames))
+            handshake = client.handshake
+            early_data = client.early_alpn is not None
+            resumption = " (0-RTT)" if early_data and handshake.early_data_accepted else " (resumed)" if handshake.session_resumed else ""
+            logger.info(f"[cli] Connected successfully to server {server}:{server_port}{resumption}")
+            return await transfer
+    except (ConnectionError, OSError) as e:
+        logger.error(f"[cli] Error: Could not connect to server! {e}")
+    except Exception as e:
+        logger.error(f"[cli] Error: {e!r}")
 
-        
+
+"""
+This class is the receive queue of a request handler, it is bounded by the number of bytes of its events
+Events are put by the synchronous aioquic callback, which cannot wait for room in the queue, so backpressure is applied
+through QUIC flow control instead: once more than 'max_size' bytes are queued, the streams that filled the queue are
+paused and their peer stops sending after the data it may already send. They are resumed once half of the queue was read.
+Once the reader closes the queue, the events of its stream are dropped until the stream ends.
+"""
+class StreamEventQueue:
+    def __init__(self, protocol: AsyncQuicServer, max_size: int = DEFAULT_RECEIVE_QUEUE_SIZE):
+        self.protocol = protocol
+        self.max_size = max_size
+        self.size = 0 # bytes of the queued events
+        self.ended = False # the stream ended or was reset, no more events arrive
+        self.closed = False # the reader is gone
+        self._events: Deque[QuicStreamEvent] = deque()
+        self._waiter: Optional[asyncio.Future] = None # set while the reader waits for an event, a stream has one reader
+        self._paused: Set[int] = set()
+
+    def empty(self) -> bool:
+        return not self._events
+
+    def put_nowait(self, event: QuicStreamEvent) -> None:
+        self._events.append(event)
+        self.size += len(event.data)
+        if self.size > self.max_size and event.stream_id not in self._paused:
+            self._paused.add(event.stream_id)
+            self.protocol.pause_stream(event.stream_id)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def get_nowait(self) -> QuicStreamEvent:
+        event = self._events.popleft()
+        self.size -= len(event.data)
+        if self._paused and self.size <= self.max_size // 2:
+            for stream_id in self._paused:
+                self.protocol.resume_stream(stream_id)
+            self._paused.clear()
+        return event
+
+    async def get(self) -> QuicStreamEvent:
+        while not self._events:
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return self.get_nowait()
+
+    # Queues the data of a received event unless the queue was closed
+    # Returns True once the queue is closed and its stream ended, so the queue can be dropped
+    def feed(self, event: StreamDataReceived) -> bool:
+        self.ended = self.ended or event.end_stream
+        if not self.closed:
+            self.put_nowait(QuicStreamEvent(event.stream_id, event.data, event.end_stream))
+        return self.closed and self.ended
+
+    # Drops the queued events, which resumes their streams, and returns True if the stream already ended
+    def close(self) -> bool:
+        self.closed = True
+        while not self.empty():
+            self.get_nowait()
+        return self.ended
+
+# Handlers are removed from the connection once their transfer returned and their stream ended or was reset
 class FTServerRequestHandler:
     def __init__(
         self,
@@ -147,54 +575,113 @@ class FTServerRequestHandler:
         self.authority = authority
         self.connection = connection
         self.protocol = protocol
-        self.queue: asyncio.Queue[QuicStreamEvent] = asyncio.Queue()
         self.scope = scope
         self.stream_id = stream_id
         self.transmit = transmit
+        self.send_window: int = scope.get("send_window", DEFAULT_SEND_WINDOW)
+        self.receive_queue_size: int = scope.get("receive_queue", DEFAULT_RECEIVE_QUEUE_SIZE)
+        self.queue = StreamEventQueue(protocol, self.receive_queue_size)
+        self.send_ended = False # the end of the stream was sent
 
         if stream_ended:
-            self.queue.put_nowait({"type": "quic.stream_end"})
+            self.queue.feed(StreamDataReceived(data=b"", end_stream=True, stream_id=stream_id))
         
     def quic_event_received(self, event: StreamDataReceived) -> None:
-        self.queue.put_nowait(
-            QuicStreamEvent(event.stream_id, event.data, 
-                            event.end_stream)
-        )
+        if self.queue.feed(event):
+            self.protocol.remove_handler(self.stream_id)
     async def receive(self) -> QuicStreamEvent:
         queue_item = await self.queue.get()
         return queue_item
     
+    # Applies backpressure: returns once the stream has at most 'send_window' bytes in flight
+    # The data of the event can be a list of buffers, e.g. from Datagram.to_framed_parts(), aioquic copies each of them once
     async def send(self, message: QuicStreamEvent) -> None:
+        if isinstance(message.data, list):
+            for part in message.data[:-1]:
+                self.connection.send_stream_data(message.stream_id, part, False)
+            data = message.data[-1]
+        else:
+            data = message.data
         self.connection.send_stream_data(
                 stream_id=message.stream_id,
-                data=message.data,
+                data=data,
                 end_stream=message.end_stream
         )
+        self.send_ended = self.send_ended or message.end_stream
         
         self.transmit()
+        await self.protocol.drain(message.stream_id, self.send_window)
         
     def close(self) -> None:
         self.protocol.remove_handler(self.stream_id)
         self.connection.close()
         
     async def launch_ft(self):
+        self.scope["wire_format"] = self.protocol.wire_format()
         qc = FTQuicConnection(self.send, 
-                self.receive, self.close, None)
-        await ft_server.ft_server_proto(self.scope, 
-            qc)
+                self.receive, self.close, None, stream_id=self.stream_id,
+                rtt=self.protocol.smoothed_rtt,
+                reserve_receive_window=lambda size: self.protocol.reserve_receive_window(self.stream_id, size),
+                connection_id=self.protocol.connection_id)
+        try:
+            await ft_server.ft_server_proto(self.scope, 
+                qc)
+        finally:
+            # Replies to uploads leave the stream open, it is ended so the client and aioquic can forget it
+            if not self.send_ended and not self.protocol.is_closed():
+                self.connection.send_stream_data(self.stream_id, b"", end_stream=True)
+                self.transmit()
+            if self.queue.close():
+                self.protocol.remove_handler(self.stream_id)
         
         
 class FTClientRequestHandler(FTServerRequestHandler):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self._stream_queues: Dict[int, StreamEventQueue] = {} # streams opened with open_stream()
+        
+    # Events of streams opened with open_stream() go to their own queue, all others to the shared one
+    # The queue of a stream is dropped once the stream was closed and its end was received
+    def quic_event_received(self, event: StreamDataReceived) -> None:
+        queue = self._stream_queues.get(event.stream_id, self.queue)
+        if queue.feed(event) and queue is not self.queue:
+            del self._stream_queues[event.stream_id]
+
+    # Ends every stream opened with open_stream(), so their readers see that the connection was closed
+    def end_streams(self) -> None:
+        for stream_id in list(self._stream_queues):
+            self.quic_event_received(StreamDataReceived(data=b"", end_stream=True, stream_id=stream_id))
+
+    def close_stream(self, stream_id: int) -> None:
+        queue = self._stream_queues.get(stream_id)
+        if queue is not None and queue.close():
+            del self._stream_queues[stream_id]
         
     def get_next_stream_id(self) -> int:
         return self.connection.get_next_available_stream_id()
     
-    # Modified to include file name
-    async def launch_ft(self, filename:str):
-        qc = FTQuicConnection(self.send, 
+    # Opens a new stream with its own receive queue, so several streams can be used concurrently
+    def open_stream(self) -> FTQuicConnection:
+        stream_id = self.get_next_stream_id()
+        self.connection.send_stream_data(stream_id, b"") # creates the stream, so the next call gets another ID
+        queue = StreamEventQueue(self.protocol, self.receive_queue_size)
+        self._stream_queues[stream_id] = queue
+        return FTQuicConnection(self.send, queue.get, 
+                lambda: self.close_stream(stream_id), 
+                lambda: stream_id, stream_id=stream_id, rtt=self.protocol.smoothed_rtt,
+                reserve_receive_window=lambda size: self.protocol.reserve_receive_window(stream_id, size),
+                connection_id=self.protocol.connection_id)
+    
+    # Returns the connection given to the client protocol, every file is sent on its own stream opened with open_stream()
+    def ft_connection(self) -> FTQuicConnection:
+        self.scope["wire_format"] = self.protocol.wire_format()
+        return FTQuicConnection(self.send, 
                 self.receive, self.close, 
-                self.get_next_stream_id)
-        await ft_client.ft_client_proto(self.scope, 
-            qc, filename)
\ No newline at end of file
+                self.get_next_stream_id, self.open_stream,
+                connection_id=self.protocol.connection_id)
+
+    # Modified to include file names
+    async def launch_ft(self, filenames:List[str]):
+        qc = self.ft_connection()
+        return await ft_client.ft_client_run(self.scope, 
+            qc, filenames)
\ No newline at end of file
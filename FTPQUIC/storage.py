@@ -0,0 +1,701 @@
+"""
+This Python file houses the storage used by the server to write received files to disk, and to list them
+The server keeps its files in a storage backend given by the 'storage' option of its scope: LocalStorage keeps them
+in a directory (the 'server_files' directory by default), and MemoryStorage keeps them in memory.
+"""
+
+import json
+import mmap
+import os
+import secrets
+import sys
+import threading
+import time
+import traceback
+from pdu import new_digest, DIGEST_SHA256
+
+# Policies for flushing received files to stable storage with fsync
+FSYNC_NEVER = "never" # leave flushing to the operating system
+FSYNC_ON_COMPLETE = "complete" # fsync once before the file is renamed to its final name
+FSYNC_ALWAYS = "always" # fsync after every batch of writes
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_ON_COMPLETE, FSYNC_ALWAYS)
+
+WRITE_BATCH_SIZE = 1024 * 1024 # number of bytes collected before they are written with a single vectored write
+IOV_MAX = 1024 # maximum number of buffers passed to one writev call
+
+SERVER_SUFFIX = "_svr" # added to the names of the files stored by the server, before their extension
+MEMORY_MAX_FILE_SIZE = 1024 ** 3 # largest file a MemoryStorage keeps by default, files are allocated in memory at their announced size
+INDEX_RACY_SECONDS = 1.0 # directories modified this recently are scanned again, their mtime may not show a change yet
+
+# This function returns a filename sent by a peer as a relative path
+# Empty, '.' and '..' components are dropped so a peer cannot reach outside of the directory
+def safe_relative_path(filename):
+    parts = [part for part in filename.replace("\\", "/").split("/") if part not in ("", ".", "..")]
+    return os.path.join(*parts) if parts else "unnamed"
+
+# This function maps a filename sent by the client to its path in the server directory with the '_svr' suffix
+def server_filepath(directory, filename):
+    split_name = os.path.splitext(safe_relative_path(filename)) # split file name and extensions if presents
+    return os.path.join(directory, f"{split_name[0]}{SERVER_SUFFIX}{split_name[1]}")
+
+# This function returns the filename a client sent a stored file under, from its path relative to the server directory
+# Returns None for files that were not stored by server_filepath
+def client_filename(relative_path):
+    root, extension = os.path.splitext(relative_path)
+    if not root.endswith(SERVER_SUFFIX):
+        return None
+    return (root[:-len(SERVER_SUFFIX)] + extension).replace(os.sep, "/")
+
+# This function writes a list of buffers at a position of a file, with as few system calls as possible
+def write_vectored(fd, buffers, offset):
+    pending = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    while pending:
+        if hasattr(os, "pwritev"):
+            written = os.pwritev(fd, pending[:IOV_MAX], offset)
+        else:
+            written = os.pwrite(fd, pending[0], offset)
+        offset += written
+        # Drop the buffers that were fully written and keep the rest of a partially written one
+        while written > 0:
+            if written >= len(pending[0]):
+                written -= len(pending[0])
+                pending.pop(0)
+            else:
+                pending[0] = pending[0][written:]
+                written = 0
+
+"""
+This class writes consecutive chunks into a file starting at a given offset
+Chunks are collected and written in batches with vectored positional writes, and the digest (SHA-256 by default)
+of the written bytes is updated with each batch, so several writers can fill different ranges of one file.
+A caller on the event loop can write with flush=False and run flush() in a worker thread when needs_flush is set.
+"""
+class RangeWriter:
+    def __init__(self, fd, offset = 0, fsync = FSYNC_NEVER, batch_size = WRITE_BATCH_SIZE, digest = DIGEST_SHA256):
+        self.offset = offset
+        self.size = 0 # number of bytes passed to write()
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self._fd = fd
+        self._hash = new_digest(digest)
+        self._pending = [] # chunks waiting for the next vectored write
+        self._pending_size = 0
+        self._flushed = 0 # number of bytes already written to the file
+
+    # This function appends a chunk to the range, the chunk must not be modified afterwards
+    # Without 'flush', a full batch stays pending until flush() is called
+    def write(self, data, flush = True):
+        self._pending.append(data)
+        self._pending_size += len(data)
+        self.size += len(data)
+        if flush and self.needs_flush:
+            self.flush()
+
+    # True when a full batch is waiting to be written
+    @property
+    def needs_flush(self):
+        return self._pending_size >= self.batch_size
+
+    # This function hashes and writes every pending chunk to the file
+    def flush(self):
+        if not self._pending:
+            return
+        for data in self._pending:
+            self._hash.update(data)
+        self._write(self._pending, self.offset + self._flushed)
+        self._flushed += self._pending_size
+        self._pending = []
+        self._pending_size = 0
+        if self.fsync == FSYNC_ALWAYS:
+            os.fsync(self._fd)
+
+    # This function writes a batch of buffers at a position of the file, writers of other storages replace it
+    def _write(self, buffers, offset):
+        write_vectored(self._fd, buffers, offset)
+
+    # Number of bytes passed to write() that were not written to the file yet
+    @property
+    def pending_size(self):
+        return self._pending_size
+
+    # Returns the digest of everything written so far as a hexadecimal string
+    def hexdigest(self):
+        self.flush()
+        return self._hash.hexdigest()
+
+"""
+This class streams a received file to a temporary file next to its final path
+Memory use does not depend on the file size and the file is never read back to compute its checksum.
+When the size is known, the file is preallocated so byte ranges can be written in parallel with range_writer().
+commit() atomically renames the temporary file to the final path, abort() removes it.
+"""
+class FileSink:
+    def __init__(self, filepath, fsync = FSYNC_NEVER, batch_size = WRITE_BATCH_SIZE, size = None, digest = DIGEST_SHA256):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.filepath = filepath
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.digest = digest
+        self.committed = False
+
+        directory = os.path.dirname(filepath) or "."
+        os.makedirs(directory, exist_ok=True)
+        self.temp_path = os.path.join(directory, f".{os.path.basename(filepath)}.{secrets.token_hex(4)}.part")
+        self._fd = os.open(self.temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o666)
+        if size is not None:
+            self._preallocate(size)
+        self._writer = RangeWriter(self._fd, 0, fsync, batch_size, digest) # used by write() for sequential transfers
+
+    # This function reserves the disk space of the whole file, or only sets its size if the file system cannot
+    def _preallocate(self, size):
+        os.ftruncate(self._fd, size)
+        if size > 0 and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self._fd, 0, size)
+            except OSError:
+                pass
+
+    # Number of bytes written sequentially with write()
+    @property
+    def size(self):
+        return self._writer.size
+
+    # This function appends a chunk to the file, the chunk must not be modified afterwards
+    def write(self, data, flush = True):
+        self._writer.write(data, flush)
+
+    @property
+    def needs_flush(self):
+        return self._writer.needs_flush
+
+    # This function flushes the chunks passed to write()
+    def flush(self):
+        self._writer.flush()
+
+    # Returns the digest of everything passed to write() as a hexadecimal string
+    def hexdigest(self):
+        return self._writer.hexdigest()
+
+    # Returns a writer for the byte range of the file starting at 'offset'
+    def range_writer(self, offset):
+        return RangeWriter(self._fd, offset, self.fsync, self.batch_size, self.digest)
+
+    # This function completes the file and atomically moves it to its final path
+    # Range writers must be flushed before
+    def commit(self):
+        self.flush()
+        if self.fsync != FSYNC_NEVER:
+            os.fsync(self._fd)
+        os.close(self._fd)
+        self._fd = None
+        os.replace(self.temp_path, self.filepath)
+        self.committed = True
+        return self.filepath
+
+    # This function discards a file that was not completed
+    def abort(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if not self.committed and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+# This function returns the paths of the partial file and of its chunk manifest, which are kept next to the final path
+def partial_paths(filepath):
+    directory, name = os.path.split(filepath)
+    return os.path.join(directory, f".{name}.part"), os.path.join(directory, f".{name}.manifest")
+
+"""
+This class keeps a partially received file and its chunk manifest, so a transfer can be resumed on a new connection
+Chunks are written at their offset, so they can arrive in any order. The manifest is an append-only file:
+its first line is a JSON header with the file size and chunk size, and every other line records a written chunk
+as '<sequence> <checksum>'. A chunk is only recorded after its data was written to the partial file.
+When an existing partial file is opened, its recorded chunks are read back and checked against their checksums,
+so chunks that were lost or torn by a crash are received again.
+"""
+class ResumableFile:
+    def __init__(self, filepath, size, chunk_size, fsync = FSYNC_NEVER, batch_size = WRITE_BATCH_SIZE, digest = DIGEST_SHA256):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        if size < 0 or chunk_size <= 0:
+            raise ValueError("Invalid file size or chunk size")
+        self.filepath = filepath
+        self.size = size
+        self.chunk_size = chunk_size
+        self.chunk_count = -(-size // chunk_size) # round up
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.digest = digest
+        self.committed = False
+        self.received = {} # checksums of the chunks in the partial file, by sequence number
+        self.part_path, self.manifest_path = partial_paths(filepath)
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+
+        header = {"size": size, "chunk_size": chunk_size}
+        if digest != DIGEST_SHA256:
+            header["digest"] = digest # manifests of SHA-256 transfers keep their original header
+        recorded = self._load_manifest(header)
+        self._fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o666)
+        for sequence, checksum in sorted(recorded.items()):
+            if 0 <= sequence < self.chunk_count:
+                data = os.pread(self._fd, self.chunk_length(sequence), sequence * chunk_size)
+                if new_digest(digest, data).hexdigest() == checksum:
+                    self.received[sequence] = checksum
+        os.ftruncate(self._fd, size)
+        self.resumed = bool(self.received)
+
+        # Rewrite the manifest with the verified chunks only, then append to it
+        with open(self.manifest_path, "w") as manifest:
+            manifest.write(json.dumps(header) + "\n")
+            manifest.writelines(f"{sequence} {checksum}\n" for sequence, checksum in self.received.items())
+        self._manifest = open(self.manifest_path, "a")
+        self._unrecorded = [] # manifest lines of chunks that are not written to the partial file yet
+
+        self._writer = None # writes the current run of consecutive chunks
+        self._next_sequence = None
+        # The digest of the file is updated as chunks arrive as long as they arrive in order from the first one
+        self._hash = new_digest(digest) if not self.received else None
+        self._hashed_sequence = 0
+
+    # This function reads the chunks recorded in an existing manifest, if it describes the same file
+    def _load_manifest(self, header):
+        try:
+            with open(self.manifest_path) as manifest:
+                if json.loads(manifest.readline()) != header:
+                    return {}
+                recorded = {}
+                for line in manifest:
+                    fields = line.split()
+                    if len(fields) == 2: # the last line may be incomplete after a crash
+                        recorded[int(fields[0])] = fields[1]
+                return recorded
+        except (OSError, ValueError):
+            return {}
+
+    # Returns the length of a chunk, only the last chunk of the file can be shorter than the chunk size
+    def chunk_length(self, sequence):
+        return min(self.chunk_size, self.size - sequence * self.chunk_size)
+
+    # Returns the received chunks as a list of [first, last + 1] sequence number ranges
+    def received_ranges(self):
+        ranges = []
+        for sequence in sorted(self.received):
+            if ranges and ranges[-1][1] == sequence:
+                ranges[-1][1] = sequence + 1
+            else:
+                ranges.append([sequence, sequence + 1])
+        return ranges
+
+    def is_complete(self):
+        return len(self.received) == self.chunk_count
+
+    # This function writes a chunk at its offset, and returns False if it is out of range or already received
+    # The chunk must not be modified afterwards, without 'flush' a full batch stays pending until flush() is called
+    def write_chunk(self, sequence, data, checksum, flush = True):
+        if self._fd is None:
+            raise ValueError("Partial file is closed")
+        if not 0 <= sequence < self.chunk_count or sequence in self.received or len(data) != self.chunk_length(sequence):
+            return False
+        if self._writer is None or sequence != self._next_sequence:
+            self._flush_writer()
+            self._writer = RangeWriter(self._fd, sequence * self.chunk_size, self.fsync, self.batch_size, self.digest)
+        self._writer.write(data, flush)
+        self._next_sequence = sequence + 1
+        self.received[sequence] = checksum
+        self._unrecorded.append(f"{sequence} {checksum}\n")
+
+        if self._hash is not None and sequence == self._hashed_sequence:
+            self._hash.update(data)
+            self._hashed_sequence += 1
+        else:
+            self._hash = None
+
+        if self._writer.pending_size == 0: # the writer just wrote its batch to the file
+            self._record()
+        return True
+
+    # True when a full batch of chunks is waiting to be written
+    @property
+    def needs_flush(self):
+        return self._writer is not None and self._writer.needs_flush
+
+    # This function writes the pending chunks and records them in the manifest
+    def flush(self):
+        self._flush_writer()
+
+    # This function appends the written chunks to the manifest
+    def _record(self):
+        if self._unrecorded:
+            self._manifest.writelines(self._unrecorded)
+            self._manifest.flush()
+            if self.fsync == FSYNC_ALWAYS:
+                os.fsync(self._manifest.fileno())
+            self._unrecorded = []
+
+    def _flush_writer(self):
+        if self._writer is not None:
+            self._writer.flush()
+        self._record()
+
+    # Returns the digest of the file as a hexadecimal string
+    def hexdigest(self):
+        self._flush_writer()
+        if self._hash is not None:
+            return self._hash.hexdigest()
+        # Chunks arrived out of order or over several connections, so the file is read back once
+        file_hash = new_digest(self.digest)
+        for offset in range(0, self.size, WRITE_BATCH_SIZE):
+            file_hash.update(os.pread(self._fd, min(WRITE_BATCH_SIZE, self.size - offset), offset))
+        return file_hash.hexdigest()
+
+    # This function completes the file, atomically moves it to its final path and removes the manifest
+    def commit(self):
+        self._flush_writer()
+        if self.fsync != FSYNC_NEVER:
+            os.fsync(self._fd)
+        self._close_files()
+        os.replace(self.part_path, self.filepath)
+        os.remove(self.manifest_path)
+        self.committed = True
+        return self.filepath
+
+    # This function writes everything received so far and keeps the partial file, so the transfer can be resumed
+    def close(self):
+        if self._fd is not None:
+            self._flush_writer()
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(self._fd)
+            self._close_files()
+
+    # This function discards the partial file and its manifest
+    def abort(self):
+        self._close_files()
+        for path in (self.part_path, self.manifest_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _close_files(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if not self._manifest.closed:
+            self._manifest.close()
+
+"""
+This class stores chunks by their SHA-256 in a content-addressed directory, shared by every delta transfer
+A chunk is kept at '<directory>/<first 2 hex digits>/<sha256>', so a chunk that is part of several files,
+or of several versions of one file, is only received and stored once.
+"""
+class ChunkStore:
+    def __init__(self, directory, fsync = FSYNC_NEVER):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy: {fsync}")
+        self.directory = directory
+        self.fsync = fsync
+
+    def _path(self, checksum):
+        if len(checksum) != 64 or not all(c in "0123456789abcdef" for c in checksum):
+            raise ValueError(f"Invalid chunk checksum: {checksum}")
+        return os.path.join(self.directory, checksum[:2], checksum)
+
+    def has(self, checksum):
+        return os.path.exists(self._path(checksum))
+
+    # This function stores a chunk that was verified against its checksum, unless it is already stored
+    # The chunk is written to a temporary file and renamed, so a stored chunk is never incomplete
+    def put(self, checksum, data):
+        path = self._path(checksum)
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{secrets.token_hex(4)}.part"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o666)
+        try:
+            write_vectored(fd, [data], 0)
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(temp_path, path)
+        return True
+
+    def get(self, checksum):
+        with open(self._path(checksum), "rb") as f:
+            return f.read()
+
+"""
+This class keeps the list of the files stored in the server directory, so repeated listings do not scan the disk
+Files are listed by the name the client sent them under, with their size and modification time. Hidden files and
+directories (temporary and partial files, the chunk store) are left out. Every file is stored by renaming it into
+its directory, which updates the modification time of that directory: the cached list is used as long as no
+directory changed, which only needs one stat() per directory. Worker processes that share the directory see
+each other's files this way.
+"""
+class DirectoryIndex:
+    def __init__(self, directory):
+        self.directory = directory
+        self._files = None # filename -> (size, mtime), None until the directory is scanned
+        self._directories = {} # path -> mtime in nanoseconds of every directory seen by the last scan
+        self._scanned = 0 # time of the last scan in nanoseconds
+        self._lock = threading.Lock()
+
+    # This function returns True if no directory changed since the last scan
+    def _is_current(self):
+        if self._files is None or self.directory not in self._directories:
+            return False # never scanned, or the directory did not exist yet
+        racy = self._scanned - int(INDEX_RACY_SECONDS * 1e9)
+        for path, mtime in self._directories.items():
+            try:
+                current = os.stat(path).st_mtime_ns
+            except OSError:
+                return False
+            if current != mtime or current >= racy:
+                return False
+        return True
+
+    def _scan(self):
+        files = {}
+        directories = {}
+        self._scanned = time.time_ns()
+        for root, subdirectories, names in os.walk(self.directory):
+            try:
+                directories[root] = os.stat(root).st_mtime_ns
+            except OSError:
+                continue
+            subdirectories[:] = [name for name in subdirectories if not name.startswith(".")]
+            for name in names:
+                if name.startswith("."):
+                    continue
+                path = os.path.join(root, name)
+                filename = client_filename(os.path.relpath(path, self.directory))
+                if filename is None:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue # removed while the directory was scanned
+                files[filename] = (stat.st_size, stat.st_mtime)
+        self._files = files
+        self._directories = directories
+
+    # Returns the stored files as a dictionary of filename -> (size, modification time), it can block on disk I/O
+    def files(self):
+        with self._lock:
+            if not self._is_current():
+                self._scan()
+            return self._files
+
+# This function unmaps a memory mapped file, 'view' is the memoryview of the mapping that the sent chunks are slices of
+# The other slices should be released before. When a transfer failed, the frames of the traceback still hold the slices
+# that were being sent, so their locals are cleared first. If a slice is still referenced somewhere else, the mapping
+# cannot be closed yet: it is left to the garbage collector, which unmaps it once the last slice is released.
+# Returns True if the mapping was closed
+def close_mapping(mapping, view):
+    error = sys.exc_info()[1]
+    while error is not None:
+        traceback.clear_frames(error.__traceback__)
+        error = error.__context__
+    view.release()
+    try:
+        mapping.close()
+    except BufferError:
+        return False
+    return True
+
+"""
+This class is a stored file that is sent to a client, opened by the open_file() method of a storage
+'source' is what read_chunk_block() reads from: a memoryview of the memory mapped file, so chunks are framed straight
+from the page cache, or a file descriptor for empty files, which cannot be mapped.
+"""
+class StoredFile:
+    def __init__(self, filepath):
+        self._file = open(filepath, "rb")
+        self.size = os.fstat(self._file.fileno()).st_size
+        self._mapping = None
+        self.source = self._file.fileno()
+        if self.size > 0:
+            self._mapping = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.source = memoryview(self._mapping)
+
+    # Slices of the source should be released before, including the blocks that worker threads are hashing
+    # The mapping keeps its own descriptor, so the file is closed even when the mapping is only unmapped later
+    def close(self):
+        if self._mapping is not None:
+            close_mapping(self._mapping, self.source)
+            self._mapping = self.source = None
+        self._file.close()
+
+"""
+This class is the storage backend of the files in a directory of the server, the default one
+Files are stored under the name the client sent with the '_svr' suffix, see server_filepath().
+Chunks of delta transfers are kept in the hidden '.chunks' directory, and the list of files is kept by a DirectoryIndex.
+Its methods block on disk I/O, the server calls them from worker threads.
+"""
+class LocalStorage:
+    supports_resume = True # partial files are kept on disk, so interrupted transfers can be resumed
+    max_file_size = None # no limit of its own, the 'max_file_size' of the server applies
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = DirectoryIndex(directory)
+        self._chunk_directory = os.path.join(directory, ".chunks")
+        os.makedirs(directory, exist_ok=True) # the workers of the server may create it at the same time
+
+    # Returns where a file sent by a client is stored, transfers of the same file are matched by it
+    def filepath(self, filename):
+        return server_filepath(self.directory, filename)
+
+    # Returns a sink receiving a file, which is stored once it is committed
+    def open_sink(self, filename, fsync = FSYNC_NEVER, batch_size = WRITE_BATCH_SIZE, size = None, digest = DIGEST_SHA256):
+        return FileSink(self.filepath(filename), fsync, batch_size, size, digest)
+
+    # Returns the partial file of a resumable transfer, with the chunks already received
+    def open_resumable(self, filename, size, chunk_size, fsync = FSYNC_NEVER, batch_size = WRITE_BATCH_SIZE, digest = DIGEST_SHA256):
+        return ResumableFile(self.filepath(filename), size, chunk_size, fsync, batch_size, digest)
+
+    # Returns the chunk store of delta transfers
+    def chunk_store(self, fsync = FSYNC_NEVER):
+        return ChunkStore(self._chunk_directory, fsync)
+
+    # Returns the stored files as a dictionary of filename -> (size, modification time)
+    def files(self):
+        return self.index.files()
+
+    # Returns a stored file to send, raises OSError if there is no such file
+    def open_file(self, filename):
+        return StoredFile(self.filepath(filename))
+
+# Writes the byte range of a file kept in memory, into the bytearray of the file
+class MemoryRangeWriter(RangeWriter):
+    def __init__(self, buffer, offset = 0, batch_size = WRITE_BATCH_SIZE, digest = DIGEST_SHA256):
+        super().__init__(None, offset, FSYNC_NEVER, batch_size, digest)
+        self._buffer = buffer
+
+    def _write(self, buffers, offset):
+        for data in buffers:
+            self._buffer[offset:offset + len(data)] = data # appends to the file when the range ends at its end
+            offset += len(data)
+
+# Receives a file into memory, with the methods of FileSink, the file is stored in its MemoryStorage once it is committed
+# A file of a known size is allocated at once, files larger than the 'max_file_size' of the storage raise ValueError
+class MemorySink:
+    def __init__(self, storage, filename, batch_size = WRITE_BATCH_SIZE, size = None, digest = DIGEST_SHA256):
+        if size is not None and size > storage.max_file_size:
+            raise ValueError(f"File exceeds the maximum size of {storage.max_file_size} bytes kept in memory")
+        self.storage = storage
+        self.filename = filename
+        self.filepath = storage.filepath(filename)
+        self.batch_size = batch_size
+        self.digest = digest
+        self.committed = False
+        self._buffer = bytearray(size or 0)
+        self._writer = MemoryRangeWriter(self._buffer, 0, batch_size, digest)
+
+    @property
+    def size(self):
+        return self._writer.size
+
+    def write(self, data, flush = True):
+        if self._writer.size + len(data) > self.storage.max_file_size:
+            raise ValueError(f"File exceeds the maximum size of {self.storage.max_file_size} bytes kept in memory")
+        self._writer.write(data, flush)
+
+    @property
+    def needs_flush(self):
+        return self._writer.needs_flush
+
+    def flush(self):
+        self._writer.flush()
+
+    def hexdigest(self):
+        return self._writer.hexdigest()
+
+    def range_writer(self, offset):
+        return MemoryRangeWriter(self._buffer, offset, self.batch_size, self.digest)
+
+    def commit(self):
+        self.flush()
+        self.storage.store(self.filename, bytes(self._buffer))
+        self.committed = True
+        return self.filepath
+
+    def abort(self):
+        self._buffer = None
+
+# Keeps the chunks of delta transfers in memory, with the methods of ChunkStore
+class MemoryChunkStore:
+    def __init__(self):
+        self._chunks = {}
+
+    def has(self, checksum):
+        return checksum in self._chunks
+
+    def put(self, checksum, data):
+        if checksum in self._chunks:
+            return False
+        self._chunks[checksum] = bytes(data)
+        return True
+
+    def get(self, checksum):
+        return self._chunks[checksum]
+
+# A file kept in memory that is sent to a client, chunks are sliced from it without copying
+class MemoryFile:
+    def __init__(self, data):
+        self.size = len(data)
+        self.source = memoryview(data)
+
+    def close(self):
+        self.source.release()
+
+"""
+This class is a storage backend that keeps the received files in memory, by the name the client sent
+It suits servers embedded in another service that hands the files on, e.g. from an 'on_file_complete' callback,
+and tests. Resumable transfers need partial files that outlive the server, so they are not supported.
+Files are kept up to 'max_file_size' bytes, the server refuses larger files when their size is announced.
+"""
+class MemoryStorage:
+    supports_resume = False
+
+    def __init__(self, max_file_size = MEMORY_MAX_FILE_SIZE):
+        self.max_file_size = max_file_size
+        self._files = {} # filename -> (content, modification time)
+        self._chunk_store = MemoryChunkStore()
+        self._lock = threading.Lock()
+
+    # Stored files are named like the files listed by the server
+    def _name(self, filename):
+        return safe_relative_path(filename).replace(os.sep, "/")
+
+    def filepath(self, filename):
+        return f"memory:{self._name(filename)}"
+
+    def open_sink(self, filename, fsync = FSYNC_NEVER, batch_size = WRITE_BATCH_SIZE, size = None, digest = DIGEST_SHA256):
+        return MemorySink(self, filename, batch_size, size, digest)
+
+    def open_resumable(self, filename, size, chunk_size, fsync = FSYNC_NEVER, batch_size = WRITE_BATCH_SIZE, digest = DIGEST_SHA256):
+        raise ValueError("Resumable transfers need a storage on disk")
+
+    def chunk_store(self, fsync = FSYNC_NEVER):
+        return self._chunk_store
+
+    def files(self):
+        with self._lock:
+            return {name: (len(content), mtime) for name, (content, mtime) in self._files.items()}
+
+    def open_file(self, filename):
+        with self._lock:
+            if self._name(filename) not in self._files:
+                raise FileNotFoundError(f"No stored file named {filename}")
+            return MemoryFile(self._files[self._name(filename)][0])
+
+    # Stores the content of a file, replacing the file of the same name
+    def store(self, filename, content):
+        with self._lock:
+            self._files[self._name(filename)] = (content, time.time())
+
+    # Returns the content of a stored file, raises KeyError if there is no such file
+    def read(self, filename):
+        with self._lock:
+            return self._files[self._name(filename)][0]
@@ -0,0 +1,9 @@
+"""
+The tests import the modules of FTPQUIC by their flat names, like file_transfer.py does, so the directory is on the path
+Run them with "python -m pytest -q" from the repository or the FTPQUIC directory
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
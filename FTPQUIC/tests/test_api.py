@@ -0,0 +1,216 @@
+"""
+Tests of the library API: an FTClient sends files to an FTServer over loopback, into a MemoryStorage or a LocalStorage,
+and downloads, lists and stats them again
+The certificate is generated like the benchmark suite does, so it is always valid
+"""
+
+import asyncio
+import hashlib
+import os
+import pytest
+import time
+from api import FTClient, FTServer, LocalStorage, MemoryStorage, TRANSFER_VERIFIED, TRANSFER_FAILED, TRANSFER_ERROR
+from bench import generate_certificate, free_port, BENCH_HOST
+from ft_client import receive_file_stream, list_files, stat_files
+from ft_server import SEND_BLOCK_SIZE
+from pdu import WIRE_FORMAT_BINARY
+from ft_quic import QuicStreamEvent
+from utils import FrameReassembler, read_reply
+import pdu
+from tickets import ClientTicketCache
+
+@pytest.fixture(scope="module")
+def certificate(tmp_path_factory):
+    return generate_certificate(str(tmp_path_factory.mktemp("certificate")))
+
+# Runs 'test' with a client connected to a server that stores into 'storage', and returns the verified files
+def run_loopback(certificate, test, storage = None, **server_options):
+    cert_file, key_file = certificate
+    port = free_port()
+    received = []
+
+    async def run():
+        async with FTServer(BENCH_HOST, port, cert_file=cert_file, key_file=key_file, storage=storage or MemoryStorage(),
+                            on_file_complete=received.append, **server_options) as server:
+            async with FTClient(BENCH_HOST, port, cert_file) as client:
+                await test(client, server)
+    asyncio.run(asyncio.wait_for(run(), 60))
+    return received
+
+async def pieces(data, size):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+def test_upload_bytes_iterables_and_files(certificate, tmp_path):
+    data = os.urandom(300_000)
+    path = tmp_path / "file.bin"
+    path.write_bytes(data)
+    storage = MemoryStorage()
+
+    async def test(client, server):
+        for source, filename, options in ((data, "bytes.bin", {}), (pieces(data, 7000), "iterable.bin", {}),
+                                          (str(path), "file.bin", {}), (str(path), "ranges.bin", {"streams": 3}),
+                                          (data, "compressed.bin", {"compression": "zlib"})):
+            result = await client.upload(source, filename, **options)
+            assert result.status == TRANSFER_VERIFIED, (filename, result.error)
+            assert result.size == len(data)
+
+    received = run_loopback(certificate, test, storage)
+    assert sorted(file.filename for file in received) == ["bytes.bin", "compressed.bin", "file.bin", "iterable.bin", "ranges.bin"]
+    for file in received:
+        assert bytes(storage.read(file.filename)) == data
+        assert file.checksum in (None, hashlib.sha256(data).hexdigest()) # ranges are verified on their own
+
+def test_files_over_the_size_limits_are_refused(certificate):
+    storage = MemoryStorage(max_file_size=100_000)
+
+    async def test(client, server):
+        assert (await client.upload(os.urandom(50_000), "small.bin", streams=2)).status == TRANSFER_VERIFIED
+        assert (await client.upload(os.urandom(150_000), "ranges.bin", streams=2)).status == TRANSFER_FAILED
+        assert (await client.upload(os.urandom(150_000), "stream.bin")).status == TRANSFER_FAILED
+        # The connection is still usable after the refused files
+        assert (await client.upload(b"last", "last.bin")).status == TRANSFER_VERIFIED
+
+    received = run_loopback(certificate, test, storage, max_file_size=1_000_000)
+    assert sorted(file.filename for file in received) == ["last.bin", "small.bin"]
+    assert sorted(storage.files()) == ["last.bin", "small.bin"]
+
+# Errors of the source are returned in the result of the upload instead of being raised
+def test_upload_errors_are_returned(certificate):
+    async def broken_pieces():
+        yield b"first piece"
+        raise RuntimeError("source failed")
+
+    async def test(client, server):
+        result = await client.upload(broken_pieces(), "broken.bin")
+        assert result.status == TRANSFER_ERROR and "source failed" in result.error
+        assert (await client.upload(b"next", "next.bin")).status == TRANSFER_VERIFIED
+
+    received = run_loopback(certificate, test)
+    assert [file.filename for file in received] == ["next.bin"]
+
+# A second client resumes the TLS session of the first one and sends its first PDUs as 0-RTT data
+def test_session_resumption_with_a_ticket_cache(certificate, tmp_path):
+    ticket_cache = ClientTicketCache(str(tmp_path / "tickets.bin"))
+
+    async def test(client, server):
+        cert_file, _ = certificate
+        for attempt in range(2):
+            async with FTClient(BENCH_HOST, client.port, cert_file, ticket_cache=ticket_cache) as resuming_client:
+                result = await resuming_client.upload(b"early data", f"early{attempt}.bin")
+                assert result.status == TRANSFER_VERIFIED
+                early_data = resuming_client._connections[0].client.early_alpn is not None
+                assert early_data == (attempt == 1)
+
+    run_loopback(certificate, test)
+
+# Returns the FTQuicConnection of a connection of the client and its wire format, for the requests FTClient has no method for
+async def ft_connection(client):
+    connection, _ = await client._acquire()
+    handler = connection.client._client_handler
+    return handler.ft_connection(), handler.scope["wire_format"]
+
+# Files are sent by the server from their mapping, as a whole or as a range, over one or more blocks of SEND_BLOCK_SIZE
+def test_download_files_and_ranges(certificate, tmp_path):
+    small = os.urandom(5000)
+    large = os.urandom(SEND_BLOCK_SIZE * 2 + 12345)
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+
+    async def test(client, server):
+        for data, filename in ((b"0123456789", "tiny.bin"), (small, "small.bin"), (large, "large.bin"), (b"", "empty.bin")):
+            assert (await client.upload(data, filename)).status == TRANSFER_VERIFIED
+        conn, wire_format = await ft_connection(client)
+        assert wire_format == WIRE_FORMAT_BINARY # negotiated by default, downloads need it
+        for data, filename, offset, length in ((b"0123456789", "tiny.bin", 0, None), (small, "small.bin", 0, None),
+                                               (large, "large.bin", 0, None), (b"", "empty.bin", 0, None),
+                                               (small, "small.bin", 100, 900), (small, "small.bin", 0, 5000),
+                                               (small, "small.bin", 4096, 0), (small, "small.bin", 4000, 10_000),
+                                               (large, "large.bin", SEND_BLOCK_SIZE - 10, 20)):
+            path = downloads / f"{filename}.{offset}.{length}"
+            assert await receive_file_stream(conn.open_stream(), wire_format, filename, str(path), offset, length)
+            expected = data[offset:] if length is None else data[offset:offset + length]
+            assert path.read_bytes() == expected, (filename, offset, length)
+
+        # Missing files and invalid ranges are refused, and nothing is saved
+        for filename, offset, length in (("missing.bin", 0, None), ("small.bin", 5001, None), ("small.bin", 0, -1)):
+            path = downloads / "refused.bin"
+            assert not await receive_file_stream(conn.open_stream(), wire_format, filename, str(path), offset, length)
+            assert not path.exists()
+
+    run_loopback(certificate, test, LocalStorage(str(tmp_path / "server")))
+
+def test_list_and_stat_files(certificate, tmp_path):
+    async def test(client, server):
+        for filename, size in (("docs/a.txt", 10), ("docs/b.txt", 2000), ("other.bin", 300)):
+            assert (await client.upload(os.urandom(size), filename)).status == TRANSFER_VERIFIED
+        conn, wire_format = await ft_connection(client)
+
+        listed = await list_files(conn, wire_format, [""])
+        assert sorted((info["name"], info["size"]) for info in listed) == [("docs/a.txt", 10), ("docs/b.txt", 2000), ("other.bin", 300)]
+        assert sorted(info["name"] for info in await list_files(conn, wire_format, ["docs"])) == ["docs/a.txt", "docs/b.txt"]
+
+        stated = await stat_files(conn, wire_format, ["other.bin", "missing.bin"])
+        assert [(info["name"], info["size"]) for info in stated] == [("other.bin", 300)]
+        assert all(abs(info["mtime"] - time.time()) < 60 for info in stated)
+
+    run_loopback(certificate, test, LocalStorage(str(tmp_path / "server")))
+
+# Sends a file as START, DATA and END PDUs, with 'overall_checksum' in the END, and returns the ACK of the server
+async def send_raw_file(client, filename, data, overall_checksum, chunk_size = 1000):
+    conn, wire_format = await ft_connection(client)
+    stream = conn.open_stream()
+    reassembler = FrameReassembler(stream, role="client")
+    START_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_START, filename, filename=filename, options={"chunk_size": chunk_size})
+    await stream.send(QuicStreamEvent(stream.stream_id, START_datagram.to_framed_bytes(wire_format), False))
+    for sequence, position in enumerate(range(0, len(data), chunk_size)):
+        chunk = data[position:position + chunk_size]
+        DATA_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_DATA, chunk, filename=filename, checksum=hashlib.sha256(chunk).hexdigest(), sequence=sequence)
+        await stream.send(QuicStreamEvent(stream.stream_id, DATA_datagram.to_framed_bytes(wire_format), False))
+    END_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_END, "Ending File Transmission", filename=filename, checksum=overall_checksum)
+    await stream.send(QuicStreamEvent(stream.stream_id, END_datagram.to_framed_bytes(wire_format), True))
+    ACK_datagram = await asyncio.wait_for(read_reply(stream, wire_format, reassembler), 5)
+    stream.close()
+    return ACK_datagram.msg
+
+# Received files are streamed to a temporary file, which only gets the final name of the file once it is verified
+def test_plain_uploads_are_stored_once_verified(certificate, tmp_path):
+    directory = tmp_path / "server"
+    data = os.urandom(4500)
+
+    async def test(client, server):
+        ACK = await send_raw_file(client, "bad.bin", data, hashlib.sha256(b"something else").hexdigest())
+        assert ACK == "File Transfer Failed (Checksum Mismatch)"
+        assert os.listdir(directory) == [] # the temporary file was removed
+        ACK = await send_raw_file(client, "good.bin", data, hashlib.sha256(data).hexdigest())
+        assert ACK == "File Transfer Successful (Checksum Verified)"
+
+    received = run_loopback(certificate, test, LocalStorage(str(directory)))
+    assert [file.filename for file in received] == ["good.bin"]
+    assert os.listdir(directory) == ["good_svr.bin"]
+    assert (directory / "good_svr.bin").read_bytes() == data
+
+# With a send window smaller than a chunk, every chunk waits for its acknowledgement and the file still arrives whole
+def test_upload_with_a_small_send_window(certificate):
+    data = os.urandom(1_500_000)
+    storage = MemoryStorage()
+
+    async def test(client, server):
+        async with FTClient(BENCH_HOST, client.port, certificate[0], send_window=4096) as small_window_client:
+            assert (await small_window_client.upload(data, "window.bin")).status == TRANSFER_VERIFIED
+
+    run_loopback(certificate, test, storage)
+    assert bytes(storage.read("window.bin")) == data
+
+# Adaptive chunks grow with the throughput and the RTT measured by the connection, the server buffers the announced maximum
+def test_upload_with_adaptive_chunk_sizes(certificate):
+    data = os.urandom(3_000_000)
+    storage = MemoryStorage()
+
+    async def test(client, server):
+        for options in ({}, {"streams": 2}):
+            assert (await client.upload(data, f"auto{len(options)}.bin", chunk_size="auto", **options)).status == TRANSFER_VERIFIED
+        assert client._connections[0].client.smoothed_rtt() > 0
+
+    run_loopback(certificate, test, storage)
+    assert bytes(storage.read("auto0.bin")) == bytes(storage.read("auto1.bin")) == data
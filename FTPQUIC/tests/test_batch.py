@@ -0,0 +1,65 @@
+"""
+Tests of batch transfers: the paths given to the client are expanded into files, which are sent over one connection
+several at a time, and downloaded again into an output directory
+"""
+
+import asyncio
+import os
+import pytest
+import ft_client
+import quic_engine
+from api import FTServer, MemoryStorage
+from bench import generate_certificate, free_port, BENCH_HOST
+from utils import expand_paths
+
+@pytest.fixture(scope="module")
+def certificate(tmp_path_factory):
+    return generate_certificate(str(tmp_path_factory.mktemp("certificate")))
+
+@pytest.fixture
+def tree(tmp_path):
+    files = {"top.txt": b"top", "docs/a.txt": b"a" * 5000, "docs/b.bin": os.urandom(70_000), "docs/deep/c.txt": b"c"}
+    for name, content in files.items():
+        path = tmp_path / "tree" / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+    return tmp_path / "tree", files
+
+# Directories are walked in order, the files of a directory before its subdirectories
+# Patterns are matched, and other paths are kept as they are even if they do not exist
+def test_expand_paths(tree):
+    root, _ = tree
+    assert expand_paths([str(root)]) == [str(root / name) for name in ("top.txt", "docs/a.txt", "docs/b.bin", "docs/deep/c.txt")]
+    assert expand_paths([str(root / "docs" / "*.txt"), str(root / "missing.txt")]) == [str(root / "docs" / "a.txt"), str(root / "missing.txt")]
+    assert expand_paths([str(root / "**" / "c.txt")]) == [str(root / "docs" / "deep" / "c.txt")]
+
+# Runs the client of the command line with 'scope' against a server storing into 'storage', returns its results
+def run_batch(certificate, storage, filenames, scope):
+    cert_file, key_file = certificate
+    port = free_port()
+
+    async def run():
+        async with FTServer(BENCH_HOST, port, cert_file=cert_file, key_file=key_file, storage=storage):
+            configuration = quic_engine.build_client_quic_config(cert_file)
+            return await quic_engine.run_client(BENCH_HOST, port, configuration, filenames, dict(scope))
+    return asyncio.run(asyncio.wait_for(run(), 60))
+
+def test_batch_upload_and_download(certificate, tree, tmp_path, monkeypatch):
+    root, files = tree
+    monkeypatch.chdir(root) # files are sent under the paths they are given with
+    storage = MemoryStorage()
+    filenames = expand_paths(["."]) + ["missing.txt"]
+
+    results = run_batch(certificate, storage, filenames, {"concurrency": 3})
+    assert sorted(result["filename"] for result in results) == sorted(filenames)
+    for result in results:
+        assert result["successful"] == (result["filename"] != "missing.txt"), result
+    for name, content in files.items():
+        assert bytes(storage.read(name)) == content
+
+    output_dir = tmp_path / "downloads"
+    scope = {"operation": ft_client.OPERATION_GET, "output_dir": str(output_dir), "concurrency": 2}
+    results = run_batch(certificate, storage, list(files), scope)
+    assert all(result["successful"] for result in results)
+    for name, content in files.items():
+        assert (output_dir / name).read_bytes() == content
@@ -0,0 +1,84 @@
+"""
+Tests of the benchmark suite: the payloads and the proxy of the transfer benchmarks, a set sent over loopback, and
+the microbenchmarks run for a few rounds
+"""
+
+import asyncio
+import os
+import pytest
+import bench
+import microbench
+from bench import generate_certificate, generate_payload, percentile, LossyLinkProxy, BENCH_HOST, free_port
+
+@pytest.fixture(scope="module")
+def certificate(tmp_path_factory):
+    return generate_certificate(str(tmp_path_factory.mktemp("certificate")))
+
+def test_percentile():
+    assert percentile([], 50) is None
+    values = [5, 1, 4, 2, 3]
+    assert [percentile(values, percent) for percent in (1, 20, 21, 50, 99, 100)] == [1, 1, 2, 3, 5, 5]
+
+def test_generate_payload(tmp_path, monkeypatch):
+    monkeypatch.setattr(bench, "WRITE_SIZE", 1000) # files are written in several pieces
+    monkeypatch.setitem(bench.PAYLOAD_SETS, "test", (3, 2500))
+    filenames = generate_payload(str(tmp_path), "test")
+    assert filenames == [str(tmp_path / "test" / f"file_{index:05d}.bin") for index in range(3)]
+    contents = [open(filename, "rb").read() for filename in filenames]
+    assert [len(content) for content in contents] == [2500] * 3
+    assert len(set(contents)) == 3 # random content
+
+# Sends datagrams through the proxy to an echo server and returns the replies received within 'timeout'
+async def echo_through_proxy(proxy, datagrams, timeout = 0.3):
+    loop = asyncio.get_running_loop()
+    echo, _ = await loop.create_datagram_endpoint(lambda: bench.ProxyEndpoint(lambda data, addr: echo.sendto(data, addr)),
+                                                  local_addr=(BENCH_HOST, 0))
+    proxy.target = echo.get_extra_info("sockname")
+    port = free_port()
+    await proxy.start(port)
+    replies = []
+    client, _ = await loop.create_datagram_endpoint(lambda: bench.ProxyEndpoint(lambda data, addr: replies.append(data)),
+                                                    remote_addr=(BENCH_HOST, port))
+    try:
+        for data in datagrams:
+            client.sendto(data)
+        await asyncio.sleep(timeout)
+    finally:
+        client.close()
+        proxy.close()
+        echo.close()
+    return replies
+
+def test_proxy_forwards_in_both_directions_with_a_delay():
+    proxy = LossyLinkProxy(None, delay=0.01)
+    replies = asyncio.run(echo_through_proxy(proxy, [b"one", b"two"]))
+    assert replies == [b"one", b"two"]
+    assert proxy.forwarded == 4 and proxy.dropped == 0
+
+def test_proxy_drops_datagrams():
+    proxy = LossyLinkProxy(None, loss=1.0)
+    assert asyncio.run(echo_through_proxy(proxy, [b"one", b"two"])) == []
+    assert proxy.forwarded == 0 and proxy.dropped == 2
+
+def test_bench_set_over_loopback(certificate, tmp_path, monkeypatch):
+    monkeypatch.setitem(bench.PAYLOAD_SETS, "test", (2, 3000))
+    filenames = generate_payload(str(tmp_path), "test")
+    cert_file, key_file = certificate
+    server_directory = str(tmp_path / "server_files")
+    result = bench.bench_set("test", filenames, cert_file, key_file, bench.WIRE_FORMATS["binary"], {"concurrency": 2},
+                             0.0, 0.0, 2, server_directory)
+    assert result["set"] == "test" and result["files"] == 4 and result["successful"] == 4
+    assert result["bytes"] == 4 * 3000 and result["dropped_datagrams"] == 0
+    assert result["mb_s"] > 0 and result["latency_p50_ms"] <= result["latency_p99_ms"]
+    assert not os.path.exists(server_directory) # the received files are removed after every run
+
+def test_microbenchmarks():
+    pdu_results = microbench.bench_pdu(1024, 5)
+    assert pdu_results["binary"]["wire_bytes"] < pdu_results["json"]["wire_bytes"] # no base64
+    assert microbench.bench_receive(1024, 5)["us_per_chunk"] > 0
+    queue_results = microbench.bench_queue(1024, 20, burst=10)
+    assert set(queue_results) == {"asyncio.Queue", "StreamEventQueue"}
+    assert queue_results["asyncio.Queue"]["pauses"] is None
+
+def test_allocated_bytes():
+    assert microbench.allocated_bytes(lambda: bytearray(10_000), count=10) >= 10_000
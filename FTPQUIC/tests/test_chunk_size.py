@@ -0,0 +1,74 @@
+"""
+Tests of the chunk size: AdaptiveChunkSize sizes chunks from the measured throughput and RTT, on a fake clock,
+and a chunk size announced in the START PDU is used by the server for its buffers
+"""
+
+import argparse
+import pytest
+import ft_client
+from ft_client import AdaptiveChunkSize, MIN_CHUNK_SIZE, MEASURE_INTERVAL
+from file_transfer import chunk_size_arg
+from ft_server import announced_chunk_size, write_batch_size, MAX_BUFFERED_CHUNK_SIZE
+from storage import WRITE_BATCH_SIZE
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def perf_counter(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ft_client, "time", clock)
+    return clock
+
+# Sends at 'throughput' bytes per second for a bit more than a measurement interval, returns the chunk size after it
+def send_interval(chunk_size, clock, throughput):
+    seconds = MEASURE_INTERVAL * 1.5
+    clock.now += seconds
+    chunk_size.sent(int(throughput * seconds))
+    return chunk_size.size
+
+def test_chunk_size_doubles_up_to_the_maximum_on_fast_links(clock):
+    chunk_size = AdaptiveChunkSize(maximum=64 * 1024)
+    assert chunk_size.size == MIN_CHUNK_SIZE
+    sizes = [send_interval(chunk_size, clock, 1e9) for _ in range(6)]
+    assert sizes == [8192, 16384, 32768, 65536, 65536, 65536] # at most doubles per interval
+
+def test_chunk_size_halves_down_to_the_minimum_on_slow_links(clock):
+    chunk_size = AdaptiveChunkSize()
+    chunk_size.size = 64 * 1024
+    sizes = [send_interval(chunk_size, clock, 100_000) for _ in range(6)]
+    assert sizes == [32768, 16384, 8192, 4096, 4096, 4096]
+
+def test_chunk_size_is_kept_within_an_interval(clock):
+    chunk_size = AdaptiveChunkSize()
+    clock.now += MEASURE_INTERVAL / 2
+    chunk_size.sent(10_000_000)
+    assert chunk_size.size == MIN_CHUNK_SIZE
+
+# At 1 MB/s a chunk takes 5 ms at 5 KB, with a 100 ms RTT a quarter of it holds 25 KB, so chunks grow to 16 KiB
+@pytest.mark.parametrize("rtt, size", [(None, 4096), (0.0, 4096), (0.1, 16384)])
+def test_chunk_size_grows_with_the_rtt(clock, rtt, size):
+    chunk_size = AdaptiveChunkSize(rtt=(lambda: rtt) if rtt is not None else None)
+    for _ in range(4):
+        send_interval(chunk_size, clock, 1_000_000)
+    assert chunk_size.size == size
+
+def test_chunk_size_argument():
+    assert chunk_size_arg("auto") == "auto"
+    assert chunk_size_arg("65536") == 65536
+    for value in ("0", "-1", "large"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            chunk_size_arg(value)
+
+# The server sizes its buffers for the largest chunk the client announced, up to its own limit
+def test_announced_chunk_size():
+    assert announced_chunk_size({}) == 0
+    assert announced_chunk_size({"chunk_size": 4096}) == 4096
+    assert announced_chunk_size({"chunk_size": 4096, "max_chunk_size": 1024 * 1024}) == 1024 * 1024
+    assert announced_chunk_size({"chunk_size": MAX_BUFFERED_CHUNK_SIZE * 2}) == MAX_BUFFERED_CHUNK_SIZE
+    assert write_batch_size({"chunk_size": 4096}) == WRITE_BATCH_SIZE
+    assert write_batch_size({"chunk_size": WRITE_BATCH_SIZE * 4}) == WRITE_BATCH_SIZE * 4
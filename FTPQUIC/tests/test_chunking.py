@@ -0,0 +1,80 @@
+"""
+Tests of the content-defined chunking of delta transfers and of the ChunkStore that keeps the chunks on the server
+"""
+
+import hashlib
+import io
+import random
+import pytest
+from chunking import find_cut, iter_chunks, chunk_file, MIN_CHUNK_SIZE, AVERAGE_CHUNK_SIZE, MAX_CHUNK_SIZE, MASK_BEFORE_AVERAGE, MASK_AFTER_AVERAGE
+from storage import ChunkStore
+
+@pytest.fixture(scope="module")
+def content():
+    return random.Random(8).randbytes(400 * 1024)
+
+def cut_chunks(data):
+    return list(iter_chunks(io.BytesIO(data)))
+
+def test_chunks_cover_the_data_within_bounds(content):
+    chunks = cut_chunks(content)
+    assert b"".join(chunks) == content
+    assert all(MIN_CHUNK_SIZE < len(chunk) <= MAX_CHUNK_SIZE for chunk in chunks[:-1])
+    assert 10 < len(chunks) < 200 # around the 8 KiB average
+
+def test_short_data_is_one_chunk():
+    assert find_cut(b"x" * MIN_CHUNK_SIZE, 0, MIN_CHUNK_SIZE) == MIN_CHUNK_SIZE
+    assert cut_chunks(b"") == []
+
+# FastCDC with the full 64-bit gear hash, as the first versions of the client cut files
+def reference_cut(data, start, size):
+    gear = random.Random(544)
+    gear = [gear.getrandbits(64) for _ in range(256)]
+    if size <= MIN_CHUNK_SIZE:
+        return size
+    rolling_hash = 0
+    for position in range(start + MIN_CHUNK_SIZE, start + min(size, MAX_CHUNK_SIZE)):
+        rolling_hash = ((rolling_hash << 1) + gear[data[position]]) & 0xFFFFFFFFFFFFFFFF
+        mask = MASK_BEFORE_AVERAGE if position < start + AVERAGE_CHUNK_SIZE else MASK_AFTER_AVERAGE
+        if not rolling_hash & mask:
+            return position + 1 - start
+    return min(size, MAX_CHUNK_SIZE)
+
+# The hash is kept to the bits the masks test, clients still cut files where the earlier versions did
+def test_cuts_match_the_64_bit_gear_hash(content):
+    data = content + b"\0" * MAX_CHUNK_SIZE * 2 # and repeated bytes
+    start = 0
+    while start < len(data):
+        for size in (len(data) - start, min(len(data) - start, AVERAGE_CHUNK_SIZE + 100)):
+            assert find_cut(data, start, size) == reference_cut(data, start, size)
+        start += find_cut(data, start, len(data) - start)
+
+# An insertion only changes the chunks around it, the cuts after it are found again
+def test_cuts_are_stable_after_an_insertion(content):
+    middle = len(content) // 2
+    edited = content[:middle] + b"12345" + content[middle:]
+    before = {hashlib.sha256(chunk).digest() for chunk in cut_chunks(content)}
+    after = [hashlib.sha256(chunk).digest() for chunk in cut_chunks(edited)]
+    changed = [digest for digest in after if digest not in before]
+    assert 1 <= len(changed) <= 2
+
+def test_chunk_file_matches_the_chunks(tmp_path, content):
+    path = tmp_path / "file.bin"
+    path.write_bytes(content)
+    chunks, file_checksum = chunk_file(str(path))
+    assert file_checksum == hashlib.sha256(content).hexdigest()
+    assert [length for _, length, _ in chunks] == [len(chunk) for chunk in cut_chunks(content)]
+    for offset, length, checksum in chunks:
+        assert hashlib.sha256(content[offset:offset + length]).hexdigest() == checksum
+
+def test_chunk_store(tmp_path):
+    store = ChunkStore(str(tmp_path / ".chunks"))
+    data = b"chunk data"
+    checksum = hashlib.sha256(data).hexdigest()
+    assert not store.has(checksum)
+    assert store.put(checksum, data)
+    assert not store.put(checksum, data) # stored once
+    assert store.has(checksum)
+    assert store.get(checksum) == data
+    with pytest.raises(ValueError):
+        store.has("../../etc/passwd")
@@ -0,0 +1,63 @@
+"""
+Tests of the chunk compression: the round trip of every available codec, the bounded decompression, and the
+ChunkCompressor turning compression off for incompressible content and probing it again
+"""
+
+import os
+import pytest
+import tracemalloc
+from compression import (ChunkCompressor, decompress_chunk, CODECS, COMPRESSION_ZLIB, INCOMPRESSIBLE_CHUNKS,
+                         PROBE_INTERVAL)
+
+TEXT_CHUNK = b"a compressible chunk of text " * 200
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_round_trip(codec):
+    compressed = ChunkCompressor(codec).compress(TEXT_CHUNK)
+    assert compressed is not None and len(compressed) < len(TEXT_CHUNK)
+    assert bytes(decompress_chunk(compressed, codec, len(TEXT_CHUNK))) == TEXT_CHUNK
+
+# A chunk that expands past the announced chunk size is refused, like a corrupted one
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_decompression_is_bounded(codec):
+    compressed = ChunkCompressor(codec).compress(TEXT_CHUNK)
+    with pytest.raises(ValueError):
+        decompress_chunk(compressed, codec, len(TEXT_CHUNK) - 1)
+    with pytest.raises(ValueError):
+        decompress_chunk(b"not compressed data", codec, len(TEXT_CHUNK))
+
+def test_unsupported_codec():
+    with pytest.raises(ValueError):
+        ChunkCompressor("rot13")
+    with pytest.raises(ValueError):
+        decompress_chunk(b"", "rot13", 10)
+
+def test_incompressible_chunks_turn_compression_off_and_probe_again():
+    compressor = ChunkCompressor(COMPRESSION_ZLIB)
+    random_chunk = os.urandom(4096)
+    for _ in range(INCOMPRESSIBLE_CHUNKS):
+        assert compressor.enabled
+        assert compressor.compress(random_chunk) is None
+    assert not compressor.enabled
+    # Compressible chunks are sent as they are until the next probe, which turns compression on again
+    results = [compressor.compress(TEXT_CHUNK) for _ in range(PROBE_INTERVAL)]
+    assert results[:-1] == [None] * (PROBE_INTERVAL - 1)
+    assert results[-1] is not None
+    assert compressor.enabled
+
+# zstd frames can declare the size of their content, which decompress() would allocate whatever the limit
+def test_zstd_declared_content_size_is_checked_first():
+    zstandard = pytest.importorskip("zstandard")
+    declared = zstandard.ZstdCompressor().compress(b"\0" * 20_000_000)
+    assert zstandard.frame_content_size(declared) == 20_000_000
+    tracemalloc.start()
+    try:
+        with pytest.raises(ValueError, match="larger than the chunk size"):
+            decompress_chunk(declared, "zstd", 4096)
+        assert tracemalloc.get_traced_memory()[1] < 1_000_000 # the declared size was not allocated
+    finally:
+        tracemalloc.stop()
+    undeclared = zstandard.ZstdCompressor(write_content_size=False).compress(b"\0" * 10_000)
+    with pytest.raises(ValueError):
+        decompress_chunk(undeclared, "zstd", 4096)
+    assert bytes(decompress_chunk(undeclared, "zstd", 10_000)) == b"\0" * 10_000
@@ -0,0 +1,82 @@
+"""
+Tests of the offload pool: disk I/O runs in worker threads, CPU bound jobs in threads or processes, and the jobs of
+one transfer go through a bounded queue
+"""
+
+import asyncio
+import hashlib
+import os
+import threading
+import zlib
+import pytest
+from executor import Offloader, get_offloader, EXECUTOR_PROCESS, OFFLOAD_MIN_SIZE
+from metrics import metrics
+
+@pytest.fixture(params=["thread", "process"])
+def offloader(request):
+    offloader = Offloader(request.param, 2)
+    yield offloader
+    offloader.shutdown()
+
+def histogram_count(name, role):
+    return metrics.to_json()["histograms"].get(f"{name}/{role}", {"count": 0})["count"]
+
+def current_thread_name():
+    return threading.current_thread().name
+
+def test_io_runs_in_threads_and_cpu_jobs_in_processes(offloader):
+    async def test():
+        assert (await offloader.run_io(current_thread_name)).startswith("ft-io")
+        return await offloader.run_cpu(os.getpid)
+    pid = asyncio.run(test())
+    assert (pid != os.getpid()) == (offloader.kind == EXECUTOR_PROCESS)
+
+def test_unknown_executor():
+    with pytest.raises(ValueError):
+        Offloader("fiber")
+
+# A transfer submits at most 'limit' jobs at a time, the next one waits for a slot
+def test_job_queue_is_bounded():
+    offloader = Offloader()
+    release = threading.Event()
+
+    async def test():
+        jobs = offloader.queue(limit=2)
+        first = await jobs.submit_io(release.wait)
+        second = await jobs.submit_io(release.wait)
+        third = asyncio.ensure_future(jobs.submit_io(lambda: "third"))
+        await asyncio.sleep(0.05)
+        assert not third.done() # waiting for a slot
+        release.set()
+        assert await first and await second
+        assert await (await asyncio.wait_for(third, 1)) == "third"
+    try:
+        asyncio.run(test())
+    finally:
+        release.set()
+        offloader.shutdown()
+
+# Small buffers are hashed on the event loop, larger ones in the pool, the time is added to the histograms either way
+def test_hexdigest_and_decompress(offloader):
+    small = os.urandom(100)
+    large = memoryview(os.urandom(OFFLOAD_MIN_SIZE * 2))
+    compressed = zlib.compress(bytes(large))
+    hashes = histogram_count("hash_seconds", "executor-test")
+
+    async def test():
+        jobs = offloader.queue()
+        assert await jobs.hexdigest(small, role="executor-test") == hashlib.sha256(small).hexdigest()
+        assert await jobs.hexdigest(large, role="executor-test") == hashlib.sha256(large).hexdigest()
+        assert bytes(await jobs.decompress(compressed, "zlib", len(large))) == large
+        return await jobs.run_io_timed("disk_write_seconds", "executor-test", len, b"12345")
+    assert asyncio.run(test()) == 5
+    assert histogram_count("hash_seconds", "executor-test") == hashes + 2
+    assert histogram_count("disk_write_seconds", "executor-test") >= 1
+
+def test_get_offloader():
+    offloader = Offloader()
+    try:
+        assert get_offloader({"offloader": offloader}) is offloader
+        assert get_offloader({}) is get_offloader({}) # shared by the handlers without one
+    finally:
+        offloader.shutdown()
@@ -0,0 +1,139 @@
+"""
+Tests of the metrics: stream counters are added to the totals when the stream ends, timings go to histograms, and
+the metrics are exported in the Prometheus text format and as JSON, summed over the worker processes of a server
+"""
+
+import asyncio
+import json
+import socket
+import pytest
+from metrics import Metrics, Histogram, WorkerMetrics, STREAM_COUNTERS, serve_metrics, dump_metrics_periodically
+
+# Returns a registry with one client connection, with a finished stream and a stream that did not end yet
+def registry():
+    metrics = Metrics()
+    metrics.open_connection("c1", "client")
+    finished = metrics.open_stream("c1", 0, "client")
+    finished.bytes, finished.chunks, finished.checksum_failures = 5000, 5, 1
+    metrics.finish_stream(finished, True)
+    open_stream = metrics.open_stream("c1", 4, "client")
+    open_stream.bytes, open_stream.chunks = 2000, 2
+    return metrics, finished, open_stream
+
+def test_stream_counters_are_added_when_the_stream_ends():
+    metrics, finished, open_stream = registry()
+    counters = metrics.counters()
+    assert counters[("bytes_total", "client", "")] == 7000 # including the stream that did not end yet
+    assert counters[("chunks_total", "client", "")] == 7
+    assert counters[("checksum_failures_total", "client", "")] == 1
+    assert counters[("transfers_total", "client", "success")] == 1
+    assert counters[("open_connections", "client", "")] == 1
+    metrics.finish_stream(finished, False) # counted once
+    metrics.finish_stream(open_stream, False)
+    counters = metrics.counters()
+    assert counters[("bytes_total", "client", "")] == 7000
+    assert counters[("transfers_total", "client", "failure")] == 1
+    metrics.close_connection("c1")
+    assert metrics.counters()[("open_connections", "client", "")] == 0
+    [closed] = metrics.to_json()["closed_connections"]
+    assert closed["totals"]["bytes"] == 7000 and closed["open_streams"] == []
+
+def test_histogram_buckets():
+    histogram = Histogram(buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+    assert histogram.cumulative() == [(0.1, 2), (1.0, 3), (float("inf"), 4)] # bounds are inclusive
+    assert histogram.to_dict() == {"count": 4, "sum": pytest.approx(2.65), "buckets": {"0.1": 2, "1.0": 3, "+Inf": 4}}
+
+def test_timer_observes_its_block():
+    metrics = Metrics()
+    with metrics.timer("hash_seconds", "server"):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.timer("hash_seconds", "server"):
+            raise ValueError # timed, and not swallowed
+    assert metrics.to_json()["histograms"]["hash_seconds/server"]["count"] == 2
+
+def test_prometheus_format():
+    metrics, _, _ = registry()
+    metrics.observe("hash_seconds", 0.003, "client")
+    lines = metrics.to_prometheus().splitlines()
+    assert "# TYPE ftquic_bytes_total counter" in lines
+    assert 'ftquic_bytes_total{role="client"} 7000' in lines
+    assert 'ftquic_transfers_total{role="client",result="success"} 1' in lines
+    assert "# TYPE ftquic_open_connections gauge" in lines
+    assert "# TYPE ftquic_hash_seconds histogram" in lines
+    assert 'ftquic_hash_seconds_bucket{role="client",le="0.001"} 0' in lines
+    assert 'ftquic_hash_seconds_bucket{role="client",le="0.005"} 1' in lines
+    assert 'ftquic_hash_seconds_bucket{role="client",le="+Inf"} 1' in lines
+    assert 'ftquic_hash_seconds_count{role="client"} 1' in lines
+
+def test_json_dump(tmp_path):
+    metrics, _, _ = registry()
+    path = tmp_path / "metrics.json"
+    metrics.write_json(str(path))
+    dump = json.loads(path.read_text())
+    assert dump["counters"]["transfers_total"] == {"client/success": 1}
+    assert dump["counters"]["bytes_total"] == {"client": 7000}
+    [connection] = dump["connections"]
+    assert connection["connection_id"] == "c1" and connection["totals"]["bytes"] == 7000
+    assert [stream["stream_id"] for stream in connection["open_streams"]] == [4]
+    assert set(STREAM_COUNTERS) <= set(connection["open_streams"][0])
+    assert list(tmp_path.iterdir()) == [path] # the temporary file was replaced
+
+# The parent of the worker processes exports the sum of the latest state of every worker
+def test_worker_metrics_are_merged():
+    first, _, _ = registry()
+    second = Metrics()
+    second.inc("forwarded_datagrams_total", 3, role="server")
+    second.observe("hash_seconds", 0.003, "client")
+    first.observe("hash_seconds", 0.5, "client")
+    workers = WorkerMetrics()
+    workers.update(0, first.state())
+    workers.update(1, second.state())
+    workers.update(1, second.state()) # replaces the earlier state of the worker
+    dump = workers.merged().to_json()
+    assert dump["counters"]["bytes_total"] == {"client": 7000}
+    assert dump["counters"]["forwarded_datagrams_total"] == {"server": 3}
+    assert dump["histograms"]["hash_seconds/client"]["count"] == 2
+    assert [(connection["connection_id"], connection["worker"]) for connection in dump["connections"]] == [("c1", 0)]
+    assert 'ftquic_forwarded_datagrams_total{role="server"} 3' in workers.to_prometheus().splitlines()
+
+def test_metrics_are_served_over_http():
+    metrics, _, _ = registry()
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    async def test():
+        server = asyncio.ensure_future(serve_metrics("127.0.0.1", port, metrics))
+        try:
+            for _ in range(50):
+                try:
+                    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                    break
+                except OSError:
+                    await asyncio.sleep(0.01) # not listening yet
+            writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+            return response
+        finally:
+            server.cancel()
+    response = asyncio.run(test())
+    headers, body = response.split(b"\r\n\r\n", 1)
+    assert headers.startswith(b"HTTP/1.0 200 OK")
+    assert body.decode() == metrics.to_prometheus()
+
+def test_dump_is_written_once_more_when_cancelled(tmp_path):
+    metrics, _, _ = registry()
+    path = tmp_path / "metrics.json"
+
+    async def test():
+        dumping = asyncio.ensure_future(dump_metrics_periodically(str(path), 60, metrics))
+        await asyncio.sleep(0)
+        dumping.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await dumping
+    asyncio.run(test())
+    assert json.loads(path.read_text())["counters"]["bytes_total"] == {"client": 7000}
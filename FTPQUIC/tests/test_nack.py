@@ -0,0 +1,117 @@
+"""
+Tests of the selective retransmit with NACK PDUs: the ReorderBuffer of the server, which holds chunks that arrive early
+and asks for the missing ones, and the RetransmitWindow of the client, which finds the chunks it is asked for
+"""
+
+import asyncio
+import time
+import pytest
+import pdu
+from ft_client import RetransmitWindow
+from ft_server import ReorderBuffer, missing_sequence_ranges, MAX_CHUNK_RETRIES
+from metrics import StreamStats
+
+# Stands in for the connection of the stream, and keeps the ranges of the NACK PDUs it sends
+class NackRecorder:
+    def __init__(self):
+        self.nacks = [] # (ranges, next expected sequence) of every NACK PDU
+
+    async def send(self, event):
+        datagram, _ = pdu.Datagram.from_framed_bytes(event.data)
+        assert datagram.mtype == pdu.MSG_TYPE_FILE_NACK
+        self.nacks.append((pdu.unpack_sequence_ranges(datagram.msg), datagram.sequence))
+
+def reorder_buffer(max_size = 1000, in_order = True):
+    conn = NackRecorder()
+    buffer = ReorderBuffer(conn, 0, "f", pdu.WIRE_FORMAT_BINARY, StreamStats(b"c", 0, "server"), max_size, in_order)
+    return buffer, conn
+
+def test_early_chunks_ask_for_the_gap_once():
+    buffer, conn = reorder_buffer()
+
+    async def receive():
+        await buffer.hold(3, b"c3", "s3", 1) # chunks 1 and 2 are missing
+        await buffer.hold(4, b"c4", "s4", 1) # nothing new is missing
+        await buffer.hold(6, b"c6", "s6", 1) # chunk 5 is missing
+        await buffer.hold(3, b"c3", "s3", 1) # a duplicate is not held twice
+    asyncio.run(receive())
+    assert conn.nacks == [([(1, 2)], 1), ([(5, 1)], 1)]
+    assert buffer.size == 6
+    assert buffer.take(3) == (b"c3", "s3")
+    assert buffer.take(3) is None
+    assert buffer.size == 4
+
+# Chunks that do not fit are dropped, those already asked for are asked for again once the buffer was written
+def test_full_buffer_drops_chunks():
+    buffer, conn = reorder_buffer(max_size=4)
+
+    async def receive():
+        await buffer.hold(5, b"c5..", "s5", 0) # asks for 0 to 4, fills the buffer
+        await buffer.hold(2, b"c2", "s2", 0) # was asked for, so it is asked for again later
+        await buffer.hold(9, b"c9", "s9", 0) # was never asked for, it is asked for with the next gap
+        buffer.take(5)
+        await buffer.request_dropped(0)
+    asyncio.run(receive())
+    assert conn.nacks == [([(0, 5)], 0), ([(2, 1)], 0)]
+    assert buffer.dropped == set()
+
+def test_rejected_chunk_fails_after_its_retries():
+    buffer, conn = reorder_buffer()
+
+    async def receive():
+        for _ in range(MAX_CHUNK_RETRIES + 1):
+            await buffer.reject(2, 0)
+    asyncio.run(receive())
+    assert conn.nacks[0] == ([(0, 2), (2, 1)], 0)
+    assert len(conn.nacks) == MAX_CHUNK_RETRIES
+    assert buffer.failed
+
+def test_end_waits_for_missing_chunks():
+    buffer, conn = reorder_buffer()
+    end = pdu.Datagram(pdu.MSG_TYPE_FILE_END, "end", filename="f", sequence=4)
+
+    async def receive():
+        assert not await buffer.wait_for_missing(end, True, [], 4)
+        assert await buffer.wait_for_missing(end, False, missing_sequence_ranges({0, 2}, 4), 1)
+    asyncio.run(receive())
+    assert conn.nacks == [([(1, 1), (3, 1)], 1)]
+    assert buffer.waiting(False) and not buffer.waiting(True)
+
+def test_missing_sequence_ranges():
+    assert missing_sequence_ranges(set(), 3) == [(0, 3)]
+    assert missing_sequence_ranges({0, 1, 4}, 7) == [(2, 2), (5, 2)]
+    assert missing_sequence_ranges({0, 1, 2}, 3) == []
+
+def test_retransmit_window_finds_chunks_and_drops_acknowledged_ones():
+    window = RetransmitWindow(None, pdu.WIRE_FORMAT_BINARY, "f", None, None, pdu.DIGEST_SHA256, None, max_size=10)
+    window.add_block(0, 10, 4, 3) # chunks 0 to 2, the last one is 2 bytes
+    window.add_block(10, 6, 6, 1) # the chunk size changed between blocks
+    assert [window.chunk_range(sequence) for sequence in range(4)] == [(0, 4), (4, 4), (8, 2), (10, 6)]
+    for sequence in range(4):
+        window.add(sequence, b"pdu")
+    assert list(window.sent) == [1, 2, 3] and window.size == 9 # the oldest PDU did not fit
+    window.acknowledge(3)
+    assert list(window.sent) == [3] and window.size == 3
+
+# The wait for the ACK times out after a quiet period, which NACK PDUs and chunks sent again restart
+def test_ack_timeout_restarts_with_activity():
+    window = RetransmitWindow(None, pdu.WIRE_FORMAT_BINARY, "f", None, None, pdu.DIGEST_SHA256, None)
+
+    async def wait(active_for):
+        replies = asyncio.get_running_loop().create_future()
+        async def activity():
+            for _ in range(active_for):
+                await asyncio.sleep(0.05)
+                window.active_at = time.monotonic()
+            replies.set_result("ACK")
+        task = asyncio.ensure_future(activity()) if active_for else None
+        window.active_at = time.monotonic()
+        try:
+            return await window.wait_for_ack(replies, timeout=0.1)
+        finally:
+            if task is not None:
+                task.cancel()
+
+    assert asyncio.run(wait(6)) == "ACK" # longer than the timeout in total
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(wait(0))
@@ -0,0 +1,99 @@
+"""
+Tests of the validation of the byte ranges of parallel transfers, and of the ParallelTransfer that collects them
+"""
+
+import asyncio
+import pytest
+import ft_server
+from ft_server import ParallelTransfer, check_announced_range, check_announced_size, get_parallel_transfer
+from executor import get_offloader
+from storage import MemoryStorage
+
+def range_options(offset, length, size = 100, ranges = 2, transfer_id = "t"):
+    return {"offset": offset, "length": length, "size": size, "ranges": ranges, "transfer_id": transfer_id}
+
+@pytest.mark.parametrize("options, refused", [
+    (range_options(0, 50), None),
+    (range_options(50, 50), None),
+    (range_options(0, 0, size=0, ranges=1), None),
+    (range_options(-1, 50), "Invalid Range"),
+    (range_options(60, 50), "Invalid Range"), # past the end of the file
+    (range_options(0, "50"), "Invalid Range"),
+    (range_options(True, 50), "Invalid Range"),
+    (range_options(0, 50, ranges=0), "Invalid Range"),
+    (range_options(0, 50, ranges=ft_server.MAX_PARALLEL_RANGES + 1), "Invalid Range"),
+    (range_options(0, 50, transfer_id=5), "Invalid Range"),
+])
+def test_check_announced_range(options, refused):
+    assert check_announced_range(options) == refused
+
+def test_check_announced_size():
+    assert check_announced_size({"size": 10}, 10) is None
+    assert check_announced_size({"size": 11}, 10) == "File Too Large"
+    assert check_announced_size({"size": -1}, 10) == "Invalid Size"
+    assert check_announced_size({"size": 1.5}, 10) == "Invalid Size"
+    assert check_announced_size({}, 10) == "Invalid Size"
+
+# Runs a test coroutine with the jobs queue of a stream, and forgets the transfers it left
+def run_with_jobs(test):
+    async def run():
+        try:
+            return await test(get_offloader({}).queue())
+        finally:
+            ft_server.parallel_transfers.clear()
+    return asyncio.run(run())
+
+def test_ranges_must_not_overlap():
+    async def test(jobs):
+        transfer = ParallelTransfer((b"c", "t"), MemoryStorage(), "f", 100, 3, ft_server.FSYNC_NEVER, jobs)
+        assert transfer.add_range(0, 50)
+        assert not transfer.add_range(40, 20)
+        assert transfer.add_range(50, 0) # an empty range at the start of another range
+        assert not transfer.add_range(50, 0)
+        assert transfer.add_range(50, 50)
+        assert not transfer.add_range(0, 0) # one range too many
+        await transfer.discard(jobs)
+    run_with_jobs(test)
+
+# The ranges of a transfer share one sink, opened once by a worker thread, and it is saved when every range was verified
+def test_transfer_is_saved_once_every_range_is_verified():
+    async def test(jobs):
+        storage = MemoryStorage()
+        first = get_parallel_transfer(b"c", range_options(0, 60), storage, "f", ft_server.FSYNC_NEVER, jobs)
+        second = get_parallel_transfer(b"c", range_options(60, 40), storage, "f", ft_server.FSYNC_NEVER, jobs)
+        assert first is second
+        assert get_parallel_transfer(b"c", range_options(0, 50, size=99), storage, "f", ft_server.FSYNC_NEVER, jobs) is None
+        sinks = await asyncio.gather(first.open_sink(), second.open_sink())
+        assert sinks[0] is sinks[1]
+        for offset, length in ((0, 60), (60, 40)):
+            assert first.add_range(offset, length)
+            writer = sinks[0].range_writer(offset)
+            writer.write(bytes([offset]) * length)
+            writer.flush()
+        assert not await first.finish_range(60, True, jobs)
+        assert await first.finish_range(40, True, jobs)
+        assert storage.files()["f"][0] == 100
+        assert not ft_server.parallel_transfers
+    run_with_jobs(test)
+
+def test_failed_range_discards_the_file():
+    async def test(jobs):
+        storage = MemoryStorage()
+        transfer = get_parallel_transfer(b"c", range_options(0, 50), storage, "f", ft_server.FSYNC_NEVER, jobs)
+        assert transfer.add_range(0, 50) and transfer.add_range(50, 50)
+        await transfer.open_sink()
+        assert not await transfer.finish_range(50, False, jobs)
+        assert not await transfer.finish_range(50, True, jobs)
+        assert transfer.done and storage.files() == {}
+    run_with_jobs(test)
+
+# A transfer whose range streams never came is discarded after its timeout
+def test_idle_transfer_expires():
+    async def test(jobs):
+        transfer = get_parallel_transfer(b"c", range_options(0, 50), MemoryStorage(), "f", ft_server.FSYNC_NEVER, jobs)
+        transfer.timeout = 0.05
+        assert transfer.add_range(0, 50)
+        assert not await transfer.finish_range(50, True, jobs)
+        await asyncio.sleep(0.2)
+        assert transfer.done and not ft_server.parallel_transfers
+    run_with_jobs(test)
@@ -0,0 +1,113 @@
+"""
+Tests of the PDUs: both wire formats, their framing and the payloads of the CHUNK_LIST, CHUNK_HAVE and FILE_NACK PDUs
+"""
+
+import hashlib
+import os
+import struct
+import pytest
+import pdu
+from utils import encode_file_chunk, decode_file_chunk
+
+WIRE_FORMATS = (pdu.WIRE_FORMAT_JSON, pdu.WIRE_FORMAT_BINARY)
+
+# Compares the fields of two datagrams, payloads are compared as bytes since binary ones are memoryviews
+def assert_same_datagram(received, sent):
+    assert received.mtype == sent.mtype
+    assert received.filename == sent.filename
+    assert received.checksum == sent.checksum
+    assert received.sequence == sent.sequence
+    assert received.options == sent.options
+    assert received.compressed == sent.compressed
+    if isinstance(sent.msg, str):
+        assert received.msg == sent.msg
+    else:
+        assert bytes(received.msg) == bytes(sent.msg)
+
+@pytest.mark.parametrize("wire_format", WIRE_FORMATS)
+def test_data_round_trip(wire_format):
+    chunk = os.urandom(1000)
+    DATA_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_DATA, encode_file_chunk(chunk, wire_format), filename="dir/file.bin",
+                                 checksum=hashlib.sha256(chunk).hexdigest(), sequence=7)
+    received, rest = pdu.Datagram.from_framed_bytes(DATA_datagram.to_framed_bytes(wire_format))
+    assert rest == b""
+    assert_same_datagram(received, DATA_datagram)
+    assert bytes(decode_file_chunk(received.msg)) == chunk
+
+@pytest.mark.parametrize("wire_format", WIRE_FORMATS)
+def test_start_options_round_trip(wire_format):
+    options = {"size": 123, "chunk_size": 4096, "nack": True, "digest": pdu.DIGEST_SHA256, "compression": "zlib"}
+    START_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_START, "file.bin", filename="file.bin", options=options)
+    received = pdu.Datagram.from_bytes(START_datagram.to_bytes(wire_format))
+    assert_same_datagram(received, START_datagram)
+
+# A text checksum is not a hexadecimal digest, the binary format sends it as text instead of raw bytes
+def test_binary_text_checksum():
+    END_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_END, "Ending File Transmission", filename="f", checksum="not hex")
+    received = pdu.Datagram.from_bytes(END_datagram.to_bytes(pdu.WIRE_FORMAT_BINARY))
+    assert_same_datagram(received, END_datagram)
+
+@pytest.mark.parametrize("wire_format", WIRE_FORMATS)
+def test_compressed_flag(wire_format):
+    DATA_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_DATA, encode_file_chunk(b"compressed chunk", wire_format), filename="f",
+                                 checksum=hashlib.sha256(b"original chunk").hexdigest(), sequence=1, compressed=True)
+    framed = DATA_datagram.to_framed_bytes(wire_format)
+    if wire_format == pdu.WIRE_FORMAT_BINARY:
+        assert framed[pdu.LENGTH_PREFIX_SIZE + 2] & pdu.FLAG_COMPRESSED
+    received, _ = pdu.Datagram.from_framed_bytes(framed)
+    assert received.compressed
+    assert_same_datagram(received, DATA_datagram)
+
+# Peers that do not know the compression flag still parse the JSON of an uncompressed chunk
+def test_json_leaves_out_unused_fields():
+    fields = pdu.Datagram(pdu.MSG_TYPE_FILE_DATA, "chunk").to_json()
+    assert "compressed" not in fields and "options" not in fields
+
+@pytest.mark.parametrize("wire_format", WIRE_FORMATS)
+def test_framed_parts_match_framed_bytes(wire_format):
+    chunk = memoryview(os.urandom(5000))[100:4200]
+    DATA_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_DATA, encode_file_chunk(chunk, wire_format) if wire_format == pdu.WIRE_FORMAT_JSON else chunk,
+                                 filename="f", checksum=hashlib.sha256(chunk).hexdigest(), sequence=3)
+    parts = DATA_datagram.to_framed_parts(wire_format)
+    assert b"".join(parts) == DATA_datagram.to_framed_bytes(wire_format)
+    if wire_format == pdu.WIRE_FORMAT_BINARY:
+        assert len(parts) == 2
+        assert parts[-1] is chunk # the payload is handed on without a copy
+
+def test_binary_datagram_length_mismatch():
+    raw = pdu.Datagram(pdu.MSG_TYPE_FILE_DATA, b"chunk", filename="f").to_bytes(pdu.WIRE_FORMAT_BINARY)
+    with pytest.raises(ValueError):
+        pdu.Datagram.from_binary_bytes(raw[:-1])
+    with pytest.raises(ValueError):
+        pdu.Datagram.from_binary_bytes(raw[:pdu.BINARY_HEADER_SIZE - 1])
+
+# Two framed datagrams in one buffer are parsed one after the other
+def test_framed_bytes_leave_the_rest():
+    first = pdu.Datagram(pdu.MSG_TYPE_FILE_START, "a", filename="a").to_framed_bytes(pdu.WIRE_FORMAT_BINARY)
+    second = pdu.Datagram(pdu.MSG_TYPE_FILE_END, "b", filename="a").to_framed_bytes(pdu.WIRE_FORMAT_BINARY)
+    datagram, rest = pdu.Datagram.from_framed_bytes(first + second)
+    assert datagram.mtype == pdu.MSG_TYPE_FILE_START
+    assert bytes(rest) == second
+    assert struct.unpack(">I", first[:4])[0] == len(first) - pdu.LENGTH_PREFIX_SIZE
+
+def test_nack_payload():
+    ranges = [(0, 1), (5, 3), (2 ** 40, 2 ** 31)]
+    payload = pdu.pack_sequence_ranges(ranges)
+    assert len(payload) == len(ranges) * pdu.SEQUENCE_RANGE.size
+    assert pdu.unpack_sequence_ranges(payload) == ranges
+    NACK_datagram = pdu.Datagram(pdu.MSG_TYPE_FILE_NACK, payload, filename="f", sequence=5)
+    received = pdu.Datagram.from_bytes(NACK_datagram.to_bytes(pdu.WIRE_FORMAT_BINARY))
+    assert received.sequence == 5
+    assert pdu.unpack_sequence_ranges(received.msg) == ranges
+    with pytest.raises(ValueError):
+        pdu.unpack_sequence_ranges(payload[:-1])
+
+def test_chunk_records_and_bitmap():
+    records = [(4096, hashlib.sha256(b"a").hexdigest()), (17, hashlib.sha256(b"b").hexdigest())]
+    assert pdu.unpack_chunk_records(pdu.pack_chunk_records(records)) == records
+    flags = [True, False, False, True, True, False, False, False, True, False]
+    bitmap = pdu.pack_bitmap(flags)
+    assert len(bitmap) == 2
+    assert pdu.unpack_bitmap(bitmap, len(flags)) == flags
+    with pytest.raises(ValueError):
+        pdu.unpack_bitmap(bitmap, 17)
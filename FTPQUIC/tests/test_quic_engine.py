@@ -0,0 +1,95 @@
+"""
+Tests of the protocol of the connections, on a QuicConnection that is not connected to a peer: the send window that
+senders wait for, and the fallbacks when the private attributes of aioquic it uses are removed
+"""
+
+import asyncio
+import logging
+import pytest
+from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.connection import QuicConnection
+import quic_engine
+from quic_engine import AsyncQuicServer, alpn_protocols
+
+def make_protocol():
+    configuration = QuicConfiguration(is_client=True, alpn_protocols=alpn_protocols())
+    return AsyncQuicServer(QuicConnection(configuration=configuration))
+
+@pytest.fixture(autouse=True)
+def warnings_logged_again(monkeypatch):
+    monkeypatch.setattr(quic_engine, "_missing_private_attributes", set())
+
+def warnings(caplog):
+    return [record.getMessage() for record in caplog.records if record.levelno == logging.WARNING]
+
+# Senders wait while more than the send window was sent but not acknowledged, and wake up with the acknowledgements
+def test_drain_waits_for_the_send_window():
+    async def test():
+        protocol = make_protocol()
+        protocol._quic.send_stream_data(0, b"x" * 5000)
+        await asyncio.wait_for(protocol.drain(0, 5000), 1) # at the window
+        drained = asyncio.ensure_future(protocol.drain(0, 1000))
+        await asyncio.sleep(0)
+        assert not drained.done()
+        sender = protocol._quic._streams[0].sender
+        sender._buffer_start += 3000 # the peer acknowledged 3000 bytes
+        protocol._send_buffer_drained.set() # as when a datagram is received
+        await asyncio.sleep(0)
+        assert not drained.done() # 2000 bytes are still in flight
+        sender._buffer_start += 1000
+        protocol._send_buffer_drained.set()
+        await asyncio.wait_for(drained, 1)
+    asyncio.run(test())
+
+def test_drain_fails_once_the_connection_is_closed():
+    async def test():
+        protocol = make_protocol()
+        protocol._quic.send_stream_data(0, b"x" * 5000)
+        drained = asyncio.ensure_future(protocol.drain(0, 1000))
+        await asyncio.sleep(0)
+        protocol._closed.set()
+        protocol._send_buffer_drained.set()
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(drained, 1)
+    asyncio.run(test())
+
+def test_stream_limits_are_paused_through_the_private_hook():
+    async def test():
+        protocol = make_protocol()
+        assert protocol._quic._write_stream_limits.__name__ == "write_unpaused_stream_limits"
+    asyncio.run(test())
+
+def test_receive_queues_are_unbounded_without_the_private_hook(monkeypatch, caplog):
+    monkeypatch.delattr(QuicConnection, "_write_stream_limits")
+    async def test():
+        make_protocol()
+        make_protocol()
+    asyncio.run(test())
+    assert warnings(caplog) == ["[cli] aioquic has no _write_stream_limits, the receive queues of streams are not bounded. "
+                                "Install the aioquic version of requirements.txt"] # logged once
+
+def test_send_buffer_without_its_private_attributes_is_not_bounded(caplog):
+    async def test():
+        protocol = make_protocol()
+        protocol._quic.send_stream_data(0, b"x" * 100)
+        assert protocol.stream_send_buffered(0) == 100
+        assert protocol.stream_send_buffered(4) == 0 # not opened
+        del protocol._quic._streams[0].sender._buffer_start
+        assert protocol.stream_send_buffered(0) == 0
+        await asyncio.wait_for(protocol.drain(0, 10), 1) # does not wait
+    asyncio.run(test())
+    assert len(warnings(caplog)) == 1 and "_buffer_start" in warnings(caplog)[0]
+
+def test_rtt_and_receive_window_without_their_private_attributes(caplog):
+    async def test():
+        protocol = make_protocol()
+        assert protocol.smoothed_rtt() == 0.0 # not measured yet
+        del protocol._quic._loss._rtt_smoothed
+        assert protocol.smoothed_rtt() == 0.0
+        protocol.reserve_receive_window(0, 1000) # the stream is not open
+        del protocol._quic._local_max_data
+        protocol._quic.send_stream_data(0, b"x")
+        protocol.reserve_receive_window(0, 1000)
+    asyncio.run(test())
+    assert ["_rtt_smoothed" in message for message in warnings(caplog)] == [True, False]
+    assert "_local_max_data" in warnings(caplog)[1]
@@ -0,0 +1,57 @@
+"""
+Tests of the FrameReassembler: frames split across QUIC events, and several frames in one event
+"""
+
+import asyncio
+import os
+import pdu
+from ft_quic import QuicStreamEvent
+from utils import FrameReassembler
+
+# Stands in for the connection of a stream, and returns the given events one by one
+class EventSource:
+    def __init__(self, events):
+        self.events = list(events)
+
+    async def receive(self):
+        return self.events.pop(0)
+
+def framed_chunks(count, size = 300):
+    datagrams = [pdu.Datagram(pdu.MSG_TYPE_FILE_DATA, os.urandom(size), filename="f", sequence=sequence) for sequence in range(count)]
+    return datagrams, b"".join(datagram.to_framed_bytes(pdu.WIRE_FORMAT_BINARY) for datagram in datagrams)
+
+def test_frames_split_byte_by_byte():
+    datagrams, data = framed_chunks(3)
+    reassembler = FrameReassembler()
+    received = []
+    for index in range(len(data)):
+        reassembler.feed(data[index:index + 1])
+        datagram = reassembler.next_datagram()
+        if datagram is not None:
+            received.append(datagram)
+    assert [datagram.sequence for datagram in received] == [0, 1, 2]
+    assert [bytes(datagram.msg) for datagram in received] == [datagram.msg for datagram in datagrams]
+    assert reassembler.next_datagram() is None
+
+def test_frames_merged_in_one_event():
+    datagrams, data = framed_chunks(5)
+    reassembler = FrameReassembler()
+    reassembler.feed(data)
+    received = [reassembler.next_datagram() for _ in datagrams]
+    assert [bytes(datagram.msg) for datagram in received] == [datagram.msg for datagram in datagrams]
+    assert reassembler.next_datagram() is None
+
+# The bytes of the next frame that arrive with the end of a frame are kept for the next read
+def test_read_keeps_leftover_bytes_until_the_stream_ends():
+    datagrams, data = framed_chunks(4)
+    cuts = [0, 10, 350, 351, 900, len(data)]
+    events = [QuicStreamEvent(0, data[start:end], end == len(data)) for start, end in zip(cuts, cuts[1:])]
+    reassembler = FrameReassembler(EventSource(events))
+
+    async def read_all():
+        return [datagram async for datagram in reassembler]
+
+    received = asyncio.run(read_all())
+    assert [datagram.sequence for datagram in received] == [0, 1, 2, 3]
+    assert [bytes(datagram.msg) for datagram in received] == [datagram.msg for datagram in datagrams]
+    assert reassembler.stream_ended and reassembler.stream_id == 0
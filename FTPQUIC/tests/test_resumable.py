@@ -0,0 +1,74 @@
+"""
+Tests of the ResumableFile: a partial file is reopened with the chunks it recorded, after they are verified again
+"""
+
+import hashlib
+import os
+import pytest
+from storage import ResumableFile, partial_paths
+
+CHUNK_SIZE = 1000
+
+@pytest.fixture
+def content():
+    return os.urandom(CHUNK_SIZE * 4 + 500) # the last chunk is shorter
+
+def chunk(content, sequence):
+    return content[sequence * CHUNK_SIZE:(sequence + 1) * CHUNK_SIZE]
+
+def write_chunks(resumable, content, sequences):
+    for sequence in sequences:
+        data = chunk(content, sequence)
+        assert resumable.write_chunk(sequence, data, hashlib.sha256(data).hexdigest())
+
+def test_reopen_keeps_the_written_chunks(tmp_path, content):
+    filepath = str(tmp_path / "file.bin")
+    resumable = ResumableFile(filepath, len(content), CHUNK_SIZE)
+    assert resumable.chunk_count == 5 and not resumable.resumed
+    write_chunks(resumable, content, [0, 1, 3])
+    resumable.close()
+
+    resumable = ResumableFile(filepath, len(content), CHUNK_SIZE)
+    assert resumable.resumed
+    assert resumable.received_ranges() == [[0, 2], [3, 4]]
+    data = chunk(content, 1)
+    assert not resumable.write_chunk(1, data, hashlib.sha256(data).hexdigest()) # already received
+    write_chunks(resumable, content, [4, 2])
+    assert resumable.is_complete()
+    assert resumable.hexdigest() == hashlib.sha256(content).hexdigest()
+    resumable.commit()
+    with open(filepath, "rb") as f:
+        assert f.read() == content
+    assert not any(os.path.exists(path) for path in partial_paths(filepath))
+
+# A chunk that was recorded but changed on disk, e.g. torn by a crash, is received again
+def test_reopen_drops_chunks_that_fail_verification(tmp_path, content):
+    filepath = str(tmp_path / "file.bin")
+    resumable = ResumableFile(filepath, len(content), CHUNK_SIZE)
+    write_chunks(resumable, content, [0, 1, 2])
+    resumable.close()
+    part_path, _ = partial_paths(filepath)
+    with open(part_path, "r+b") as f:
+        f.seek(CHUNK_SIZE + 10)
+        f.write(b"\x00" * 10)
+
+    resumable = ResumableFile(filepath, len(content), CHUNK_SIZE)
+    assert resumable.received_ranges() == [[0, 1], [2, 3]]
+    resumable.abort()
+    assert not any(os.path.exists(path) for path in partial_paths(filepath))
+
+# A manifest of another size or chunk size describes another file, so the transfer starts over
+def test_reopen_with_other_layout_starts_over(tmp_path, content):
+    filepath = str(tmp_path / "file.bin")
+    resumable = ResumableFile(filepath, len(content), CHUNK_SIZE)
+    write_chunks(resumable, content, [0, 1])
+    resumable.close()
+    resumable = ResumableFile(filepath, len(content), CHUNK_SIZE * 2)
+    assert not resumable.resumed and resumable.received_ranges() == []
+    resumable.abort()
+
+def test_write_chunk_rejects_bad_chunks(tmp_path, content):
+    resumable = ResumableFile(str(tmp_path / "file.bin"), len(content), CHUNK_SIZE)
+    assert not resumable.write_chunk(5, b"x", "00") # past the end
+    assert not resumable.write_chunk(0, b"short", "00") # wrong length
+    resumable.abort()
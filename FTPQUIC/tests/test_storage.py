@@ -0,0 +1,86 @@
+"""
+Tests of the sinks that stream received files to disk or to memory, and of the StoredFile: files sent by the server
+are memory mapped, and closed even while a slice is still referenced
+"""
+
+import hashlib
+import os
+import pytest
+from storage import FileSink, MemoryStorage, StoredFile, write_vectored, IOV_MAX
+
+# Chunks are written in batches to a temporary file next to the final path, which only appears once it is committed
+def test_file_sink_writes_batches_and_commits(tmp_path):
+    path = tmp_path / "dir" / "file.bin"
+    sink = FileSink(str(path), batch_size=3000)
+    chunks = [os.urandom(1000) for _ in range(7)]
+    for chunk in chunks[:2]:
+        sink.write(chunk)
+    assert os.path.getsize(sink.temp_path) == 0 and sink.needs_flush is False # the batch is not full yet
+    sink.write(chunks[2])
+    assert os.path.getsize(sink.temp_path) == 3000
+    for chunk in chunks[3:]:
+        sink.write(chunk, flush=False) # the caller flushes, e.g. from a worker thread
+    assert sink.needs_flush and os.path.getsize(sink.temp_path) == 3000
+    assert sink.hexdigest() == hashlib.sha256(b"".join(chunks)).hexdigest()
+    assert not path.exists()
+    sink.commit()
+    sink.abort() # after commit, the file is kept
+    assert path.read_bytes() == b"".join(chunks) and os.listdir(path.parent) == ["file.bin"]
+
+def test_file_sink_abort_removes_the_temporary_file(tmp_path):
+    sink = FileSink(str(tmp_path / "file.bin"))
+    sink.write(b"partial")
+    sink.abort()
+    assert os.listdir(tmp_path) == []
+    with pytest.raises(ValueError):
+        FileSink(str(tmp_path / "other.bin"), fsync="sometimes")
+
+def test_vectored_writes_of_more_buffers_than_iov_max(tmp_path):
+    buffers = [bytes([index % 256]) * 3 for index in range(IOV_MAX * 2 + 5)]
+    fd = os.open(tmp_path / "file.bin", os.O_WRONLY | os.O_CREAT)
+    try:
+        write_vectored(fd, buffers, 10)
+    finally:
+        os.close(fd)
+    assert (tmp_path / "file.bin").read_bytes() == b"\0" * 10 + b"".join(buffers)
+
+# A memory sink is stored in its storage once committed, and cannot grow past the maximum file size of the storage
+def test_memory_sink_is_bounded():
+    storage = MemoryStorage(max_file_size=5000)
+    sink = storage.open_sink("file.bin")
+    sink.write(b"x" * 4000)
+    with pytest.raises(ValueError):
+        sink.write(b"x" * 1001)
+    sink.commit()
+    assert bytes(storage.read("file.bin")) == b"x" * 4000
+    with pytest.raises(ValueError):
+        storage.open_sink("large.bin", size=5001)
+
+def test_stored_file_is_unmapped_when_closed(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(os.urandom(5000))
+    f = StoredFile(str(path))
+    mapping = f._mapping
+    chunk = bytes(f.source[100:1000])
+    f.close()
+    assert chunk == path.read_bytes()[100:1000]
+    assert mapping.closed and f._file.closed
+
+def test_mapping_with_a_referenced_slice_is_closed_later(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"x" * 5000)
+    f = StoredFile(str(path))
+    mapping = f._mapping
+    chunk = f.source[0:10] # e.g. the result of a finished job that is still held by the event loop
+    f.close() # does not raise BufferError
+    assert not mapping.closed and f._file.closed
+    assert bytes(chunk) == b"x" * 10 # the mapping keeps its own descriptor
+    chunk.release()
+    mapping.close()
+
+def test_empty_files_are_not_mapped(tmp_path):
+    path = tmp_path / "empty.bin"
+    path.write_bytes(b"")
+    f = StoredFile(str(path))
+    assert f.size == 0 and os.pread(f.source, 10, 0) == b""
+    f.close()
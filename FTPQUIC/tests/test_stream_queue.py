@@ -0,0 +1,66 @@
+"""
+Tests of the StreamEventQueue, the receive queue of the request handlers, which is bounded by the bytes of its events
+"""
+
+import asyncio
+from aioquic.quic.events import StreamDataReceived
+from ft_quic import QuicStreamEvent
+from quic_engine import StreamEventQueue
+
+# Stands in for the protocol of the connection, and records the streams that are paused
+class PausedStreams:
+    def __init__(self):
+        self.paused = set()
+        self.resumes = 0
+
+    def pause_stream(self, stream_id):
+        self.paused.add(stream_id)
+
+    def resume_stream(self, stream_id):
+        self.paused.discard(stream_id)
+        self.resumes += 1
+
+def event(size, stream_id = 0, end_stream = False):
+    return QuicStreamEvent(stream_id, b"x" * size, end_stream)
+
+def test_stream_is_paused_over_the_size_and_resumed_at_half():
+    protocol = PausedStreams()
+    queue = StreamEventQueue(protocol, max_size=1000)
+    for _ in range(4):
+        queue.put_nowait(event(250))
+    assert queue.size == 1000 and protocol.paused == set() # paused once it is over its size
+    queue.put_nowait(event(250))
+    queue.put_nowait(event(250))
+    assert protocol.paused == {0}
+    for _ in range(3):
+        queue.get_nowait()
+    assert protocol.paused == {0} and queue.size == 750
+    queue.get_nowait()
+    assert protocol.paused == set() and queue.size == 500 and protocol.resumes == 1
+    queue.get_nowait() # a resumed stream is not resumed twice
+    assert protocol.resumes == 1
+
+def test_get_waits_for_an_event():
+    queue = StreamEventQueue(PausedStreams(), max_size=1000)
+
+    async def read():
+        reader = asyncio.ensure_future(queue.get())
+        await asyncio.sleep(0)
+        assert not reader.done()
+        queue.put_nowait(event(10, end_stream=True))
+        return await reader
+
+    received = asyncio.run(read())
+    assert received.end_stream and len(received.data) == 10 and queue.size == 0
+
+# Once the reader is gone, data is dropped, its stream is resumed, and the queue can be dropped when the stream ends
+def test_closed_queue_drops_events():
+    protocol = PausedStreams()
+    queue = StreamEventQueue(protocol, max_size=100)
+    queue.put_nowait(event(200))
+    assert protocol.paused == {0}
+    assert not queue.close()
+    assert protocol.paused == set() and queue.empty() and queue.size == 0
+    assert not queue.feed(StreamDataReceived(data=b"late", end_stream=False, stream_id=0))
+    assert queue.empty()
+    assert queue.feed(StreamDataReceived(data=b"", end_stream=True, stream_id=0))
@@ -0,0 +1,89 @@
+"""
+Tests of the session ticket caches: expiry, the least recently added tickets dropped first, single use, the saved
+encoding of the tickets and the directories they are saved to
+"""
+
+import datetime
+import os
+import pytest
+from aioquic.buffer import Buffer
+from aioquic.tls import CipherSuite, SessionTicket
+from tickets import ClientTicketCache, SessionTicketStore, decode_ticket, encode_ticket
+
+def session_ticket(label, lifetime = datetime.timedelta(hours=24)):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return SessionTicket(age_add=1234, cipher_suite=CipherSuite.AES_128_GCM_SHA256, not_valid_after=now + lifetime,
+                         not_valid_before=now, resumption_secret=os.urandom(32), server_name="localhost", ticket=label,
+                         max_early_data_size=0xFFFFFFFF, other_extensions=[(0xFF02, b"value")])
+
+def test_encoding_round_trip():
+    ticket = session_ticket(b"label")
+    decoded, header = decode_ticket(Buffer(data=encode_ticket(ticket, 12.5, server="localhost:4433")))
+    assert decoded == ticket
+    assert header["expiry"] == 12.5 and header["server"] == "localhost:4433"
+    with pytest.raises(ValueError):
+        decode_ticket(Buffer(data=encode_ticket(ticket, 12.5)[:-3]))
+
+def test_tickets_are_used_once():
+    store = SessionTicketStore()
+    ticket = session_ticket(b"a")
+    store.add(ticket)
+    assert store.pop(b"a") is ticket
+    assert store.pop(b"a") is None
+
+def test_ttl_shortens_the_lifetime():
+    store = SessionTicketStore(ttl=-1) # expired as soon as it is added
+    store.add(session_ticket(b"a"))
+    assert store.pop(b"a") is None
+
+def test_least_recently_added_tickets_are_dropped():
+    store = SessionTicketStore(max_size=2)
+    for label in (b"a", b"b", b"c"):
+        store.add(session_ticket(label))
+    assert list(store.tickets) == [b"b", b"c"]
+    store.add(session_ticket(b"b")) # added again, so it is the most recent one
+    store.add(session_ticket(b"d"))
+    assert list(store.tickets) == [b"b", b"d"]
+
+# Workers share the tickets through the directory, a ticket is claimed by removing its file
+def test_directory_is_shared(tmp_path):
+    directory = str(tmp_path / "tickets")
+    first = SessionTicketStore(directory=directory)
+    second = SessionTicketStore(directory=directory)
+    ticket = session_ticket(b"a")
+    first.add(ticket)
+    assert oct(os.stat(directory).st_mode & 0o777) == "0o700"
+    assert second.pop(b"a") == ticket
+    assert first.pop(b"a") is None
+
+def test_prune_removes_expired_tickets(tmp_path):
+    directory = str(tmp_path / "tickets")
+    store = SessionTicketStore(ttl=-1, directory=directory)
+    store.add(session_ticket(b"a"))
+    assert len(os.listdir(directory)) == 1
+    SessionTicketStore(directory=directory)
+    assert os.listdir(directory) == []
+
+def test_client_cache_file(tmp_path):
+    path = str(tmp_path / "tickets.bin")
+    cache = ClientTicketCache(path)
+    ticket = session_ticket(b"a")
+    cache.add("localhost:4433", ticket, "file-transfer-protocol/2")
+    cache.add("expired:4433", session_ticket(b"b", -datetime.timedelta(seconds=1)), "file-transfer-protocol")
+    assert oct(os.stat(path).st_mode & 0o777) == "0o600"
+    loaded = ClientTicketCache(path)
+    assert loaded.get("localhost:4433") == (ticket, "file-transfer-protocol/2")
+    assert loaded.get("expired:4433") == (None, None)
+    with open(path, "ab") as f:
+        f.write(b"garbage")
+    assert ClientTicketCache(path).get("localhost:4433") == (ticket, "file-transfer-protocol/2")
+
+@pytest.mark.skipif(not hasattr(os, "geteuid"), reason="mode bits are not the permissions on Windows")
+def test_directories_writable_by_others_are_refused(tmp_path):
+    os.chmod(tmp_path, 0o777)
+    with pytest.raises(PermissionError):
+        SessionTicketStore(directory=str(tmp_path))
+    with pytest.raises(PermissionError):
+        ClientTicketCache(str(tmp_path / "tickets.bin"))
+    os.chmod(tmp_path, 0o755)
+    ClientTicketCache(str(tmp_path / "tickets.bin"))
@@ -0,0 +1,134 @@
+"""
+Tests of the routing between the worker processes of a server: the connection IDs of a worker start with its index,
+and datagrams of a connection of another worker are forwarded to that worker only
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import pytest
+from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.connection import QuicConnection
+import quic_engine
+from quic_engine import RoutingQuicServer, stamp_connection_ids, serve_worker
+from bench import generate_certificate, free_port, BENCH_HOST
+from api import MemoryStorage
+from workers import WorkerRouter
+
+pytestmark = pytest.mark.skipif(not quic_engine.ROUTABLE_CONNECTION_IDS, reason="aioquic has no _replenish_connection_ids")
+
+@pytest.fixture(scope="module")
+def certificate(tmp_path_factory):
+    return generate_certificate(str(tmp_path_factory.mktemp("certificate")))
+
+# Unix socket paths are short, so the directory is not the one of pytest
+@pytest.fixture
+def socket_directory():
+    with tempfile.TemporaryDirectory(prefix="ftquic-test-") as directory:
+        yield directory
+
+def test_connection_ids_start_with_the_worker_index(certificate):
+    configuration = quic_engine.build_server_quic_config(*certificate)
+    connection = QuicConnection(configuration=configuration, original_destination_connection_id=os.urandom(8))
+    stamp_connection_ids(connection, 7)
+    assert connection.host_cid[0] == 7 and connection._local_initial_source_connection_id == connection.host_cid
+    connection._remote_active_connection_id_limit = 4 # as announced by the peer
+    connection._replenish_connection_ids()
+    assert len(connection._host_cids) == 4
+    assert all(host_cid.cid[0] == 7 and len(host_cid.cid) == 8 for host_cid in connection._host_cids)
+
+def test_router_paths(socket_directory):
+    router = WorkerRouter(1, 3, socket_directory)
+    assert router.local_path == os.path.join(socket_directory, "worker-1.sock")
+    assert router.peer_paths == [router.path(0), router.path(2)]
+
+# Records what a server sends, in place of its sockets and of the protocols of its connections
+class Recorder:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr = None):
+        self.sent.append((data, addr))
+
+    def datagram_received(self, data, addr):
+        self.sent.append((data, addr))
+
+# A 1-RTT packet of the connection with the destination connection ID 'cid'
+def short_header_packet(cid):
+    return bytes([0x40]) + cid + os.urandom(40)
+
+# A datagram as a worker forwards it, with the address of the client
+def forwarded_message(data, addr):
+    address = json.dumps(list(addr)).encode("utf-8")
+    return len(address).to_bytes(2, "big") + address + data
+
+def routing_server(index, count, directory):
+    server = RoutingQuicServer(configuration=QuicConfiguration(is_client=False), router=WorkerRouter(index, count, directory))
+    server.connection_made(Recorder())
+    server._router_transport = Recorder()
+    return server
+
+def forwarded(server):
+    return [(message, path) for message, path in server._router_transport.sent]
+
+def test_datagrams_are_forwarded_to_the_worker_of_their_connection(socket_directory):
+    async def test():
+        server = routing_server(0, 3, socket_directory)
+        own = short_header_packet(bytes([0]) + os.urandom(7)) # e.g. a closed connection of this worker
+        server.datagram_received(own, ("10.0.0.1", 4433))
+        assert forwarded(server) == []
+        packet = short_header_packet(bytes([2]) + os.urandom(7))
+        server.datagram_received(packet, ("10.0.0.1", 4433))
+        [(message, path)] = forwarded(server)
+        assert path == server._router.path(2)
+
+        # The worker of the connection processes the datagram as if it came from the client address
+        worker = routing_server(2, 3, socket_directory)
+        protocol = worker._protocols[packet[1:9]] = Recorder()
+        worker.forwarded_datagram_received(message)
+        worker.forwarded_datagram_received(forwarded_message(own, ("10.0.0.1", 4433))) # not a connection of this worker
+        assert protocol.sent == [(packet, ("10.0.0.1", 4433))]
+    asyncio.run(test())
+
+# With more workers than a connection ID byte can tell apart, datagrams go to every other worker
+def test_datagrams_are_forwarded_to_every_worker_without_routing(socket_directory):
+    async def test():
+        server = routing_server(0, quic_engine.MAX_ROUTED_WORKERS + 1, socket_directory)
+        assert not server.routes_by_connection_id()
+        server.datagram_received(short_header_packet(bytes([0]) + os.urandom(7)), ("10.0.0.1", 4433))
+        messages = forwarded(server)
+        assert [path for _, path in messages] == server._router.peer_paths
+        message = messages[0][0]
+        length = int.from_bytes(message[:2], "big")
+        assert json.loads(message[2:2 + length]) == ["10.0.0.1", 4433]
+    asyncio.run(test())
+
+# A worker accepts connections with stamped connection IDs, including the ones issued after the handshake
+def test_worker_serves_a_transfer(certificate, socket_directory, tmp_path):
+    cert_file, key_file = certificate
+    path = tmp_path / "file.bin"
+    path.write_bytes(os.urandom(20_000))
+    storage = MemoryStorage()
+    port = free_port()
+    connections = []
+
+    def create_protocol(connection, *args, **kwargs):
+        connections.append(connection)
+        return quic_engine.AsyncQuicServer(connection, *args, scope={"storage": storage}, **kwargs)
+
+    async def test():
+        configuration = quic_engine.build_server_quic_config(cert_file, key_file)
+        server = await serve_worker(BENCH_HOST, port, configuration=configuration, create_protocol=create_protocol,
+                                    router=WorkerRouter(3, 4, socket_directory))
+        try:
+            client_configuration = quic_engine.build_client_quic_config(cert_file)
+            return await quic_engine.run_client(BENCH_HOST, port, client_configuration, [str(path)], {})
+        finally:
+            server.close()
+    [result] = asyncio.run(asyncio.wait_for(test(), 30))
+    assert result["successful"]
+    assert bytes(storage.read(str(path))) == path.read_bytes()
+    [connection] = connections
+    assert len(connection._host_cids) > 1
+    assert all(host_cid.cid[0] == 3 for host_cid in connection._host_cids)
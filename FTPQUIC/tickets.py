@@ -0,0 +1,204 @@
+"""
+This Python file houses the TLS session ticket caches of the server and the client
+A client that kept a ticket from an earlier connection resumes the TLS session and sends its first PDUs as 0-RTT
+early data, which saves one round trip per connection for short uploads.
+Tickets hold the resumption secret of a session, so the files they are saved to are only readable by their owner,
+and are only kept in directories that no other user can write to. A saved ticket is a JSON header, with the fields
+of the session and the time it expires, followed by the NewSessionTicket message of TLS that carried it.
+"""
+
+import collections
+import datetime
+import json
+import os
+import secrets
+import stat
+import threading
+import time
+from typing import Optional
+from aioquic.buffer import Buffer
+from aioquic.tls import Alert, CipherSuite, NewSessionTicket, SessionTicket, pull_new_session_ticket, push_new_session_ticket
+
+DEFAULT_MAX_TICKETS = 10000 # tickets the server keeps, the least recently added ones are dropped first
+PRUNE_INTERVAL = 100 # tickets added between two scans of the ticket directory for expired tickets
+TICKET_SUFFIX = ".ticket"
+# Errors of a saved ticket that cannot be decoded, aioquic asserts the type of the TLS message
+TICKET_DECODE_ERRORS = (ValueError, KeyError, TypeError, AssertionError, Alert)
+
+# This function returns the time until which a ticket can be used, as a UNIX timestamp
+def ticket_expiry(ticket: SessionTicket, ttl = None):
+    expiry = ticket.not_valid_after.replace(tzinfo=datetime.timezone.utc).timestamp()
+    if ttl is not None:
+        expiry = min(expiry, time.time() + ttl)
+    return expiry
+
+# This function returns a saved ticket: the size of a JSON header, the header, then the NewSessionTicket message of TLS
+# The header holds the fields of the session that the message does not carry, its expiry and the other 'fields'
+def encode_ticket(ticket: SessionTicket, expiry, **fields) -> bytes:
+    header = json.dumps({"expiry": expiry, "cipher_suite": int(ticket.cipher_suite),
+                         "not_valid_before": ticket.not_valid_before.timestamp(),
+                         "not_valid_after": ticket.not_valid_after.timestamp(),
+                         "resumption_secret": ticket.resumption_secret.hex(), "server_name": ticket.server_name,
+                         **fields}).encode()
+    message = NewSessionTicket(
+        ticket_lifetime=max(0, int((ticket.not_valid_after - ticket.not_valid_before).total_seconds())),
+        ticket_age_add=ticket.age_add, ticket=ticket.ticket, max_early_data_size=ticket.max_early_data_size,
+        other_extensions=list(ticket.other_extensions))
+    buf = Buffer(capacity=2 + len(header) + 32 + len(ticket.ticket) + sum(4 + len(value) for _, value in ticket.other_extensions))
+    buf.push_uint16(len(header))
+    buf.push_bytes(header)
+    push_new_session_ticket(buf, message)
+    return buf.data
+
+# This function reads the next saved ticket from 'buf', returns it with its header, raises one of TICKET_DECODE_ERRORS
+def decode_ticket(buf: Buffer):
+    header = json.loads(buf.pull_bytes(buf.pull_uint16()))
+    message = pull_new_session_ticket(buf)
+    ticket = SessionTicket(
+        age_add=message.ticket_age_add, cipher_suite=CipherSuite(header["cipher_suite"]),
+        not_valid_after=datetime.datetime.fromtimestamp(header["not_valid_after"], datetime.timezone.utc),
+        not_valid_before=datetime.datetime.fromtimestamp(header["not_valid_before"], datetime.timezone.utc),
+        resumption_secret=bytes.fromhex(header["resumption_secret"]), server_name=header["server_name"],
+        ticket=message.ticket, max_early_data_size=message.max_early_data_size,
+        other_extensions=message.other_extensions)
+    return ticket, header
+
+# This function raises PermissionError when another user than the owner of the process can write to 'path'
+# Tickets hold session secrets, and tickets saved there by another user would be trusted by the server or the client.
+def check_private_path(path):
+    if not hasattr(os, "geteuid"):
+        return # the permissions of Windows are access control lists, not mode bits
+    st = os.stat(path)
+    if st.st_uid != os.geteuid():
+        raise PermissionError(f"{path} is owned by another user, session tickets are not kept there")
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise PermissionError(f"{path} can be written by other users, session tickets are not kept there")
+
+# This function writes a file that only its owner can read, replacing it atomically
+def write_private_file(path, data):
+    temp_path = f"{path}.{secrets.token_hex(4)}.part"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o600)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+    os.replace(temp_path, path)
+
+"""
+This class stores the session tickets issued by the server, for the TLS session resumption of its clients
+Tickets expire after their lifetime, or after 'ttl' seconds if it is shorter, and only the last 'max_size' tickets
+are kept. A ticket is removed when it is used, so the early data of a session cannot be replayed.
+With a 'directory', tickets are also saved to files, so they survive server restarts and are shared by the
+worker processes of a server: a worker can resume a session that another worker started. The directory is created
+when it does not exist, and PermissionError is raised when other users can write to it.
+"""
+class SessionTicketStore:
+    def __init__(self, max_size = DEFAULT_MAX_TICKETS, ttl = None, directory = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.directory = directory
+        self.tickets = collections.OrderedDict() # ticket label -> (ticket, expiry), least recently added first
+        self._added = 0
+        if directory is not None:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            check_private_path(directory)
+            self._prune()
+
+    def _path(self, label: bytes):
+        return os.path.join(self.directory, label.hex() + TICKET_SUFFIX)
+
+    def add(self, ticket: SessionTicket) -> None:
+        expiry = ticket_expiry(ticket, self.ttl)
+        self.tickets[ticket.ticket] = (ticket, expiry)
+        self.tickets.move_to_end(ticket.ticket)
+        while len(self.tickets) > self.max_size:
+            self.tickets.popitem(last=False)
+        if self.directory is not None:
+            write_private_file(self._path(ticket.ticket), encode_ticket(ticket, expiry))
+            self._added += 1
+            if self._added % PRUNE_INTERVAL == 0:
+                self._prune()
+
+    def pop(self, label: bytes) -> Optional[SessionTicket]:
+        entry = self.tickets.pop(label, None)
+        if self.directory is not None:
+            # Removing the file claims the ticket, so two workers cannot both accept it
+            path = self._path(label)
+            try:
+                if entry is None:
+                    with open(path, "rb") as f:
+                        ticket, header = decode_ticket(Buffer(data=f.read()))
+                    entry = (ticket, header["expiry"])
+                os.remove(path)
+            except (OSError, *TICKET_DECODE_ERRORS):
+                return None
+        if entry is None or entry[1] < time.time():
+            return None
+        return entry[0]
+
+    # Removes the files of expired tickets, and of the oldest tickets beyond 'max_size'
+    def _prune(self):
+        now = time.time()
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(TICKET_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, "rb") as f:
+                    _, header = decode_ticket(Buffer(data=f.read()))
+                if header["expiry"] < now:
+                    os.remove(path)
+                else:
+                    files.append((os.path.getmtime(path), path))
+            except (OSError, *TICKET_DECODE_ERRORS):
+                continue # removed by another worker, or being written
+        files.sort()
+        for _, path in files[:max(0, len(files) - self.max_size)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+"""
+This class keeps the last session ticket the client received from every server, with the ALPN of the session
+The client needs the ALPN to pick the PDU wire format of the PDUs it sends as early data, before the handshake
+is complete. With a 'path', the tickets are saved to that file, one after the other with the server and the ALPN
+in their header, so the next client process can use them. PermissionError is raised when other users can write to
+the file or to its directory.
+"""
+class ClientTicketCache:
+    def __init__(self, path = None) -> None:
+        self.path = path
+        self.tickets = {} # "server name:port" -> (ticket, ALPN)
+        self._lock = threading.Lock()
+        if path is not None:
+            check_private_path(os.path.dirname(os.path.abspath(path)))
+            if os.path.exists(path):
+                check_private_path(path)
+                self._load()
+
+    # Reads the tickets saved to the file, a ticket that cannot be decoded ends the file
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                buf = Buffer(data=f.read())
+            while not buf.eof():
+                ticket, header = decode_ticket(buf)
+                self.tickets[header["server"]] = (ticket, header["alpn"])
+        except (OSError, *TICKET_DECODE_ERRORS):
+            pass
+
+    # Returns a ticket that is still valid for the server and the ALPN of its session, or (None, None)
+    def get(self, server_name):
+        ticket, alpn = self.tickets.get(server_name, (None, None))
+        if ticket is None or not ticket.is_valid:
+            return None, None
+        return ticket, alpn
+
+    def add(self, server_name, ticket: SessionTicket, alpn) -> None:
+        with self._lock:
+            self.tickets[server_name] = (ticket, alpn)
+            if self.path is not None:
+                write_private_file(self.path, b"".join(encode_ticket(ticket, ticket_expiry(ticket), server=name, alpn=alpn)
+                                                       for name, (ticket, alpn) in self.tickets.items() if ticket.is_valid))
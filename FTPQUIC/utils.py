@@ -2,29 +2,193 @@
 This Python file houses helper functions for the client and server
 """
 
+import glob
 import hashlib
+import os
+import struct
+from collections import deque
+import base64 # library used for encoding/decoding file chunks during transfer
 import pdu
 from ft_quic import QuicStreamEvent
+from executor import get_offloader
+from metrics import metrics
+
+CHECKSUM_READ_SIZE = 1024 * 1024 # number of bytes read at a time to compute the checksum of a file
 
 # This function calculates the checksum of the entire file and returns it as a hexadecimal string
-async def calculate_checksum(file):
+# The file is read and hashed by a worker, so other transfers keep running while a large file is hashed
+async def calculate_checksum(file, offloader = None):
+    if offloader is None:
+        offloader = get_offloader({})
+    return await offloader.run_cpu(file_checksum, file)
+
+# This function reads and hashes a file, it runs in a worker thread or process
+def file_checksum(file):
     hash = hashlib.sha256()
     # Read file chunks and hash them for the checksum
     try:
         with open(file, "rb") as f:
-            while file_chunk := f.read(4096):
+            while file_chunk := f.read(CHECKSUM_READ_SIZE):
                 hash.update(file_chunk)
         return hash.hexdigest()
     except Exception as e:
         return f"File Error: {e}"
     
+# This function expands the paths given to the client: glob patterns are matched and directories are walked recursively
+# Other paths are kept as they are, so a missing file is reported when it is sent
+def expand_paths(paths):
+    filenames = []
+    for path in paths:
+        matches = sorted(glob.glob(path, recursive=True)) if any(c in path for c in "*?[") else [path]
+        for match in matches:
+            if os.path.isdir(match):
+                for root, directories, files in os.walk(match):
+                    directories.sort()
+                    filenames.extend(os.path.join(root, name) for name in sorted(files))
+            else:
+                filenames.append(match)
+    return filenames
+
+# This function returns a byte range of a file descriptor, or a slice of a memoryview without copying it
+def read_range(source, offset, size):
+    if isinstance(source, memoryview):
+        return source[offset:offset + size]
+    return memoryview(os.pread(source, size, offset))
+
+# This function reads a block of consecutive chunks of a file and returns every chunk with its checksum
+# 'source' is a file descriptor, or a memoryview of the memory mapped file or of data in memory, whose slices are returned without copying
+# It runs in a worker thread, and also updates 'file_hash' with the block
+# With a 'compressor', every chunk is also compressed, the compressed chunk is None for chunks that are sent as they are
+def read_chunk_block(source, offset, size, chunk_size, file_hash, digest = pdu.DIGEST_SHA256, role = "client", compressor = None):
+    block = read_range(source, offset, size)
+    with metrics.timer("hash_seconds", role):
+        file_hash.update(block)
+        chunks = []
+        for position in range(0, len(block), chunk_size):
+            file_chunk = block[position:position + chunk_size]
+            chunks.append((file_chunk, pdu.new_digest(digest, file_chunk).hexdigest(), None))
+    if compressor is not None:
+        with metrics.timer("compress_seconds", role):
+            chunks = [(file_chunk, checksum, compressor.compress(file_chunk)) for file_chunk, checksum, _ in chunks]
+    return chunks
+
+# This function prepares a file chunk for a DATA datagram, only the JSON wire format needs it as Base64 text
+def encode_file_chunk(file_chunk, wire_format):
+    if wire_format == pdu.WIRE_FORMAT_BINARY:
+        return file_chunk
+    return base64.b64encode(file_chunk).decode("ascii") # convert binary bytes to ASCII using Base64
+
+# This function returns the original bytes of a file chunk from either wire format
+def decode_file_chunk(msg):
+    if isinstance(msg, str):
+        return base64.b64decode(msg.encode("ascii")) # Convert from base64 string to original bytes
+    return msg
+
+"""
+This class reassembles framed datagrams from the data events of a single QUIC stream
+Received data is kept as a list of memoryviews, so appending is constant time and a frame that
+fits in one event is parsed without copying. Bytes left after a complete frame are kept for the next read.
+When a role is given, the time spent parsing every datagram is added to the decoding histogram of that role.
+"""
+class FrameReassembler:
+    def __init__(self, conn = None, role = None):
+        self.conn = conn
+        self.role = role
+        self.stream_id = None
+        self.stream_ended = False
+        self._chunks = deque() # memoryviews of the received data that has not been parsed yet
+        self._buffered = 0 # number of bytes in self._chunks
+
+    # This function adds received stream data to the reassembler
+    def feed(self, data):
+        if data:
+            self._chunks.append(memoryview(data))
+            self._buffered += len(data)
+
+    # This function returns the first 'size' buffered bytes as one contiguous view
+    # Only a frame split across several events is joined, which copies that frame once
+    def _peek(self, size):
+        first = self._chunks[0]
+        if len(first) >= size:
+            return first[:size]
+        parts = []
+        needed = size
+        while needed > 0:
+            chunk = self._chunks.popleft()
+            parts.append(chunk[:needed])
+            if len(chunk) > needed:
+                self._chunks.appendleft(chunk[needed:])
+            needed -= len(parts[-1])
+        joined = memoryview(b"".join(parts))
+        self._chunks.appendleft(joined)
+        return joined
+
+    # This function drops the first 'size' buffered bytes
+    def _consume(self, size):
+        self._buffered -= size
+        while size > 0:
+            chunk = self._chunks.popleft()
+            if len(chunk) > size:
+                self._chunks.appendleft(chunk[size:])
+            size -= len(chunk)
+
+    # This function returns the next complete datagram, or None if more data is needed
+    def next_datagram(self):
+        if self._buffered < pdu.LENGTH_PREFIX_SIZE:
+            return None # Incomplete Header
+        length = struct.unpack(">I", self._peek(pdu.LENGTH_PREFIX_SIZE))[0]
+        frame_size = pdu.LENGTH_PREFIX_SIZE + length
+        if self._buffered < frame_size:
+            return None # Incomplete Payload
+        frame = self._peek(frame_size)
+        self._consume(frame_size)
+        if self.role is None:
+            datagram, _ = pdu.Datagram.from_framed_bytes(frame)
+        else:
+            with metrics.timer("decode_seconds", self.role):
+                datagram, _ = pdu.Datagram.from_framed_bytes(frame)
+        return datagram
+
+    # This function waits for the next complete datagram of the stream, or returns None once the stream has ended
+    async def read(self):
+        while True:
+            datagram = self.next_datagram()
+            if datagram is not None:
+                return datagram
+            if self.stream_ended:
+                return None
+            event: QuicStreamEvent = await self.conn.receive()
+            self.stream_id = event.stream_id
+            self.stream_ended = event.end_stream
+            self.feed(event.data)
+
+    # Every complete datagram of the stream can be read with 'async for'
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        datagram = await self.read()
+        if datagram is None:
+            raise StopAsyncIteration
+        return datagram
+
 # This function helps read and parse a framed datagram
-async def read_framed_datagram(conn):
-    buffer = b'' # empty byte string
-    while True:
-        event: QuicStreamEvent = await conn.receive()
-        buffer += event.data
-        datagram, remaining = pdu.Datagram.from_framed_bytes(buffer)
-        if datagram:
-            return datagram, event.stream_id
-        buffer = remaining # Wait for more data
+# Pass the same reassembler on every call to keep the bytes received after the frame
+async def read_framed_datagram(conn, reassembler: FrameReassembler = None):
+    if reassembler is None:
+        reassembler = FrameReassembler(conn)
+    datagram = await reassembler.read()
+    return datagram, reassembler.stream_id
+
+# The original JSON protocol replies with an unframed datagram, while the binary protocol frames every datagram
+def reply_bytes(datagram, wire_format):
+    if wire_format == pdu.WIRE_FORMAT_BINARY:
+        return datagram.to_framed_bytes(wire_format)
+    return datagram.to_bytes()
+
+# This function reads a reply sent with reply_bytes
+async def read_reply(conn, wire_format, reassembler: FrameReassembler):
+    if wire_format == pdu.WIRE_FORMAT_BINARY:
+        return await reassembler.read()
+    event: QuicStreamEvent = await conn.receive()
+    return pdu.Datagram.from_bytes(event.data)
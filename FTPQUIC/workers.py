@@ -0,0 +1,109 @@
+"""
+This Python file houses the multi-process server
+The parent process starts one worker process per CPU core (or as many as requested). Every worker runs its own
+event loop and QUIC server on the same port with SO_REUSEPORT, so connections are spread over the workers and
+the packet processing, encryption and hashing of different connections run on different cores.
+Workers write to the same 'server_files' directory, and send their metrics to the parent, which exports their sum.
+The connection IDs of a worker start with its index, datagrams that reach another worker after a client address
+changes are forwarded to that worker only. Parallel transfers and resumable files are state of each worker.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+from metrics import metrics, WorkerMetrics
+
+METRICS_REPORT_INTERVAL = 1.0 # seconds between two metrics reports of a worker to the parent
+WORKER_STOP_TIMEOUT = 5.0 # seconds a worker has to exit before it is killed
+WORKER_POLL_INTERVAL = 0.5 # seconds between two checks that every worker is still running
+
+# Identifies a worker process, and the Unix sockets the workers forward datagrams of each other's connections to
+class WorkerRouter:
+    def __init__(self, index, count, directory):
+        self.index = index
+        self.count = count
+        self.directory = directory
+
+    def path(self, index):
+        return os.path.join(self.directory, f"worker-{index}.sock")
+
+    @property
+    def local_path(self):
+        return self.path(self.index)
+
+    @property
+    def peer_paths(self):
+        return [self.path(index) for index in range(self.count) if index != self.index]
+
+# This function sends the metrics of a worker to the parent every 'interval' seconds, and once more when it is cancelled
+async def report_metrics(reports, index, interval = METRICS_REPORT_INTERVAL):
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            reports.put((index, metrics.state()))
+    finally:
+        reports.put((index, metrics.state()))
+
+# This function receives the metrics reports of the workers until it is cancelled
+async def collect_metrics(reports, collector: WorkerMetrics):
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            index, state = await loop.run_in_executor(None, reports.get, True, METRICS_REPORT_INTERVAL)
+        except queue.Empty:
+            continue
+        collector.update(index, state)
+
+# This function is the entry point of a worker process, it runs 'serve(router, reports)' until the process is stopped
+def worker_main(serve, router, reports):
+    try:
+        asyncio.run(serve(router, reports))
+    except KeyboardInterrupt:
+        pass
+
+"""
+This function starts 'count' worker processes and waits until they exit
+'serve' is a coroutine function that runs the server of one worker, it receives the WorkerRouter of the worker and
+the queue its metrics are reported to. 'exporters' is a coroutine function that receives the combined metrics
+of the workers and exports them from the parent process.
+"""
+def run_workers(count, serve, exporters = None):
+    directory = tempfile.mkdtemp(prefix="ftquic-workers-") # Unix sockets of the workers
+    reports = multiprocessing.Queue()
+    processes = []
+    for index in range(count):
+        router = WorkerRouter(index, count, directory)
+        process = multiprocessing.Process(target=worker_main, args=(serve, router, reports), name=f"ft-worker-{index}")
+        process.start()
+        processes.append(process)
+
+    async def supervise():
+        collector = WorkerMetrics()
+        tasks = [asyncio.ensure_future(collect_metrics(reports, collector))]
+        if exporters is not None:
+            tasks.append(asyncio.ensure_future(exporters(collector)))
+        try:
+            # The server stops when any worker exits, e.g. because the port could not be bound
+            while all(process.is_alive() for process in processes):
+                await asyncio.sleep(WORKER_POLL_INTERVAL)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    try:
+        asyncio.run(supervise())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join(WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+        shutil.rmtree(directory, ignore_errors=True)